@@ -1,18 +1,26 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from . import models, schemas, utils
+from .cache import user_cache
 from typing import Optional
 
-def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    return await db.scalar(select(models.User).where(models.User.email == email))
 
-def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
+    return await db.scalar(select(models.User).where(models.User.username == username))
 
-def get_user_by_id(db: Session, user_id: int) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.id == user_id).first()
+async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.get(models.User, user_id)
 
-def create_user(db: Session, user: schemas.UserCreate, verification_token: str) -> models.User:
-    hashed_password = utils.hash_password(user.password)
+async def get_user_by_verification_token(db: AsyncSession, token: str) -> Optional[models.User]:
+    return await db.scalar(select(models.User).where(models.User.verification_token == token))
+
+async def get_user_by_reset_token(db: AsyncSession, token: str) -> Optional[models.User]:
+    return await db.scalar(select(models.User).where(models.User.reset_token == token))
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate, verification_token: str) -> models.User:
+    hashed_password = await utils.password_hasher.hash(user.password)
     db_user = models.User(
         email=user.email,
         username=user.username,
@@ -22,26 +30,29 @@ def create_user(db: Session, user: schemas.UserCreate, verification_token: str)
         is_verified=False
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
-def update_user_verification(db: Session, user: models.User, is_verified: bool):
+async def update_user_verification(db: AsyncSession, user: models.User, is_verified: bool):
     user.is_verified = is_verified
     user.verification_token = None
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    user_cache.invalidate(user.id)
     return user
 
-def set_reset_token(db: Session, user: models.User, reset_token: str):
+async def set_reset_token(db: AsyncSession, user: models.User, reset_token: str):
     user.reset_token = reset_token
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    user_cache.invalidate(user.id)
     return user
 
-def reset_password(db: Session, user: models.User, new_password: str):
-    user.password_hash = utils.hash_password(new_password)
+async def reset_password(db: AsyncSession, user: models.User, new_password: str):
+    user.password_hash = await utils.password_hasher.hash(new_password)
     user.reset_token = None
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    user_cache.invalidate(user.id)
     return user 
\ No newline at end of file
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import queue
+import smtplib
+import ssl
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from typing import Any, Dict, List
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import AsyncSessionLocal
+from .models import EmailOutbox
+
+# Без SMTP_HOST письма печатаются в лог, как раньше делал utils.send_email.
+# Для локальной проверки подходит mailpit из docker-compose: SMTP_HOST=mail, SMTP_PORT=1025
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "0") == "1"
+SMTP_SSL = os.getenv("SMTP_SSL", "0") == "1"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 10))
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))
+MAIL_FROM = os.getenv("MAIL_FROM", "no-reply@halal-scan.local")
+
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", SMTP_POOL_SIZE))
+MAIL_POLL_INTERVAL = float(os.getenv("MAIL_POLL_INTERVAL", 1))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 6))
+MAIL_LEASE_SECONDS = int(os.getenv("MAIL_LEASE_SECONDS", 120))
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class ConsoleTransport:
+    def send(self, message: EmailMessage) -> None:
+        print(f"Send email to {message['To']}: {message['Subject']}\n{message.get_content()}")
+
+    def close(self) -> None:
+        pass
+
+
+class SmtpTransport:
+    """Пул постоянных SMTP-соединений: TLS-рукопожатие и AUTH делаются один раз, а не на каждое письмо.
+
+    send блокирующий и вызывается из потока (asyncio.to_thread).
+    """
+
+    def __init__(self, size: int = SMTP_POOL_SIZE):
+        self._idle: "queue.LifoQueue[smtplib.SMTP]" = queue.LifoQueue()
+        self._slots = queue.Queue()
+        for _ in range(size):
+            self._slots.put(None)
+
+    def _connect(self) -> smtplib.SMTP:
+        if SMTP_SSL:
+            connection = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT, context=ssl.create_default_context())
+        else:
+            connection = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                connection.starttls(context=ssl.create_default_context())
+        if SMTP_USERNAME:
+            connection.login(SMTP_USERNAME, SMTP_PASSWORD or "")
+        return connection
+
+    def send(self, message: EmailMessage) -> None:
+        self._slots.get()
+        connection = None
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                connection.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл простаивающее соединение — переподключаемся один раз
+                connection = self._connect()
+                connection.send_message(message)
+            self._idle.put(connection)
+            connection = None
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            self._slots.put(None)
+
+    def close(self) -> None:
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.quit()
+            except Exception:
+                pass
+
+
+def create_transport():
+    return SmtpTransport() if SMTP_HOST else ConsoleTransport()
+
+
+class MailQueue:
+    """Исходящие письма в таблице email_outbox: запрос только добавляет строку, отправляют воркеры."""
+
+    def enqueue(self, db: AsyncSession, to_email: str, subject: str, body: str) -> None:
+        """Добавляет письмо в сессию запроса без коммита: строка попадёт в БД тем же коммитом,
+        что и изменение пользователя, или не попадёт вовсе, если запрос откатится."""
+        db.add(EmailOutbox(to_email=to_email, subject=subject, body=body, status="queued",
+                           attempts=0, available_at=utcnow()))
+
+    async def claim(self, limit: int) -> List[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            now = utcnow()
+            rows = (await db.scalars(
+                select(EmailOutbox)
+                .where(or_(
+                    and_(EmailOutbox.status == "queued", EmailOutbox.available_at <= now),
+                    and_(EmailOutbox.status == "sending", EmailOutbox.locked_at <= now - timedelta(seconds=MAIL_LEASE_SECONDS)),
+                ))
+                .order_by(EmailOutbox.available_at)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )).all()
+            claimed = []
+            for row in rows:
+                result = await db.execute(
+                    update(EmailOutbox)
+                    .where(EmailOutbox.id == row.id, EmailOutbox.attempts == row.attempts)
+                    .values(status="sending", locked_at=now, attempts=row.attempts + 1)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount:
+                    claimed.append({"id": row.id, "to_email": row.to_email, "subject": row.subject,
+                                    "body": row.body, "attempts": row.attempts + 1})
+            await db.commit()
+            return claimed
+
+    async def mark_sent(self, mail_id: int) -> None:
+        await self._update(mail_id, status="sent", sent_at=utcnow(), error=None)
+
+    async def mark_failed(self, mail_id: int, attempts: int, error: str, permanent: bool = False) -> None:
+        if permanent or attempts >= MAIL_MAX_ATTEMPTS:
+            # dead — больше не пытаемся; такие письма видно в таблице и их можно переотправить вручную
+            await self._update(mail_id, status="dead", error=error)
+        else:
+            await self._update(mail_id, status="queued", error=error,
+                               available_at=utcnow() + timedelta(seconds=min(3600, 5 * 2 ** attempts)))
+
+    async def _update(self, mail_id: int, **values) -> None:
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(EmailOutbox).where(EmailOutbox.id == mail_id).values(**values))
+            await db.commit()
+
+
+class MailWorkers:
+    def __init__(self, mail_queue: "MailQueue", transport=None, count: int = MAIL_WORKERS):
+        self.queue = mail_queue
+        self.transport = transport
+        self.count = count
+        self._tasks = []
+
+    def start(self) -> None:
+        if self.transport is None:
+            self.transport = create_transport()
+        self._tasks = [asyncio.create_task(self._run(i)) for i in range(self.count)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.transport is not None:
+            await asyncio.to_thread(self.transport.close)
+
+    async def _run(self, number: int) -> None:
+        while True:
+            try:
+                batch = await self.queue.claim(limit=10)
+            except Exception as e:
+                logging.error(f"Mail worker {number}: failed to claim mail: {e}")
+                batch = []
+            if not batch:
+                await asyncio.sleep(MAIL_POLL_INTERVAL)
+                continue
+            for mail in batch:
+                try:
+                    await self._deliver(mail)
+                except Exception as e:
+                    # Обычно сбой БД в mark_sent/mark_failed: письмо вернётся в очередь по истечении аренды
+                    logging.error(f"Mail worker {number}: failed to deliver mail {mail['id']}: {e}")
+                    await asyncio.sleep(MAIL_POLL_INTERVAL)
+
+    async def _deliver(self, mail: Dict[str, Any]) -> None:
+        message = EmailMessage()
+        message["From"] = MAIL_FROM
+        message["To"] = mail["to_email"]
+        message["Subject"] = mail["subject"]
+        message.set_content(mail["body"])
+        try:
+            await asyncio.to_thread(self.transport.send, message)
+        except Exception as e:
+            logging.warning(f"Mail {mail['id']} attempt {mail['attempts']} failed: {e}")
+            # 5xx от сервера (несуществующий адрес и т.п.) повтор не исправит
+            permanent = isinstance(e, smtplib.SMTPRecipientsRefused) or (
+                isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500)
+            await self.queue.mark_failed(mail["id"], mail["attempts"], str(e), permanent)
+            return
+        await self.queue.mark_sent(mail["id"])
+
+
+mail_queue = MailQueue()
@@ -1,27 +1,33 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from . import schemas, models, crud, utils, database
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import schemas, models, crud, utils
+from .database import get_db
 from jose import JWTError, jwt
 from datetime import timedelta
 from fastapi.security import OAuth2PasswordBearer
+from .cache import user_cache
+from .mail import mail_queue
+from .throttle import auth_throttle
+from .utils import PasswordHasherBusyError, password_hasher
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-# Dependency
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Токены подписывает utils.create_access_token — проверяем тем же ключом
+SECRET_KEY = utils.SECRET_KEY
+ALGORITHM = utils.ALGORITHM
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+def too_many_attempts(retry_after: int) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many attempts, try again later", headers={"Retry-After": str(retry_after)})
 
-SECRET_KEY = "your_secret_key"
-ALGORITHM = "HS256"
+def throttle_ip(request: Request):
+    # Проверяем до bcrypt: отказ стоит микросекунды, а не сотни миллисекунд CPU
+    retry_after = auth_throttle.check_ip(request.client.host if request.client else "unknown")
+    if retry_after:
+        raise too_many_attempts(retry_after)
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -34,32 +40,60 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_id(db, int(user_id))
+    user = user_cache.get(int(user_id))
+    if user is not None:
+        return user
+    user = await crud.get_user_by_id(db, int(user_id))
     if user is None:
         raise credentials_exception
+    # Отсоединяем от сессии запроса, чтобы объект можно было отдавать следующим запросам
+    db.expunge(user)
+    user_cache.set(user)
     return user
 
-@router.post("/register", response_model=schemas.UserOut)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    if crud.get_user_by_email(db, user.email):
+@router.post("/register", response_model=schemas.UserOut, dependencies=[Depends(throttle_ip)])
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    if await crud.get_user_by_email(db, user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    if crud.get_user_by_username(db, user.username):
+    if await crud.get_user_by_username(db, user.username):
         raise HTTPException(status_code=400, detail="Username already taken")
     verification_code = utils.generate_verification_code()
-    db_user = crud.create_user(db, user, verification_code)
-    # Отправка письма
-    utils.send_email(
-        db_user.email,
+    # Письмо уходит из фоновых воркеров (auth/mail.py), регистрация не ждёт SMTP.
+    # Строка очереди коммитится вместе с пользователем в create_user
+    mail_queue.enqueue(
+        db,
+        user.email,
         "Verify your email",
         f"Verification code: {verification_code}"
     )
+    try:
+        db_user = await crud.create_user(db, user, verification_code)
+    except PasswordHasherBusyError:
+        raise too_many_attempts(1)
     return db_user
 
-@router.post("/login", response_model=schemas.Token)
-def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, user.email)
-    if not db_user or not utils.verify_password(user.password, db_user.password_hash):
+@router.post("/login", response_model=schemas.Token, dependencies=[Depends(throttle_ip)])
+async def login(user: schemas.UserLogin, db: AsyncSession = Depends(get_db)):
+    retry_after = auth_throttle.check_account(user.email)
+    if retry_after:
+        raise too_many_attempts(retry_after)
+    db_user = await crud.get_user_by_email(db, user.email)
+    if not db_user:
+        auth_throttle.failure(user.email)
         raise HTTPException(status_code=400, detail="Incorrect email or password")
+    try:
+        valid, new_hash = await password_hasher.verify_and_update(user.password, db_user.password_hash)
+    except PasswordHasherBusyError:
+        raise too_many_attempts(1)
+    if not valid:
+        auth_throttle.failure(user.email)
+        raise HTTPException(status_code=400, detail="Incorrect email or password")
+    auth_throttle.success(user.email)
+    if new_hash:
+        # Хэш со старой стоимостью bcrypt — пересчитан при входе, пока пароль известен
+        db_user.password_hash = new_hash
+        await db.commit()
+        user_cache.invalidate(db_user.id)
     if not db_user.is_verified:
         raise HTTPException(status_code=400, detail="Email not verified")
     access_token = utils.create_access_token(
@@ -69,52 +103,62 @@ def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/verify-email")
-def verify_email(data: schemas.EmailVerification, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.verification_token == data.token).first()
+async def verify_email(data: schemas.EmailVerification, db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_verification_token(db, data.token)
     if not user:
         raise HTTPException(status_code=400, detail="Invalid token")
-    crud.update_user_verification(db, user, True)
+    await crud.update_user_verification(db, user, True)
     return {"message": "Email verified"}
 
 @router.post("/resend-verification")
-def resend_verification(data: schemas.ResendVerification, db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, data.email)
+async def resend_verification(data: schemas.ResendVerification, db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_email(db, data.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     if user.is_verified:
         raise HTTPException(status_code=400, detail="Email already verified")
     verification_token = utils.generate_verification_code()
     user.verification_token = verification_token
-    db.commit()
-    utils.send_email(
+    mail_queue.enqueue(
+        db,
         user.email,
         "Verify your email",
         f"Verification code: {verification_token}"
     )
+    await db.commit()
+    user_cache.invalidate(user.id)
     return {"message": "Verification email resent"}
 
 @router.post("/forgot-password")
-def forgot_password(data: schemas.ForgotPassword, db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, data.email)
+async def forgot_password(data: schemas.ForgotPassword, db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_email(db, data.email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     reset_token = utils.generate_token()
-    crud.set_reset_token(db, user, reset_token)
-    utils.send_email(
+    mail_queue.enqueue(
+        db,
         user.email,
         "Reset your password",
         f"Reset token: {reset_token}"
     )
+    await crud.set_reset_token(db, user, reset_token)
     return {"message": "Password reset email sent"}
 
-@router.post("/reset-password")
-def reset_password(data: schemas.ResetPassword, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.reset_token == data.token).first()
+@router.post("/reset-password", dependencies=[Depends(throttle_ip)])
+async def reset_password(data: schemas.ResetPassword, db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_reset_token(db, data.token)
     if not user:
         raise HTTPException(status_code=400, detail="Invalid token")
-    crud.reset_password(db, user, data.new_password)
+    try:
+        await crud.reset_password(db, user, data.new_password)
+    except PasswordHasherBusyError:
+        raise too_many_attempts(1)
     return {"message": "Password reset successful"}
 
 @router.get("/me", response_model=schemas.UserOut)
-def read_users_me(current_user: models.User = Depends(get_current_user)):
-    return current_user 
\ No newline at end of file
+async def read_users_me(current_user: models.User = Depends(get_current_user)):
+    return current_user
+
+@router.get("/user-cache/stats")
+async def user_cache_stats():
+    return user_cache.stats()
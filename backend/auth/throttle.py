@@ -0,0 +1,80 @@
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+# Попытки входа/регистрации/сброса пароля с одного IP: каждая стоит десятки-сотни мс CPU на bcrypt
+AUTH_IP_MAX_ATTEMPTS = int(os.getenv("AUTH_IP_MAX_ATTEMPTS", 20))
+AUTH_IP_WINDOW_SECONDS = int(os.getenv("AUTH_IP_WINDOW_SECONDS", 60))
+# Неудачные входы в один аккаунт с любых IP (перебор пароля распределённой сетью)
+AUTH_ACCOUNT_MAX_FAILURES = int(os.getenv("AUTH_ACCOUNT_MAX_FAILURES", 5))
+AUTH_ACCOUNT_WINDOW_SECONDS = int(os.getenv("AUTH_ACCOUNT_WINDOW_SECONDS", 15 * 60))
+AUTH_THROTTLE_MAX_KEYS = int(os.getenv("AUTH_THROTTLE_MAX_KEYS", 100000))
+
+
+class SlidingWindow:
+    """Скользящее окно событий по ключу; число ключей ограничено, самые давние вытесняются."""
+
+    def __init__(self, limit: int, window: int, max_keys: int = AUTH_THROTTLE_MAX_KEYS):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._events: "OrderedDict[str, deque]" = OrderedDict()
+
+    def _current(self, key: str) -> deque:
+        events = self._events.get(key)
+        if events is None:
+            return deque()
+        cutoff = time.monotonic() - self.window
+        while events and events[0] <= cutoff:
+            events.popleft()
+        if not events:
+            del self._events[key]
+        return events
+
+    def retry_after(self, key: str) -> Optional[int]:
+        """Секунды до следующей разрешённой попытки или None, если лимит не исчерпан."""
+        events = self._current(key)
+        if len(events) < self.limit:
+            return None
+        return max(1, int(events[0] + self.window - time.monotonic()) + 1)
+
+    def hit(self, key: str) -> None:
+        events = self._current(key)
+        events.append(time.monotonic())
+        self._events[key] = events
+        self._events.move_to_end(key)
+        while len(self._events) > self.max_keys:
+            self._events.popitem(last=False)
+
+    def reset(self, key: str) -> None:
+        self._events.pop(key, None)
+
+
+class AuthThrottle:
+    """Ограничение попыток до того, как запрос дойдёт до bcrypt.
+
+    Счётчики в памяти процесса: при нескольких воркерах лимит действует на каждый воркер.
+    """
+
+    def __init__(self):
+        self.ip_attempts = SlidingWindow(AUTH_IP_MAX_ATTEMPTS, AUTH_IP_WINDOW_SECONDS)
+        self.account_failures = SlidingWindow(AUTH_ACCOUNT_MAX_FAILURES, AUTH_ACCOUNT_WINDOW_SECONDS)
+
+    def check_ip(self, ip: str) -> Optional[int]:
+        retry_after = self.ip_attempts.retry_after(ip)
+        if retry_after is None:
+            self.ip_attempts.hit(ip)
+        return retry_after
+
+    def check_account(self, account: str) -> Optional[int]:
+        return self.account_failures.retry_after(account.lower())
+
+    def failure(self, account: str) -> None:
+        self.account_failures.hit(account.lower())
+
+    def success(self, account: str) -> None:
+        self.account_failures.reset(account.lower())
+
+
+auth_throttle = AuthThrottle()
@@ -1,6 +1,8 @@
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
-from passlib.context import CryptContext
 from jose import jwt
 from datetime import datetime, timedelta
 import secrets
@@ -9,7 +11,19 @@ import string
 
 load_dotenv()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# При изменении BCRYPT_ROUNDS старые хэши прозрачно пересчитываются при следующем входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# bcrypt отпускает GIL, поэтому потоков достаточно; их число ограничивает долю CPU под пароли
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", 4 * PASSWORD_HASH_WORKERS))
+
+
+@lru_cache(maxsize=None)
+def password_context():
+    # passlib и backend bcrypt грузятся при первом пароле или в прогреве, а не при импорте приложения
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
@@ -21,10 +35,61 @@ if not SECRET_KEY:
 # Пароли
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return password_context().hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_context().verify(plain_password, hashed_password)
+
+
+class PasswordHasherBusyError(RuntimeError):
+    pass
+
+
+class PasswordHasher:
+    """Отдельный ограниченный пул для bcrypt, чтобы всплеск логинов не занимал общий threadpool.
+
+    Если все потоки заняты и PASSWORD_HASH_QUEUE_SIZE операций уже ждут,
+    новые сразу получают PasswordHasherBusyError (роутер отвечает 429).
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_size: int = PASSWORD_HASH_QUEUE_SIZE):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self._slots = None
+        self._executor = None
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.capacity)
+
+    async def warmup(self) -> None:
+        """Импорт passlib и выбор backend bcrypt в потоке пула — до первого входа пользователя."""
+        self.start()
+        await asyncio.get_running_loop().run_in_executor(self._executor, lambda: password_context().handler("bcrypt").get_backend())
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn, *args):
+        self.start()
+        if self._slots.locked():
+            raise PasswordHasherBusyError("Password hashing workers are saturated")
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(password_context().hash, password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str):
+        """(совпал ли пароль, новый хэш или None) — новый хэш, если параметры bcrypt устарели."""
+        return await self._run(password_context().verify_and_update, plain_password, hashed_password)
+
+
+password_hasher = PasswordHasher()
 
 # JWT
 
@@ -45,8 +110,4 @@ def generate_token() -> str:
 
 def generate_verification_code() -> str:
     return "".join(random.choices(string.digits, k=6))
-
-# Заглушка для отправки email
-
-def send_email(to_email: str, subject: str, body: str):
-    print(f"Send email to {to_email}: {subject}\n{body}") 
\ No newline at end of file
+ 
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""Синтетический корпус фото упаковок для нагрузочных сценариев.
+
+    python benchmarks/corpus.py --out /tmp/halal_bench_corpus --count 200
+
+Этикетки рисуются детерминированно по seed: название, «Состав: ...» и у части — штрихкод
+EAN-13 с правильной контрольной цифрой. Реальных фото в репозитории нет, а такой корпус
+проходит тот же путь (предобработка, OCR, кэш по хэшам, каталог), что и снимки пользователей.
+"""
+import argparse
+import io
+import os
+import random
+from typing import Any, Dict, List
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+PRODUCTS = ["Мармелад", "Печенье", "Шоколад", "Йогурт", "Колбаса", "Сок", "Конфеты", "Вафли", "Зефир", "Чипсы"]
+BRANDS = ["Рахат", "Баян Сулу", "Fake Foods", "Ақ Ниет", "Sweet Co", "Eco Farm"]
+INGREDIENTS = [
+    "сахар", "пшеничная мука", "пектин", "лимонная кислота", "желатин", "кармин", "E120", "E471",
+    "растительное масло", "сухое молоко", "какао-порошок", "ароматизатор", "крахмал", "соль",
+    "лецитин соевый", "глюкозный сироп", "свиной жир", "яичный порошок", "ванилин", "дрожжи",
+]
+
+# Кодировки цифр EAN-13: L и G — левая половина (выбор по первой цифре), R — правая
+EAN_L = ["0001101", "0011001", "0010011", "0111101", "0100011", "0110001", "0101111", "0111011", "0110111", "0001011"]
+EAN_G = ["0100111", "0110011", "0011011", "0100001", "0011101", "0111001", "0000101", "0010001", "0001001", "0010111"]
+EAN_R = ["1110010", "1100110", "1101100", "1000010", "1011100", "1001110", "1010000", "1000100", "1001000", "1110100"]
+EAN_PARITY = ["LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG", "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL"]
+
+
+def ean13(body: str) -> str:
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(body))
+    return body + str((10 - total % 10) % 10)
+
+
+def ean13_bits(code: str) -> str:
+    parity = EAN_PARITY[int(code[0])]
+    left = "".join((EAN_L if p == "L" else EAN_G)[int(d)] for p, d in zip(parity, code[1:7]))
+    right = "".join(EAN_R[int(d)] for d in code[7:])
+    return "101" + left + "01010" + right + "101"
+
+
+def load_font(size: int) -> ImageFont.ImageFont:
+    for name in ("DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size=size)
+
+
+def label_spec(seed: int) -> Dict[str, Any]:
+    """Что напечатано на этикетке seed: отсюда же берутся эталонные ответы для eval_routing.py."""
+    rng = random.Random(seed)
+    background = tuple(rng.randint(225, 255) for _ in range(3))
+    brand, product = rng.choice(BRANDS), rng.choice(PRODUCTS)
+    ingredients = rng.sample(INGREDIENTS, rng.randint(4, 9))
+    barcode = ean13("460" + "".join(str(rng.randint(0, 9)) for _ in range(9))) if seed % 2 == 0 else None
+    return {"background": background, "brand": brand, "product_name": product, "ingredients": ingredients,
+            "barcode": barcode, "rotation": rng.uniform(-3, 3)}
+
+
+def render_label(seed: int, width: int = 1200, height: int = 900) -> bytes:
+    spec = label_spec(seed)
+    image = Image.new("RGB", (width, height), spec["background"])
+    draw = ImageDraw.Draw(image)
+    title, body = load_font(56), load_font(30)
+    draw.text((60, 40), f"{spec['brand']} — {spec['product_name']}", font=title, fill=(20, 20, 20))
+
+    text = "Состав: " + ", ".join(spec["ingredients"]) + "."
+    lines, line = [], ""
+    for word in text.split():
+        if draw.textlength(f"{line} {word}", font=body) > width - 120:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}".strip()
+    lines.append(line)
+    for number, line in enumerate(lines):
+        draw.text((60, 160 + number * 42), line, font=body, fill=(30, 30, 30))
+
+    if spec["barcode"]:
+        x, top = 60, height - 230
+        for bit in ean13_bits(spec["barcode"]):
+            if bit == "1":
+                draw.rectangle((x, top, x + 2, top + 150), fill=(0, 0, 0))
+            x += 3
+        draw.text((60, top + 160), spec["barcode"], font=body, fill=(0, 0, 0))
+
+    # Немного «камеры»: поворот и размытие, чтобы OCR и перцептивный хэш работали не на идеальной картинке
+    image = image.rotate(spec["rotation"], expand=True, fillcolor=(255, 255, 255)).filter(ImageFilter.GaussianBlur(0.6))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def render_photo(seed: int, width: int = 4032, height: int = 3024) -> bytes:
+    """Этикетка в размере снимка 12 Мп с зерном матрицы: файл 5–10 МБ, как у телефонной камеры."""
+    label = Image.open(io.BytesIO(render_label(seed))).resize((width, height), Image.BICUBIC)
+    grain = Image.effect_noise((width, height), 64).convert("RGB")
+    buffer = io.BytesIO()
+    Image.blend(label, grain, 0.25).save(buffer, "JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def build_photos(path: str, count: int) -> List[str]:
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for seed in range(count):
+        file = os.path.join(path, f"photo_{seed:04d}.jpg")
+        if not os.path.exists(file):
+            with open(file, "wb") as f:
+                f.write(render_photo(seed))
+        files.append(file)
+    return files
+
+
+def build_corpus(path: str, count: int) -> List[str]:
+    """Создаёт недостающие файлы и возвращает пути ко всем count изображениям."""
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for seed in range(count):
+        file = os.path.join(path, f"label_{seed:04d}.jpg")
+        if not os.path.exists(file):
+            with open(file, "wb") as f:
+                f.write(render_label(seed))
+        files.append(file)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default="/tmp/halal_bench_corpus")
+    parser.add_argument("--count", type=int, default=200)
+    args = parser.parse_args()
+    print(f"{len(build_corpus(args.out, args.count))} images in {args.out}")
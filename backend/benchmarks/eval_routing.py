@@ -0,0 +1,165 @@
+"""Офлайн-сравнение маршрутов моделей на размеченном наборе: точность, задержка, токены и стоимость по ступеням.
+
+    python benchmarks/eval_routing.py                                       # halal: gpt-4o против gpt-4o-mini>gpt-4o
+    python benchmarks/eval_routing.py --stage vision --routes gpt-4o gpt-4o-mini>gpt-4o
+    python benchmarks/eval_routing.py --fake                                # без ключа, против fake_openai.py
+
+Маршрут — модели через «>», эскалация по правилам --escalate-on (по умолчанию — правила
+ступени из product_analysis/routing.py). Ступени:
+
+  halal  — вердикт по составу из benchmarks/eval_halal.jsonl (brand, product_name, ingredients,
+           status); точность — совпадение статуса, critical — харам, признанный чистым;
+  vision — чтение состава с этикеток benchmarks/corpus.py; точность — доля эталонных
+           ингредиентов, найденных в ответе.
+
+Запросы идут через ProductAnalysisAgent с теми же повторами, лимитами и бюджетом, что и
+в сервисе; индекс ингредиентов и кэши не участвуют. Стоимость считается по LLM_PRICES.
+С --fake ответы шаблонные, поэтому точность бессмысленна — режим проверяет сам прогон,
+задержки и долю эскалаций.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from benchmarks.corpus import build_corpus, label_spec  # noqa: E402
+from benchmarks.load import free_port, percentile, wait_ready  # noqa: E402
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--stage", default="halal", choices=["halal", "vision"])
+parser.add_argument("--routes", nargs="+", default=["gpt-4o", "gpt-4o-mini>gpt-4o"])
+parser.add_argument("--escalate-on", help="правила через запятую; пустая строка — без эскалации")
+parser.add_argument("--set", default=os.path.join(BACKEND, "benchmarks", "eval_halal.jsonl"))
+parser.add_argument("--images", type=int, default=20, help="этикеток для ступени vision")
+parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "halal_bench_corpus"))
+parser.add_argument("--concurrency", type=int, default=4)
+parser.add_argument("--fake", action="store_true", help="поднять benchmarks/fake_openai.py вместо OpenAI")
+parser.add_argument("--output", help="записать результаты в JSON")
+
+
+def load_items(args) -> List[Dict[str, Any]]:
+    if args.stage == "halal":
+        with open(args.set) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    paths = build_corpus(args.corpus, args.images)
+    return [{"image": path, "ingredients": label_spec(seed)["ingredients"]} for seed, path in enumerate(paths)]
+
+
+async def run_item(agent, stage: str, item: Dict[str, Any]) -> Dict[str, Any]:
+    from product_analysis.ingredients import normalize
+    from product_analysis.resilience import llm_budget
+
+    metadata: Dict[str, Any] = {}
+    started = time.perf_counter()
+    with llm_budget():
+        if stage == "halal":
+            halal_json = await agent.analyze_halal_status(item["brand"], item["product_name"], item["ingredients"], [], metadata)
+            predicted = (agent.validate_halal(halal_json) or {}).get("status")
+            score = float(predicted == item["status"])
+            critical = item["status"] == "haram" and predicted in ("clean", "certified")
+        else:
+            with open(item["image"], "rb") as f:
+                parsed = await agent.extract_with_vision(f.read(), "image/jpeg", metadata)
+            found = " | ".join(normalize(i) for i in parsed.get("ingredients") or [])
+            score = sum(normalize(i) in found for i in item["ingredients"]) / len(item["ingredients"])
+            critical = False
+    return {
+        "latency_ms": (time.perf_counter() - started) * 1000,
+        "score": score,
+        "critical": critical,
+        "escalated": bool(metadata.get("escalations")),
+        "model": metadata.get("models", {}).get(stage),
+    }
+
+
+async def evaluate(agent, stage: str, route: str, escalate_on: List[str], items: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    from product_analysis.routing import ModelRoute, model_router, route_stats
+
+    model_router.routes[stage] = ModelRoute(stage, route.split(">"), escalate_on)
+    route_stats.reset()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with slots:
+            try:
+                return await run_item(agent, stage, item)
+            except Exception as e:
+                return {"error": f"{type(e).__name__}: {e}"}
+
+    outcomes = await asyncio.gather(*[one(item) for item in items])
+    done = [outcome for outcome in outcomes if "error" not in outcome]
+    models = route_stats.stats()["stages"].get(stage, {})
+    prompt = sum(entry["avg_prompt_tokens"] * entry["requests"] for entry in models.values())
+    completion = sum(entry["avg_completion_tokens"] * entry["requests"] for entry in models.values())
+    costs = [entry["cost_usd"] for entry in models.values()]
+    return {
+        "route": route,
+        "items": len(items),
+        "errors": len(outcomes) - len(done),
+        "accuracy": round(sum(o["score"] for o in done) / len(done), 3) if done else None,
+        "critical": sum(o["critical"] for o in done),
+        "escalation_rate": round(sum(o["escalated"] for o in done) / len(done), 3) if done else None,
+        "p50_ms": percentile([o["latency_ms"] for o in done], 0.5),
+        "p95_ms": percentile([o["latency_ms"] for o in done], 0.95),
+        "avg_tokens": round((prompt + completion) / len(done)) if done else None,
+        "cost_per_1k_usd": round(sum(costs) / len(done) * 1000, 3) if done and None not in costs else None,
+        "final_models": {model: sum(o["model"] == model for o in done) for model in route.split(">")},
+        "models": models,
+    }
+
+
+def print_table(stage: str, results: List[Dict[str, Any]]) -> None:
+    columns = ("route", "items", "errors", "accuracy", "critical", "escalation_rate", "p50_ms", "p95_ms", "avg_tokens", "cost_per_1k_usd")
+    print(f"\nstage: {stage}")
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print("  ".join(f"{'-' if result[column] is None else result[column]!s:>16}" for column in columns))
+    for result in results:
+        print(f"{result['route']}: final model {result['final_models']}")
+
+
+async def main(args) -> int:
+    from product_analysis.routing import DEFAULT_ROUTES
+
+    escalate_on = DEFAULT_ROUTES[args.stage]["escalate_on"] if args.escalate_on is None \
+        else [rule.strip() for rule in args.escalate_on.split(",") if rule.strip()]
+    items = load_items(args)
+    fake = None
+    if args.fake:
+        port = free_port()
+        fake = subprocess.Popen([sys.executable, "-m", "uvicorn", "benchmarks.fake_openai:app", "--port", str(port), "--log-level", "warning"],
+                                cwd=BACKEND, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        await wait_ready(f"http://127.0.0.1:{port}/faults", fake)
+        # Агент читает адрес при импорте модуля
+        os.environ.update({"OPENAI_BASE_URL": f"http://127.0.0.1:{port}/v1", "OPENAI_API_KEY": "fake"})
+    try:
+        from product_analysis.agent import ProductAnalysisAgent
+        agent = ProductAnalysisAgent()
+        results = []
+        for route in args.routes:
+            print(f"evaluating {args.stage} with {route} on {len(items)} items...", flush=True)
+            results.append(await evaluate(agent, args.stage, route, escalate_on, items, args.concurrency))
+        await agent.aclose()
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.wait()
+
+    print_table(args.stage, results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"stage": args.stage, "escalate_on": escalate_on, "fake": args.fake, "results": results},
+                      f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parser.parse_args())))
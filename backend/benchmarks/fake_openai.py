@@ -0,0 +1,151 @@
+"""Локальный OpenAI-совместимый сервер с подменными ответами и инъекцией сбоев.
+
+    uvicorn benchmarks.fake_openai:app --port 8900
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake uvicorn main:app
+
+Сбои задаются переменными окружения при старте или на лету:
+
+    curl -X POST localhost:8900/faults -H 'content-type: application/json' \\
+         -d '{"error_rate": 0.3, "rate_limit_rate": 0.1, "hang_rate": 0.05, "latency_ms": 800}'
+
+error_rate — доля ответов 500, rate_limit_rate — доля 429 с Retry-After,
+hang_rate — доля запросов, которые висят hang_seconds (таймаут клиента).
+
+Задержка ответа: distribution = fixed (latency_ms), normal (latency_ms ± jitter_ms)
+или lognormal (медиана latency_ms, разброс sigma) — у настоящего API хвост длинный;
+плюс tail_rate — доля ответов, задержанных ещё на tail_ms. GET /faults показывает
+текущие настройки и счётчики, POST /faults/reset обнуляет счётчики.
+
+Слабая модель (weak_model, по умолчанию gpt-4o-mini) отвечает в weak_latency_factor раз
+быстрее, но доля weak_rate её вердиктов — «doubtful» с низкой уверенностью: так видна
+эскалация маршрутизатора моделей (product_analysis/routing.py).
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+VISION = {"brand": "Fake", "product_name": "Мармелад", "manufacturer": None, "country": "Казахстан",
+          "ingredients": ["Сахар", "Пектин", "Лимонная кислота"]}
+HALAL = {"status": "clean", "confidence": "средняя", "concerns": [], "recommendation": "Состав чистый.",
+         "ingredients": [{"name": name, "status": "clean", "reason": ""} for name in VISION["ingredients"]]}
+USAGE = {"prompt_tokens": 1000, "completion_tokens": 150, "total_tokens": 1150}
+UNSURE = {**HALAL, "status": "doubtful", "confidence": "низкая", "concerns": ["Не уверен в происхождении пектина"]}
+SINGLE_PASS = {**VISION, **{key: value for key, value in HALAL.items() if key != "ingredients"},
+               "ingredient_verdicts": HALAL["ingredients"]}
+
+faults = {
+    "error_rate": float(os.getenv("FAKE_LLM_ERROR_RATE", 0)),
+    "rate_limit_rate": float(os.getenv("FAKE_LLM_RATE_LIMIT_RATE", 0)),
+    "retry_after": float(os.getenv("FAKE_LLM_RETRY_AFTER", 1)),
+    "hang_rate": float(os.getenv("FAKE_LLM_HANG_RATE", 0)),
+    "hang_seconds": float(os.getenv("FAKE_LLM_HANG_SECONDS", 60)),
+    "distribution": os.getenv("FAKE_LLM_DISTRIBUTION", "normal"),
+    "latency_ms": float(os.getenv("FAKE_LLM_LATENCY_MS", 300)),
+    "jitter_ms": float(os.getenv("FAKE_LLM_JITTER_MS", 100)),
+    "sigma": float(os.getenv("FAKE_LLM_SIGMA", 0.5)),
+    "tail_rate": float(os.getenv("FAKE_LLM_TAIL_RATE", 0)),
+    "tail_ms": float(os.getenv("FAKE_LLM_TAIL_MS", 5000)),
+    "weak_model": os.getenv("FAKE_LLM_WEAK_MODEL", "gpt-4o-mini"),
+    "weak_rate": float(os.getenv("FAKE_LLM_WEAK_RATE", 0.2)),
+    "weak_latency_factor": float(os.getenv("FAKE_LLM_WEAK_LATENCY_FACTOR", 0.4)),
+}
+counters = {"requests": 0, "errors": 0, "rate_limited": 0, "hangs": 0, "weak": 0, "unsure": 0}
+
+app = FastAPI(title="Fake OpenAI")
+
+
+def answer(body: dict) -> str:
+    unsure = body.get("model") == faults["weak_model"] and random.random() < faults["weak_rate"]
+    counters["unsure"] += int(unsure)
+    if "response_format" in body:
+        return json.dumps({**SINGLE_PASS, **({"status": "doubtful", "confidence": "низкая"} if unsure else {})}, ensure_ascii=False)
+    content = body["messages"][0]["content"]
+    # Список частей с картинкой — запрос vision, строка — вердикт по составу
+    return json.dumps(VISION if isinstance(content, list) else UNSURE if unsure else HALAL, ensure_ascii=False)
+
+
+def latency(model: str = None) -> float:
+    if faults["distribution"] == "fixed":
+        delay = faults["latency_ms"]
+    elif faults["distribution"] == "lognormal":
+        delay = faults["latency_ms"] * random.lognormvariate(0, faults["sigma"])
+    else:
+        delay = random.gauss(faults["latency_ms"], faults["jitter_ms"])
+    if random.random() < faults["tail_rate"]:
+        delay += faults["tail_ms"]
+    if model == faults["weak_model"]:
+        delay *= faults["weak_latency_factor"]
+    return max(0.0, delay) / 1000
+
+
+def chunk(delta: dict, usage_block: dict = None) -> str:
+    payload = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+               "choices": [] if usage_block else [{"index": 0, "delta": delta, "finish_reason": None}]}
+    if usage_block:
+        payload["usage"] = usage_block
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.get("/faults")
+def get_faults():
+    return {"faults": faults, "counters": counters}
+
+
+@app.post("/faults")
+async def set_faults(request: Request):
+    faults.update({key: type(faults[key])(value) for key, value in (await request.json()).items() if key in faults})
+    return {"faults": faults}
+
+
+@app.post("/faults/reset")
+def reset_counters():
+    counters.update({key: 0 for key in counters})
+    return {"counters": counters}
+
+
+@app.get("/v1/models")
+def list_models():
+    # Прогрев агента при старте: не считается в counters["requests"]
+    return {"object": "list", "data": [{"id": model, "object": "model", "created": 0, "owned_by": "fake"}
+                                       for model in ("gpt-4o", "gpt-4o-mini")]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    counters["requests"] += 1
+    roll = random.random()
+    if roll < faults["hang_rate"]:
+        counters["hangs"] += 1
+        await asyncio.sleep(faults["hang_seconds"])
+    roll -= faults["hang_rate"]
+    if 0 <= roll < faults["rate_limit_rate"]:
+        counters["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                            status_code=429, headers={"retry-after": str(faults["retry_after"])})
+    roll -= faults["rate_limit_rate"]
+    if 0 <= roll < faults["error_rate"]:
+        counters["errors"] += 1
+        return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}}, status_code=500)
+
+    counters["weak"] += int(body.get("model") == faults["weak_model"])
+    await asyncio.sleep(latency(body.get("model")))
+    text = answer(body)
+    if body.get("stream"):
+        async def events():
+            for start in range(0, len(text), 16):
+                yield chunk({"content": text[start:start + 16]})
+                await asyncio.sleep(0.005)
+            yield chunk({}, USAGE)
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+    return {
+        "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": USAGE,
+    }
@@ -0,0 +1,125 @@
+"""Задержка GET /history при росте истории одного пользователя.
+
+    python benchmarks/history_bench.py --database-url sqlite:////tmp/history_bench.db --sizes 1000,10000,100000,1000000
+
+Наполняет отдельную БД (не запускайте на рабочей) и для каждого размера истории
+меряет первую страницу, страницу из середины истории по курсору, фильтр по статусу
+и старый вариант — выборку всей истории целиком (только до --legacy-max строк).
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--database-url", default="sqlite:////tmp/history_bench.db")
+parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+parser.add_argument("--repeats", type=int, default=30)
+parser.add_argument("--limit", type=int, default=50)
+parser.add_argument("--legacy-max", type=int, default=100000)
+args = parser.parse_args()
+
+os.environ["DATABASE_URL"] = args.database_url
+os.environ.setdefault("SECRET_KEY", "bench")
+
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from auth import models as auth_models  # noqa: E402
+from auth.base import Base  # noqa: E402
+from auth.database import AsyncSessionLocal, SessionLocal, async_engine, engine  # noqa: E402
+from product_analysis.history import fetch_history, parse_fields  # noqa: E402
+from product_analysis.models import ProductCheckHistory  # noqa: E402
+
+USER_ID = 1
+STATUSES = ["clean", "doubtful", "haram", "certified"]
+BRANDS = ["Рахат", "Lactel", "Nestle", "Баян Сулу", "Danone", "Food Master"]
+INGREDIENTS = ["Сахар", "Молоко цельное", "Желатин", "Эмульгатор E471", "Ароматизатор", "Кармин E120", "Крахмал"]
+
+
+def seed(target: int) -> None:
+    Base.metadata.create_all(engine)
+    with SessionLocal() as db:
+        if db.get(auth_models.User, USER_ID) is None:
+            db.add(auth_models.User(id=USER_ID, email="bench@example.com", username="bench",
+                                    password_hash="x", is_active=True, is_verified=True))
+            db.commit()
+        count = db.scalar(select(func.count()).select_from(ProductCheckHistory).where(ProductCheckHistory.user_id == USER_ID))
+        started = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        while count < target:
+            chunk = min(10000, target - count)
+            db.execute(insert(ProductCheckHistory), [{
+                "user_id": USER_ID,
+                "product_name": f"Товар {count + i}",
+                "brand": random.choice(BRANDS),
+                "status": random.choice(STATUSES),
+                "date": started + timedelta(minutes=count + i),
+                "ingredients": random.sample(INGREDIENTS, 5),
+                "confidence": "средняя",
+                "barcode": f"{4600000000000 + count + i}",
+            } for i in range(chunk)])
+            db.commit()
+            count += chunk
+
+
+async def measure(repeats: int, call) -> tuple:
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        await call()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(0.95 * (len(timings) - 1))]
+
+
+async def bench(size: int) -> dict:
+    async with AsyncSessionLocal() as db:
+        fields = parse_fields(None)
+        # Курсор примерно из середины истории: keyset не должен замедляться с глубиной
+        middle = await db.scalar(select(ProductCheckHistory.date).where(ProductCheckHistory.user_id == USER_ID)
+                                 .order_by(ProductCheckHistory.date.desc()).offset(size // 2).limit(1))
+        from product_analysis.history import encode_cursor
+        middle_cursor = encode_cursor(middle, 2 ** 31)
+
+        async def first_page():
+            await fetch_history(db, USER_ID, limit=args.limit, fields=fields)
+
+        async def deep_page():
+            await fetch_history(db, USER_ID, limit=args.limit, cursor=middle_cursor, fields=fields)
+
+        async def filtered_sparse():
+            await fetch_history(db, USER_ID, limit=args.limit, status="haram", fields=parse_fields("brand,status"))
+
+        async def legacy_all():
+            result = await db.scalars(select(ProductCheckHistory).where(ProductCheckHistory.user_id == USER_ID)
+                                      .order_by(ProductCheckHistory.date.desc()))
+            result.all()
+            db.expunge_all()
+
+        row = {"size": size}
+        for name, call in (("first", first_page), ("deep", deep_page), ("status+fields", filtered_sparse)):
+            row[name] = await measure(args.repeats, call)
+        row["legacy_all"] = await measure(3, legacy_all) if size <= args.legacy_max else None
+        return row
+
+
+def fmt(value) -> str:
+    return "—" if value is None else f"{value[0]:8.2f} / {value[1]:8.2f}"
+
+
+async def main() -> None:
+    print(f"{'rows':>9} | {'first p50/p95 ms':>19} | {'deep p50/p95 ms':>19} | {'status+fields':>19} | {'legacy .all()':>19}")
+    for size in sorted(int(s) for s in args.sizes.split(",")):
+        seed(size)
+        row = await bench(size)
+        print(f"{size:>9} | {fmt(row['first']):>19} | {fmt(row['deep']):>19} | {fmt(row['status+fields']):>19} | {fmt(row['legacy_all']):>19}")
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,396 @@
+"""Нагрузочные сценарии против живого сервера с фейковым OpenAI.
+
+    python benchmarks/load.py                                  # все сценарии, сравнение с benchmarks/baseline.json
+    python benchmarks/load.py --scenarios analyze,login --duration 30 --concurrency 32
+    python benchmarks/load.py --save-baseline                  # записать текущие цифры как базовые
+
+Поднимает benchmarks/fake_openai.py и uvicorn main:app на свободных портах с отдельной
+SQLite-базой, наполняет её пользователями и историей, затем гоняет каждый сценарий
+закрытым циклом: --concurrency клиентов шлют запросы без пауз. Для каждого сценария
+печатает пропускную способность и p50/p95/p99 по успешным ответам, долю ошибок
+(429 от переполненных очередей OCR и bcrypt тоже считается), число обращений к LLM
+и пиковый RSS процесса сервера, а также прирост RSS над простоем в пересчёте на одного
+клиента (rss_per_client_mb) — сколько памяти стоит один запрос в работе. analyze_large
+шлёт снимки 12 Мп по 5–10 МБ: на нём видно, держит ли сервер загрузки в памяти.
+
+Очереди OCR и bcrypt сервера подгоняются под --concurrency: клиенты закрытого цикла ждут
+своей очереди, а не получают 429, и задержки считаются по всем запросам, а не по горстке
+уцелевших. Сброс нагрузки при переполнении здесь не меряется.
+
+Регрессия — ухудшение больше --tolerance относительно базовых цифр (задержки, RPS, RSS)
+или рост доли ошибок; тогда код выхода 1. Базовые цифры имеют смысл только для той же
+машины и тех же параметров запуска, поэтому параметры (RUN_PARAMS и число ядер) хранятся
+в базовой линии у каждого сценария. Сценарий, базовые цифры которого сняты с другими
+параметрами, не сравнивается — печатается SKIPPED с отличиями; после смены железа или
+параметров перезапишите базовую линию --save-baseline.
+Прогон, где хоть один сценарий ошибается чаще MAX_BASELINE_ERROR_RATE, базовой линией не станет.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from benchmarks.corpus import build_corpus, build_photos  # noqa: E402
+
+SCENARIOS = ("analyze", "analyze_hot", "analyze_large", "batch", "history_write", "history_read", "login")
+# Метрики, по которым ищем регрессии: имя -> True, если больше — хуже
+COMPARED = {"p50_ms": True, "p95_ms": True, "p99_ms": True, "throughput_rps": False, "peak_rss_mb": True}
+# При большей доле ошибок сравнивать не с чем: рост ошибок не поймать, а задержки — по немногим уцелевшим
+MAX_BASELINE_ERROR_RATE = 0.01
+# Параметры запуска, от которых зависят цифры: с другими значениями базовая линия несравнима
+RUN_PARAMS = ("duration", "warmup", "concurrency", "corpus_size", "photos", "batch_size", "users", "history_rows",
+              "llm_latency_ms", "llm_distribution", "ocr")
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+parser.add_argument("--duration", type=float, default=15, help="секунд замера на сценарий")
+parser.add_argument("--warmup", type=float, default=2, help="секунд прогрева перед замером (не учитываются)")
+parser.add_argument("--concurrency", type=int, default=16)
+parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "halal_bench_corpus"))
+parser.add_argument("--corpus-size", type=int, default=200)
+parser.add_argument("--photos", type=int, default=8, help="снимков 12 Мп для analyze_large")
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--users", type=int, default=50)
+parser.add_argument("--history-rows", type=int, default=5000)
+parser.add_argument("--llm-latency-ms", type=float, default=600)
+parser.add_argument("--llm-distribution", default="lognormal", choices=["fixed", "normal", "lognormal"])
+parser.add_argument("--ocr", action="store_true", help="включить локальный OCR (нужен tesseract)")
+parser.add_argument("--baseline", default=os.path.join(BACKEND, "benchmarks", "baseline.json"))
+parser.add_argument("--save-baseline", action="store_true")
+parser.add_argument("--tolerance", type=float, default=0.2)
+parser.add_argument("--output", help="записать результаты в JSON")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url}: process exited with code {process.returncode}")
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} is not ready after {timeout}s")
+
+
+class Harness:
+    def __init__(self, args, workdir: str):
+        self.args = args
+        self.workdir = workdir
+        self.llm_port = free_port()
+        self.app_port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.app_port}"
+        self.llm_url = f"http://127.0.0.1:{self.llm_port}"
+        self.processes: List[subprocess.Popen] = []
+        self.images = [open(path, "rb").read() for path in build_corpus(args.corpus, args.corpus_size)]
+        self.users: List[Dict[str, str]] = []
+        self.photos: List[bytes] = []
+
+    def spawn(self, module: str, port: int, env: Dict[str, str], log: str) -> subprocess.Popen:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=BACKEND, env={**os.environ, **env}, stdout=open(os.path.join(self.workdir, log), "w"), stderr=subprocess.STDOUT,
+        )
+        self.processes.append(process)
+        return process
+
+    async def start(self) -> None:
+        database_url = f"sqlite:///{os.path.join(self.workdir, 'bench.db')}"
+        subprocess.run([sys.executable, "-c", "import auth.models, product_analysis.models; from auth.base import Base; "
+                        "from auth.database import engine; Base.metadata.create_all(engine)"],
+                       cwd=BACKEND, env={**os.environ, "DATABASE_URL": database_url}, check=True)
+        llm = self.spawn("benchmarks.fake_openai:app", self.llm_port, {
+            "FAKE_LLM_LATENCY_MS": str(self.args.llm_latency_ms),
+            "FAKE_LLM_DISTRIBUTION": self.args.llm_distribution,
+        }, "fake_openai.log")
+        await wait_ready(f"{self.llm_url}/faults", llm)
+        self.app = self.spawn("main:app", self.app_port, {
+            "DATABASE_URL": database_url,
+            "OPENAI_API_KEY": "fake",
+            "OPENAI_BASE_URL": f"{self.llm_url}/v1",
+            "SECRET_KEY": "bench",
+            "OCR_FAST_PATH_ENABLED": "1" if self.args.ocr else "0",
+            # Все клиенты приходят с 127.0.0.1: лимит попыток по IP превратил бы login в сценарий 429
+            "AUTH_IP_MAX_ATTEMPTS": "1000000000",
+            # Каждый клиент держит не больше одного запроса: с такими очередями никого не отбрасывают
+            "OCR_QUEUE_SIZE": str(self.args.concurrency),
+            "PASSWORD_HASH_QUEUE_SIZE": str(self.args.concurrency),
+        }, "app.log")
+        await wait_ready(f"{self.base_url}/openapi.json", self.app)
+
+    def stop(self) -> None:
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def seed(self, client: httpx.AsyncClient) -> None:
+        # Первый пользователь получает id=1 — под ним пишет и читает история (user_id пока зашит в роутере)
+        for number in range(self.args.users):
+            user = {"email": f"bench{number}@example.com", "password": f"Bench-password-{number}"}
+            response = await client.post("/auth/register", json={**user, "username": f"bench{number}"})
+            if response.status_code not in (200, 201, 400):
+                raise RuntimeError(f"register failed: {response.status_code} {response.text}")
+            self.users.append(user)
+        subprocess.run([sys.executable, "-c", "from sqlalchemy import text\nfrom auth.database import engine\n"
+                        "with engine.begin() as conn:\n    conn.execute(text('UPDATE users SET is_verified = true'))"],
+                       cwd=BACKEND, env={**os.environ, "DATABASE_URL": f"sqlite:///{os.path.join(self.workdir, 'bench.db')}"},
+                       check=True)
+        for start in range(0, self.args.history_rows, 500):
+            items = [history_item(start + i) for i in range(min(500, self.args.history_rows - start))]
+            response = await client.post("/api/v1/products/history/batch", json={"items": items})
+            response.raise_for_status()
+
+    async def llm_calls(self) -> int:
+        async with httpx.AsyncClient() as client:
+            return (await client.get(f"{self.llm_url}/faults")).json()["counters"]["requests"]
+
+    async def run(self, client: httpx.AsyncClient, name: str, request: Callable) -> Dict[str, Any]:
+        latencies: List[float] = []
+        statuses: Dict[int, int] = {}
+        counter = iter(range(10 ** 9))
+        warm_until = time.monotonic() + self.args.warmup
+        stop_at = warm_until + self.args.duration
+        idle_rss = peak_rss = rss_mb(self.app.pid) or 0.0
+        llm_before = await self.llm_calls()
+        worker_state = [dict() for _ in range(self.args.concurrency)]
+
+        async def worker(number: int) -> None:
+            while time.monotonic() < stop_at:
+                started = time.monotonic()
+                try:
+                    status = (await request(client, next(counter), worker_state[number])).status_code
+                except httpx.HTTPError:
+                    status = 0
+                if started >= warm_until:
+                    # Задержки и пропускная способность — только по успешным ответам: быстрый 429 не должен улучшать цифры
+                    if 200 <= status < 300:
+                        latencies.append((time.monotonic() - started) * 1000)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+        async def sample_rss() -> None:
+            nonlocal peak_rss
+            while time.monotonic() < stop_at:
+                peak_rss = max(peak_rss, rss_mb(self.app.pid) or 0.0)
+                await asyncio.sleep(0.1)
+
+        await asyncio.gather(sample_rss(), *(worker(number) for number in range(self.args.concurrency)))
+        total = sum(statuses.values())
+        errors = sum(count for status, count in statuses.items() if status == 0 or status >= 400)
+        return {
+            "requests": total,
+            "throughput_rps": round(len(latencies) / self.args.duration, 2),
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "error_rate": round(errors / total, 4) if total else None,
+            "statuses": {str(status): count for status, count in sorted(statuses.items())},
+            "llm_calls": await self.llm_calls() - llm_before,
+            "peak_rss_mb": round(peak_rss, 1),
+            "rss_per_client_mb": round((peak_rss - idle_rss) / self.args.concurrency, 2),
+        }
+
+    # Сценарии: request(client, номер запроса, состояние клиента) -> httpx.Response
+
+    async def analyze(self, client, index, state):
+        return await client.post("/api/v1/products/analyze", files={"image": ("label.jpg", self.images[index % len(self.images)], "image/jpeg")})
+
+    async def analyze_hot(self, client, index, state):
+        # «Вирусный» товар: одни и те же несколько фото — кэш и (позже) склейка одинаковых запросов
+        return await client.post("/api/v1/products/analyze", files={"image": ("label.jpg", self.images[index % 5], "image/jpeg")})
+
+    async def analyze_large(self, client, index, state):
+        return await client.post("/api/v1/products/analyze", files={"image": ("photo.jpg", self.photos[index % len(self.photos)], "image/jpeg")})
+
+    async def batch(self, client, index, state):
+        size = self.args.batch_size
+        files = [("images", (f"label{n}.jpg", self.images[(index * size + n) % len(self.images)], "image/jpeg")) for n in range(size)]
+        return await client.post("/api/v1/products/analyze/batch", files=files)
+
+    async def history_write(self, client, index, state):
+        return await client.post("/api/v1/products/history", json=history_item(index))
+
+    async def history_read(self, client, index, state):
+        # Каждый клиент листает историю вглубь по курсору и начинает заново на последней странице
+        params = {"limit": 50}
+        if state.get("cursor"):
+            params["cursor"] = state["cursor"]
+        response = await client.get("/api/v1/products/history", params=params)
+        state["cursor"] = response.headers.get("X-Next-Cursor")
+        return response
+
+    async def login(self, client, index, state):
+        return await client.post("/auth/login", json=self.users[index % len(self.users)])
+
+
+def history_item(index: int) -> Dict[str, Any]:
+    return {
+        "product_name": f"Товар {index}",
+        "brand": ["Рахат", "Fake Foods", "Eco Farm"][index % 3],
+        "status": ["clean", "doubtful", "haram", "certified"][index % 4],
+        "ingredients": ["сахар", "пектин", "лимонная кислота"],
+        "confidence": "средняя",
+        "idempotency_key": f"bench-{index}-{time.monotonic_ns()}",
+    }
+
+
+def run_params(args) -> Dict[str, Any]:
+    return {**{key: getattr(args, key) for key in RUN_PARAMS}, "cpus": os.cpu_count()}
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, Any]]:
+    """Сценарии базовой линии; у записанных до хранения параметров по сценариям они берутся из meta."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        document = json.load(f)
+    meta = document.get("meta", {})
+    params = {**{key: meta.get("args", {}).get(key) for key in RUN_PARAMS}, "cpus": meta.get("cpus")}
+    return {name: {"params": params, **scenario} for name, scenario in document.get("scenarios", {}).items()}
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float,
+            params: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    """Регрессии и сценарии, пропущенные из-за других параметров запуска базовой линии."""
+    regressions, skipped = [], []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        recorded = base.get("params", {})
+        differs = [f"{key}={recorded.get(key)} -> {value}" for key, value in params.items() if recorded.get(key) != value]
+        if differs:
+            skipped.append(f"{name}: baseline recorded with other parameters ({', '.join(differs)})")
+            continue
+        for metric, higher_is_worse in COMPARED.items():
+            old, new = base.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change > tolerance) if higher_is_worse else (change < -tolerance):
+                regressions.append(f"{name}.{metric}: {old} -> {new} ({change:+.0%})")
+        if (current.get("error_rate") or 0) > (base.get("error_rate") or 0) + 0.01:
+            regressions.append(f"{name}.error_rate: {base.get('error_rate')} -> {current['error_rate']}")
+    return regressions, skipped
+
+
+def print_table(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> None:
+    print(f"{'scenario':<14}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'llm':>7}{'rss MB':>9}")
+    for name, r in results.items():
+        print(f"{name:<14}{r['throughput_rps']:>9}{r['p50_ms'] or '-':>10}{r['p95_ms'] or '-':>10}{r['p99_ms'] or '-':>10}"
+              f"{r['error_rate'] if r['error_rate'] is not None else '-':>8}{r['llm_calls']:>7}{r['peak_rss_mb']:>9}")
+        if r["error_rate"]:
+            # 429 — это сброс нагрузки (очередь OCR или bcrypt заполнена), а не падение
+            print(f"{'  statuses':<14}{json.dumps(r['statuses'])}")
+        base = baseline.get(name)
+        if base:
+            print(f"{'  baseline':<14}{base.get('throughput_rps', '-'):>9}{base.get('p50_ms') or '-':>10}"
+                  f"{base.get('p95_ms') or '-':>10}{base.get('p99_ms') or '-':>10}{base.get('error_rate', '-'):>8}"
+                  f"{base.get('llm_calls', '-'):>7}{base.get('peak_rss_mb', '-'):>9}")
+
+
+async def main(args) -> int:
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}")
+    baseline = load_baseline(args.baseline)
+    params = run_params(args)
+
+    with tempfile.TemporaryDirectory(prefix="halal_bench_") as workdir:
+        harness = Harness(args, workdir)
+        try:
+            await harness.start()
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=harness.base_url, timeout=120, limits=limits) as client:
+                await harness.seed(client)
+                results = {}
+                for name in names:
+                    if name == "analyze_large":
+                        # Снимки нужны только этому сценарию: рисуются один раз, в клиенте ~60 МБ
+                        harness.photos = [open(path, "rb").read() for path in build_photos(args.corpus, args.photos)]
+                    print(f"running {name} ({args.warmup:g}s warmup + {args.duration:g}s, concurrency {args.concurrency})...", flush=True)
+                    results[name] = await harness.run(client, name, getattr(harness, name))
+        finally:
+            harness.stop()
+
+    print_table(results, baseline)
+    document = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline", "output", "corpus")},
+        },
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        failing = {name: r["error_rate"] for name, r in results.items() if (r["error_rate"] or 0) > MAX_BASELINE_ERROR_RATE}
+        if failing:
+            print(f"baseline not saved: error rate above {MAX_BASELINE_ERROR_RATE:.0%} in {json.dumps(failing)}")
+            return 1
+        # Сценарии, которые в этот раз не запускались, остаются в базовой линии как были, со своими параметрами
+        scenarios = {**baseline, **{name: {**result, "params": params} for name, result in results.items()}}
+        with open(args.baseline, "w") as f:
+            json.dump({**document, "scenarios": scenarios}, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    regressions, skipped = compare(results, baseline, args.tolerance, params)
+    for line in skipped:
+        print(f"SKIPPED {line}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions and len(skipped) < len(set(results) & set(baseline)):
+        print(f"no regressions beyond {args.tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,128 @@
+"""Время холодного старта: импорт приложения, запуск до /health/ready и первый анализ после старта.
+
+    python benchmarks/startup.py                              # uvicorn с прогревом и без, gunicorn на 2 воркера
+    python benchmarks/startup.py --runs 5 --workers 4
+    python benchmarks/startup.py --modes gunicorn --output startup.json
+
+Каждый режим запускается --runs раз с нуля против benchmarks/fake_openai.py и отдельной
+SQLite-базы. Для каждого запуска меряются:
+
+  import_ms       — `import main` в чистом интерпретаторе (сколько стоят импорты верхнего уровня);
+  ready_ms        — от запуска процесса до 200 на /health/ready: то, что ждёт автоскейлинг;
+  first_analyze_ms — первый POST /analyze после готовности: без прогрева сюда попадают
+                     запуск процессов OCR, соединение с OpenAI и загрузка индекса ингредиентов.
+
+Режимы: uvicorn (один процесс, прогрев в lifespan), uvicorn_cold (WARMUP_ENABLED=0),
+gunicorn (gunicorn.conf.py, --workers воркеров с preload). Печатаются медианы по запускам.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from benchmarks.corpus import build_corpus  # noqa: E402
+from benchmarks.load import free_port, wait_ready  # noqa: E402
+
+MODES = ("uvicorn", "uvicorn_cold", "gunicorn")
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--modes", default=",".join(MODES))
+parser.add_argument("--runs", type=int, default=3)
+parser.add_argument("--workers", type=int, default=2, help="воркеров gunicorn")
+parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "halal_bench_corpus"))
+parser.add_argument("--output", help="записать результаты в JSON")
+
+
+def command(mode: str, port: int) -> List[str]:
+    if mode == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}", "main:app"]
+    return [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+
+
+def import_ms(env: Dict[str, str]) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=BACKEND, env=env, check=True)
+    total = time.perf_counter() - started
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], cwd=BACKEND, env=env, check=True)
+    # Без запуска самого интерпретатора
+    return round((total - (time.perf_counter() - started)) * 1000, 1)
+
+
+async def measure(mode: str, env: Dict[str, str], image: bytes, workdir: str, workers: int) -> Dict[str, Any]:
+    port = free_port()
+    env = {**env, "WARMUP_ENABLED": "0" if mode == "uvicorn_cold" else "1", "WEB_CONCURRENCY": str(workers)}
+    started = time.perf_counter()
+    process = subprocess.Popen(command(mode, port), cwd=BACKEND, env=env,
+                               stdout=open(os.path.join(workdir, f"{mode}.log"), "a"), stderr=subprocess.STDOUT)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        await wait_ready(f"{base_url}/health/ready", process, timeout=120)
+        ready = time.perf_counter() - started
+        async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+            started = time.perf_counter()
+            response = await client.post("/api/v1/products/analyze", files={"image": ("label.jpg", image, "image/jpeg")})
+            first_analyze = time.perf_counter() - started
+            startup = (await client.get("/health/ready")).json().get("startup")
+        return {"ready_ms": round(ready * 1000, 1), "first_analyze_ms": round(first_analyze * 1000, 1),
+                "first_analyze_status": response.status_code, "startup": startup}
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def main(args) -> int:
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        raise SystemExit(f"Unknown modes: {', '.join(unknown)}")
+    image = open(build_corpus(args.corpus, 1)[0], "rb").read()
+    with tempfile.TemporaryDirectory(prefix="halal_startup_") as workdir:
+        database_url = f"sqlite:///{os.path.join(workdir, 'startup.db')}"
+        env = {**os.environ, "DATABASE_URL": database_url, "SECRET_KEY": "bench", "OPENAI_API_KEY": "fake"}
+        subprocess.run([sys.executable, "-c", "import auth.models, product_analysis.models; from auth.base import Base; "
+                        "from auth.database import engine; Base.metadata.create_all(engine)"],
+                       cwd=BACKEND, env=env, check=True)
+        llm_port = free_port()
+        llm = subprocess.Popen([sys.executable, "-m", "uvicorn", "benchmarks.fake_openai:app", "--port", str(llm_port), "--log-level", "warning"],
+                               cwd=BACKEND, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        try:
+            await wait_ready(f"http://127.0.0.1:{llm_port}/faults", llm)
+            env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{llm_port}/v1"
+            imports = [import_ms(env) for _ in range(args.runs)]
+            print(f"import main: median {round(statistics.median(imports))} ms", flush=True)
+            results = {"import_ms": imports, "modes": {}}
+            for mode in modes:
+                runs = []
+                for _ in range(args.runs):
+                    runs.append(await measure(mode, env, image, workdir, args.workers))
+                results["modes"][mode] = runs
+                print(f"{mode:>14}: ready {round(statistics.median(r['ready_ms'] for r in runs))} ms, first analyze "
+                      f"{round(statistics.median(r['first_analyze_ms'] for r in runs))} ms "
+                      f"(status {', '.join(str(r['first_analyze_status']) for r in runs)})", flush=True)
+        finally:
+            llm.terminate()
+            llm.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,70 @@
+"""Продакшен-запуск: gunicorn -c gunicorn.conf.py main:app
+
+Несколько процессов uvicorn за одним сокетом вместо одного `uvicorn --reload`. Переменные окружения:
+
+  WEB_CONCURRENCY                число воркеров (по умолчанию — число ядер)
+  GUNICORN_PRELOAD               1 — импортировать приложение и тяжёлые библиотеки в мастере до форка:
+                                 воркеры (и перезапущенные после MAX_REQUESTS) стартуют без импорта
+  GUNICORN_MAX_REQUESTS          перезапуск воркера после N запросов, 0 — никогда; ограничивает рост памяти
+  GUNICORN_MAX_REQUESTS_JITTER   случайная добавка к N, чтобы воркеры не перезапускались одновременно
+  GUNICORN_GRACEFUL_TIMEOUT      сколько секунд воркер дорабатывает начатые запросы при перезапуске
+  GUNICORN_TIMEOUT               воркер без признаков жизни дольше этого убивается (прогрев входит сюда)
+
+OCR_WORKERS по умолчанию делится между воркерами, чтобы процессов Tesseract было по числу ядер,
+а не ядер в квадрате. Кэши в памяти (анализы, каталог, пользователи, single-flight) у каждого
+воркера свои. Метрики Prometheus собираются со всех воркеров через PROMETHEUS_MULTIPROC_DIR.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+CONFIG_LOADED = time.perf_counter()
+CPU_COUNT = os.cpu_count() or 1
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", CPU_COUNT))
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 5000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 500))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+os.environ.setdefault("OCR_WORKERS", str(max(1, CPU_COUNT // workers)))
+
+# Каталог должен быть задан до первого импорта prometheus_client и пуст при каждом старте
+if os.getenv("METRICS_ENABLED", "1") == "1":
+    multiproc_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "halal_scan_metrics"))
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+# Модули, которые приложение импортирует лениво, при первом запросе. С preload их страницы
+# загружаются в мастере один раз и делятся воркерами через copy-on-write
+PRELOAD_MODULES = ("openai", "PIL.Image", "pytesseract", "passlib.context", "passlib.handlers.bcrypt")
+
+
+def on_starting(server):
+    if not preload_app:
+        return
+    import importlib
+    started = time.perf_counter()
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            server.log.warning(f"Preload: {module} is not available: {e}")
+    server.log.info(f"Preloaded {', '.join(PRELOAD_MODULES)} in {time.perf_counter() - started:.2f}s")
+
+
+def when_ready(server):
+    server.log.info(f"Master ready in {time.perf_counter() - CONFIG_LOADED:.2f}s: {workers} workers, "
+                    f"preload={preload_app}, max_requests={max_requests}±{max_requests_jitter}, OCR_WORKERS={os.environ['OCR_WORKERS']}")
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
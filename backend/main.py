@@ -1,19 +1,165 @@
-from fastapi import FastAPI
+import time
+
+# Отсчёт времени старта: импорт приложения, затем прогрев в lifespan
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import logging
+import os
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Dict
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
 from auth.routes import router as auth_router
 from fastapi.middleware.cors import CORSMiddleware
-from product_analysis.router import router as product_router
+from product_analysis.router import BATCH_MAX_BYTES, router as product_router
+from product_analysis.agent import ProductAnalysisAgent
+from product_analysis.ocr import ocr_executor
+from product_analysis.jobs import JobWorkers, job_queue
+from auth.database import async_engine
+from auth.utils import password_hasher
+from auth.mail import MailWorkers, mail_queue
+from auth.cache import user_cache
+from product_analysis.cache import analysis_cache
+from product_analysis.catalog import product_catalog
+from product_analysis.ingredients import ingredient_index
+from product_analysis.singleflight import halal_flights, image_flights
+from product_analysis.uploads import UPLOAD_MAX_BYTES, UploadLimitMiddleware, body_limit, upload_memory
+from observability import METRICS_ENABLED, STARTUP_SECONDS, MetricsMiddleware, configure_tracing, instrument_engine, metrics_response, stats_collector
+
+# Прогрев до готовности: соединения с БД и OpenAI, процессы OCR, bcrypt и индекс ингредиентов.
+# Без него всё это достаётся первым запросам к каждому новому воркеру
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+# Сколько соединений пула БД открыть заранее
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", 2))
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+instrument_engine(async_engine.sync_engine)
+stats_collector.caches.update({
+    "analysis": lambda: (analysis_cache.hits + analysis_cache.similar_hits, analysis_cache.misses),
+    "catalog": lambda: (product_catalog.hits, product_catalog.misses),
+    "user": lambda: (user_cache.hits, user_cache.misses),
+})
+stats_collector.pools["async"] = async_engine.pool
+stats_collector.stats.update({"singleflight_image": image_flights.stats, "singleflight_halal": halal_flights.stats,
+                              "upload_memory": upload_memory.stats})
+
+
+async def warm_database(connections: int) -> None:
+    # Держим соединения открытыми одновременно, иначе пул вернёт одно и то же
+    async with AsyncExitStack() as stack:
+        for _ in range(connections):
+            connection = await stack.enter_async_context(async_engine.connect())
+            await connection.execute(text("SELECT 1"))
+
+
+async def warmup(app: FastAPI) -> Dict[str, Any]:
+    """Прогревает пулы и кэши параллельно. Ошибки не фатальны: шаг просто останется холодным."""
+    timings: Dict[str, float] = {}
+    errors: Dict[str, str] = {}
+
+    async def step(name: str, coroutine) -> None:
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except Exception as e:
+            errors[name] = f"{type(e).__name__}: {e}"
+            logging.warning(f"Warmup: {name} failed: {errors[name]}")
+        timings[name] = time.perf_counter() - started
+
+    async def storage() -> None:
+        await step("database", warm_database(WARMUP_DB_CONNECTIONS))
+        # Вердикты из БД — после соединений, чтобы не открывать лишнее
+        await step("ingredient_index", ingredient_index.load())
+
+    await asyncio.gather(
+        storage(),
+        step("llm", app.state.agent.warmup()),
+        step("ocr", ocr_executor.warmup()),
+        step("password_hasher", password_hasher.warmup()),
+    )
+    return {"steps_ms": {name: round(seconds * 1000, 1) for name, seconds in timings.items()}, "errors": errors}
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    lifespan_started = time.perf_counter()
+    configure_tracing()
+    ocr_executor.start()
+    password_hasher.start()
+    app.state.agent = ProductAnalysisAgent()
+    stats_collector.stats["llm_resilience"] = app.state.agent.llm.stats
+    app.state.job_workers = JobWorkers(job_queue, lambda: app.state.agent)
+    app.state.job_workers.start()
+    app.state.mail_workers = MailWorkers(mail_queue)
+    app.state.mail_workers.start()
+    startup = {"pid": os.getpid(), "import_ms": round(IMPORT_SECONDS * 1000, 1)}
+    if WARMUP_ENABLED:
+        startup.update(await warmup(app))
+    startup["lifespan_ms"] = round((time.perf_counter() - lifespan_started) * 1000, 1)
+    app.state.startup = startup
+    if METRICS_ENABLED:
+        STARTUP_SECONDS.labels("import").set(IMPORT_SECONDS)
+        STARTUP_SECONDS.labels("lifespan").set(time.perf_counter() - lifespan_started)
+    # Логгер uvicorn настроен и под uvicorn, и под gunicorn; корневой пишет только предупреждения
+    logging.getLogger("uvicorn.error").info(f"Startup: {startup}")
+    app.state.ready = True
+    yield
+    # Пока закрываются пулы, воркер снова не готов
+    app.state.ready = False
+    await app.state.mail_workers.stop()
+    await app.state.job_workers.stop()
+    await app.state.agent.aclose()
+    await ocr_executor.shutdown()
+    password_hasher.shutdown()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
+# Внутри CORS, чтобы ответ 413 браузер тоже мог прочитать
+app.add_middleware(UploadLimitMiddleware, limits={
+    "/api/v1/products/analyze": body_limit(UPLOAD_MAX_BYTES),
+    "/api/v1/products/analyze/stream": body_limit(UPLOAD_MAX_BYTES),
+    "/api/v1/products/analyze/jobs": body_limit(UPLOAD_MAX_BYTES),
+    "/api/v1/products/analyze/batch": body_limit(BATCH_MAX_BYTES),
+})
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(auth_router) 
-app.include_router(product_router, prefix="/api/v1") 
\ No newline at end of file
+app.include_router(product_router, prefix="/api/v1")
+
+
+if METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        body, content_type = metrics_response()
+        return Response(body, media_type=content_type)
+
+
+@app.get("/health/live", include_in_schema=False)
+def health_live():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+def health_ready():
+    if not getattr(app.state, "ready", False):
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return {"status": "ready", "startup": app.state.startup}
+ 
\ No newline at end of file
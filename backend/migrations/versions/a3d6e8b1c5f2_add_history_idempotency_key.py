@@ -0,0 +1,28 @@
+"""Add idempotency_key to product_check_history
+
+Revision ID: a3d6e8b1c5f2
+Revises: f4a9c3e2d7b8
+Create Date: 2026-10-18 18:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3d6e8b1c5f2'
+down_revision: Union[str, None] = 'f4a9c3e2d7b8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('product_check_history', sa.Column('idempotency_key', sa.String(), nullable=True))
+    op.create_index('ix_product_check_history_user_idempotency', 'product_check_history', ['user_id', 'idempotency_key'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_product_check_history_user_idempotency', table_name='product_check_history')
+    op.drop_column('product_check_history', 'idempotency_key')
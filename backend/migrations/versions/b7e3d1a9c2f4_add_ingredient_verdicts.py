@@ -0,0 +1,39 @@
+"""Add ingredient_verdicts
+
+Revision ID: b7e3d1a9c2f4
+Revises: 4c258ad0e7cc
+Create Date: 2026-10-18 12:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3d1a9c2f4'
+down_revision: Union[str, None] = '4c258ad0e7cc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('ingredient_verdicts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('reason', sa.String(), nullable=True),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_ingredient_verdicts_id'), 'ingredient_verdicts', ['id'], unique=False)
+    op.create_index(op.f('ix_ingredient_verdicts_key'), 'ingredient_verdicts', ['key'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_ingredient_verdicts_key'), table_name='ingredient_verdicts')
+    op.drop_index(op.f('ix_ingredient_verdicts_id'), table_name='ingredient_verdicts')
+    op.drop_table('ingredient_verdicts')
@@ -0,0 +1,26 @@
+"""Drop product_catalog entries copied from user history
+
+Revision ID: c3a7e5f1b9d2
+Revises: b9e2f6a4d1c3
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3a7e5f1b9d2'
+down_revision: Union[str, None] = 'b9e2f6a4d1c3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Вердикты из истории присылал клиент без проверки; при следующем сканировании штрихкод пройдёт анализ заново
+    op.execute("DELETE FROM product_catalog WHERE source = 'history'")
+
+
+def downgrade() -> None:
+    pass
@@ -0,0 +1,47 @@
+"""Add analysis_jobs
+
+Revision ID: d5f8a2c4e6b1
+Revises: b7e3d1a9c2f4
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5f8a2c4e6b1'
+down_revision: Union[str, None] = 'b7e3d1a9c2f4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('analysis_jobs',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('owner', sa.String(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=False),
+    sa.Column('image', sa.LargeBinary(), nullable=True),
+    sa.Column('result', sa.JSON(), nullable=True),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('webhook_url', sa.String(), nullable=True),
+    sa.Column('webhook_status', sa.String(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('available_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('locked_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_analysis_jobs_owner'), 'analysis_jobs', ['owner'], unique=False)
+    op.create_index('ix_analysis_jobs_claim', 'analysis_jobs', ['status', 'priority', 'available_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_analysis_jobs_claim', table_name='analysis_jobs')
+    op.drop_index(op.f('ix_analysis_jobs_owner'), table_name='analysis_jobs')
+    op.drop_table('analysis_jobs')
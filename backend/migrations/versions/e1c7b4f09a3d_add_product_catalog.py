@@ -0,0 +1,46 @@
+"""Add product_catalog
+
+Revision ID: e1c7b4f09a3d
+Revises: d5f8a2c4e6b1
+Create Date: 2026-10-18 16:05:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1c7b4f09a3d'
+down_revision: Union[str, None] = 'd5f8a2c4e6b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('product_catalog',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('barcode', sa.String(), nullable=False),
+    sa.Column('brand', sa.String(), nullable=True),
+    sa.Column('product_name', sa.String(), nullable=True),
+    sa.Column('manufacturer', sa.String(), nullable=True),
+    sa.Column('country', sa.String(), nullable=True),
+    sa.Column('ingredients', sa.JSON(), nullable=True),
+    sa.Column('status', sa.String(), nullable=True),
+    sa.Column('confidence', sa.String(), nullable=True),
+    sa.Column('concerns', sa.JSON(), nullable=True),
+    sa.Column('recommendation', sa.String(), nullable=True),
+    sa.Column('source', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_product_catalog_id'), 'product_catalog', ['id'], unique=False)
+    op.create_index(op.f('ix_product_catalog_barcode'), 'product_catalog', ['barcode'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_product_catalog_barcode'), table_name='product_catalog')
+    op.drop_index(op.f('ix_product_catalog_id'), table_name='product_catalog')
+    op.drop_table('product_catalog')
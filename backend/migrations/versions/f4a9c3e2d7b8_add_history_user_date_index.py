@@ -0,0 +1,30 @@
+"""Add (user_id, date, id) index on product_check_history
+
+Revision ID: f4a9c3e2d7b8
+Revises: e1c7b4f09a3d
+Create Date: 2026-10-18 17:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4a9c3e2d7b8'
+down_revision: Union[str, None] = 'e1c7b4f09a3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Строки без даты выпали бы из keyset-пагинации
+    op.execute("UPDATE product_check_history SET date = now() WHERE date IS NULL")
+    op.alter_column('product_check_history', 'date', existing_type=sa.DateTime(timezone=True), nullable=False)
+    op.create_index('ix_product_check_history_user_date', 'product_check_history', ['user_id', 'date', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_product_check_history_user_date', table_name='product_check_history')
+    op.alter_column('product_check_history', 'date', existing_type=sa.DateTime(timezone=True), nullable=True)
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from opentelemetry import trace
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+
+# По умолчанию метрики включены (/metrics), трассировка выключена. METRICS_ENABLED=0 и TRACING_ENABLED=0
+# оставляют только проверку флага на каждой стадии
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0") == "1"
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "halal-scan-backend")
+# При нескольких воркерах (gunicorn.conf.py) каждый пишет метрики в файлы этого каталога, /metrics сводит их вместе
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Цена за 1M токенов (вход, выход) в долларах; переопределяется JSON вида {"gpt-4o": [2.5, 10]}
+LLM_PRICES: Dict[str, Tuple[float, float]] = {"gpt-4o": (2.5, 10.0), "gpt-4o-mini": (0.15, 0.6)}
+LLM_PRICES.update({model: tuple(price) for model, price in json.loads(os.getenv("LLM_PRICES_JSON", "{}")).items()})
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45)
+
+STAGE_SECONDS = Histogram("analyze_stage_seconds", "Duration of analyze pipeline stages", ["stage"], buckets=STAGE_BUCKETS)
+ANALYZE_IN_PROGRESS = Gauge("analyze_in_progress", "Photo analyses currently running", multiprocess_mode="livesum")
+LLM_REQUEST_SECONDS = Histogram("llm_request_seconds", "Duration of single OpenAI requests", ["model", "outcome"],
+                                buckets=STAGE_BUCKETS)
+LLM_IN_PROGRESS = Gauge("llm_requests_in_progress", "OpenAI requests currently in flight", multiprocess_mode="livesum")
+LLM_TOKENS = Counter("llm_tokens", "OpenAI tokens used", ["model", "kind"])
+LLM_COST = Counter("llm_cost_usd", "Estimated OpenAI cost in USD", ["model"])
+LLM_ESCALATIONS = Counter("llm_escalations", "Stage results sent on to a stronger model", ["stage", "reason"])
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "HTTP request duration", ["method", "route", "status"],
+                                 buckets=STAGE_BUCKETS)
+HTTP_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests currently being served", multiprocess_mode="livesum")
+STARTUP_SECONDS = Gauge("startup_seconds", "Process startup duration by phase", ["phase"], multiprocess_mode="max")
+UPLOAD_BYTES = Histogram("upload_bytes", "Size of uploaded photos",
+                         buckets=(64 * 1024, 256 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2, 8 * 1024 ** 2, 16 * 1024 ** 2))
+UPLOAD_SPOOLED = Counter("uploads_spooled", "Uploads kept in a temporary file instead of memory")
+UPLOAD_REJECTED = Counter("uploads_rejected", "Uploads rejected before analysis", ["reason"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Database statement duration", ["operation"],
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+tracer = trace.get_tracer("halal-scan")
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """Стадия анализа: гистограмма analyze_stage_seconds и span, если включена трассировка.
+
+    Не оборачивайте им yield в async-генераторах — для них есть observe_stage.
+    """
+    started = time.perf_counter()
+    with tracer.start_as_current_span(f"analyze.{name}", attributes=attributes) if TRACING_ENABLED else nullcontext():
+        try:
+            yield
+        finally:
+            observe_stage(name, time.perf_counter() - started)
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    if METRICS_ENABLED:
+        STAGE_SECONDS.labels(name).observe(seconds)
+
+
+@contextmanager
+def llm_request(model: str):
+    """Одна попытка запроса к OpenAI (повторы и hedging считаются отдельно)."""
+    started = time.perf_counter()
+    outcome = "error"
+    LLM_IN_PROGRESS.inc()
+    try:
+        with tracer.start_as_current_span("llm.chat", attributes={"llm.model": model}) if TRACING_ENABLED else nullcontext():
+            yield
+        outcome = "ok"
+    except asyncio.CancelledError:
+        # Проигравший hedged-запрос или отключившийся клиент
+        outcome = "cancelled"
+        raise
+    finally:
+        LLM_IN_PROGRESS.dec()
+        if METRICS_ENABLED:
+            LLM_REQUEST_SECONDS.labels(model, outcome).observe(time.perf_counter() - started)
+
+
+def record_tokens(model: Optional[str], usage) -> None:
+    if usage is None or not METRICS_ENABLED:
+        return
+    model = model or "unknown"
+    prompt, completion = usage.prompt_tokens or 0, usage.completion_tokens or 0
+    LLM_TOKENS.labels(model, "prompt").inc(prompt)
+    LLM_TOKENS.labels(model, "completion").inc(completion)
+    cost = llm_cost(model, prompt, completion)
+    if cost is not None:
+        LLM_COST.labels(model).inc(cost)
+
+
+def llm_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """Стоимость в долларах по LLM_PRICES; None, если цена модели неизвестна."""
+    price = LLM_PRICES.get(model)
+    if not price:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+def percentile(values, q: float) -> Optional[float]:
+    """Значение на доле q (0..1) отсортированной выборки; None для пустой."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class StatsCollector:
+    """Снимает счётчики, которые модули уже ведут сами, в момент scrape — без правок их горячего пути."""
+
+    def __init__(self):
+        self.caches: Dict[str, Callable[[], Tuple[int, int]]] = {}
+        self.pools: Dict[str, Any] = {}
+        self.stats: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def collect(self):
+        requests = CounterMetricFamily("cache_requests", "Cache lookups", labels=["cache", "result"])
+        ratio = GaugeMetricFamily("cache_hit_ratio", "Cache hit ratio since start", labels=["cache"])
+        for name, read in self.caches.items():
+            hits, misses = read()
+            requests.add_metric([name, "hit"], hits)
+            requests.add_metric([name, "miss"], misses)
+            ratio.add_metric([name], hits / (hits + misses) if hits + misses else 0.0)
+        yield requests
+        yield ratio
+
+        pool_metrics = {
+            "size": GaugeMetricFamily("db_pool_size", "Configured pool size", labels=["engine"]),
+            "checkedout": GaugeMetricFamily("db_pool_checked_out", "Connections in use", labels=["engine"]),
+            "checkedin": GaugeMetricFamily("db_pool_checked_in", "Idle connections in the pool", labels=["engine"]),
+            "overflow": GaugeMetricFamily("db_pool_overflow", "Connections above pool size", labels=["engine"]),
+        }
+        for name, pool in self.pools.items():
+            for attribute, family in pool_metrics.items():
+                # У SQLite-пулов части этих методов нет
+                if hasattr(pool, attribute):
+                    family.add_metric([name], getattr(pool, attribute)())
+        yield from pool_metrics.values()
+
+        for prefix, read in self.stats.items():
+            for key, value in read().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield GaugeMetricFamily(f"{prefix}_{key}", f"{prefix} {key}", value=value)
+
+
+stats_collector = StatsCollector()
+if METRICS_ENABLED:
+    REGISTRY.register(stats_collector)
+
+
+def metrics_response() -> Tuple[bytes, str]:
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        # Снимки StatsCollector (кэши, пулы) — только того воркера, который ответил на scrape
+        registry.register(stats_collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def configure_tracing() -> None:
+    """Экспорт spans через OTLP (OTEL_EXPORTER_OTLP_ENDPOINT) или в лог, если OTLP-экспортёр не установлен."""
+    if not TRACING_ENABLED:
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        logging.warning("TRACING_ENABLED=1, but opentelemetry-sdk is not installed: spans are not exported")
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    except ImportError:
+        exporter = ConsoleSpanExporter()
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+def instrument_engine(sync_engine) -> None:
+    """Время и span на каждый SQL-запрос; для AsyncEngine передавайте async_engine.sync_engine."""
+    if not (METRICS_ENABLED or TRACING_ENABLED):
+        return
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        context._observability = (time.perf_counter(), operation, tracer.start_span(
+            f"db.{operation}", attributes={"db.system": conn.dialect.name, "db.statement": statement[:1000]},
+        ) if TRACING_ENABLED else None)
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        finish(context)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        if exception_context.execution_context is not None:
+            finish(exception_context.execution_context, exception_context.original_exception)
+
+    def finish(context, error: Optional[BaseException] = None) -> None:
+        started, operation, span = getattr(context, "_observability", (None, None, None))
+        if started is None:
+            return
+        context._observability = (None, None, None)
+        if METRICS_ENABLED:
+            DB_QUERY_SECONDS.labels(operation).observe(time.perf_counter() - started)
+        if span is not None:
+            if error is not None:
+                span.record_exception(error)
+                span.set_status(trace.Status(trace.StatusCode.ERROR))
+            span.end()
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: длительность и число запросов в работе, span на запрос. Шаблон маршрута
+    (/products/analyze/jobs/{job_id}), а не сырой путь — иначе метки разрастаются."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (METRICS_ENABLED or TRACING_ENABLED):
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_IN_PROGRESS.inc()
+        span_context = tracer.start_as_current_span(f"{scope['method']} {scope['path']}", kind=trace.SpanKind.SERVER) \
+            if TRACING_ENABLED else nullcontext()
+        try:
+            with span_context as span:
+                try:
+                    await self.app(scope, receive, send_with_status)
+                finally:
+                    if span is not None:
+                        span.update_name(f"{scope['method']} {route_template(scope)}")
+                        span.set_attribute("http.status_code", status_code)
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            if METRICS_ENABLED:
+                HTTP_REQUEST_SECONDS.labels(scope["method"], route_template(scope), str(status_code)) \
+                    .observe(time.perf_counter() - started)
+
+
+def route_template(scope) -> str:
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    # Маршрут вложенного роутера знает путь без префикса include_router (/api/v1) — восстанавливаем его из scope
+    try:
+        concrete = route.path_format.format(**scope.get("path_params", {}))
+    except (AttributeError, KeyError, IndexError):
+        return template
+    path = scope["path"]
+    return path[:-len(concrete)] + template if concrete and path.endswith(concrete) else template
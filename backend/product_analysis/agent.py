@@ -1,27 +1,411 @@
-import base64
+import asyncio
+import binascii
+import logging
 import os
 import re
 import json
 import ast
-from typing import Dict, Any, List
-from openai import AsyncOpenAI
+import contextvars
+import time
+from typing import TYPE_CHECKING, Dict, Any, List, AsyncIterator, Awaitable, Callable, Optional, Tuple
 import httpx
-from PIL import Image
-from io import BytesIO
-import pytesseract
+from .ocr import OCR_FAST_PATH_ENABLED, OcrBusyError, accept_ocr, ocr_image, run_ocr
+from .ingredients import ingredient_index, local_decision, normalize, worst_status
+from .experiments import choose_mode, mode_stats, other_mode, should_shadow
+from .schemas import HalalVerdict, SinglePassAnalysis
+from observability import llm_request, observe_stage, record_tokens, stage
+from .resilience import LLMUnavailableError, ResilientLLM, estimate_tokens, llm_budget
+from .singleflight import halal_flights, halal_key
+from .routing import ModelRoute, model_router, route_stats
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# OPENAI_BASE_URL позволяет направить агента на локальный фейковый сервер в тестах
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 20))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "1") == "1"
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+# Общий лимит одновременных запросов к OpenAI на процесс (одиночные и пакетные анализы)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+# Кратно 3, чтобы base64 кусков склеивался без паддинга в середине
+_BASE64_CHUNK = 3 * 256 * 1024
+
+
+_NULLABLE_STRING = {"type": ["string", "null"]}
+SINGLE_PASS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "product_analysis",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["brand", "product_name", "manufacturer", "country", "ingredients", "status",
+                         "confidence", "concerns", "recommendation", "ingredient_verdicts"],
+            "properties": {
+                "brand": _NULLABLE_STRING,
+                "product_name": _NULLABLE_STRING,
+                "manufacturer": _NULLABLE_STRING,
+                "country": _NULLABLE_STRING,
+                "ingredients": {"type": "array", "items": {"type": "string"}},
+                "status": {"type": "string", "enum": ["certified", "clean", "doubtful", "haram"]},
+                "confidence": {"type": "string", "enum": ["высокая", "средняя", "низкая"]},
+                "concerns": {"type": "array", "items": {"type": "string"}},
+                "recommendation": {"type": "string"},
+                "ingredient_verdicts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "additionalProperties": False,
+                        "required": ["name", "status", "reason"],
+                        "properties": {
+                            "name": {"type": "string"},
+                            "status": {"type": "string", "enum": ["clean", "doubtful", "haram"]},
+                            "reason": {"type": "string"},
+                        },
+                    },
+                },
+            },
+        },
+    },
+}
+
+SINGLE_PASS_PROMPT = """
+На изображении — упаковка пищевого продукта.
+
+1. Прочитай только тот текст, который **разборчиво виден** на упаковке.
+2. Найди бренд, короткое название продукта (не более 3–4 слов), производителя (юридическое лицо), страну производства и состав.
+3. Проанализируй состав на халяльность и дай вердикт по каждому ингредиенту в ingredient_verdicts.
+
+❗ Статусы продукта:
+- certified — если на упаковке есть халяль сертификат
+- clean — если состав чистый, но нет сертификата
+- doubtful — если есть сомнительные компоненты
+- haram — если есть харам ингредиенты
+❗ Будь жестким это отвественная работа
+
+Если параметр не виден — верни null, если состав не виден — пустой список ingredients.
+Не додумывай и не фантазируй ингредиенты. Используй **только** то, что видно на изображении.
+"""
+
+
+def image_data_url(image_content: bytes, mime_type: str) -> str:
+    """data:-URL фото: base64 пишется кусками сразу после префикса в заранее выделенный буфер.
+
+    b64encode + decode + f-строка выделяют три копии по 1.33 размера фото, здесь — две
+    (буфер и итоговая строка), и строка на выход собирается один раз.
+    """
+    prefix = f"data:{mime_type};base64,".encode("ascii")
+    buffer = bytearray(len(prefix) + 4 * ((len(image_content) + 2) // 3))
+    buffer[:len(prefix)] = prefix
+    view, offset = memoryview(image_content), len(prefix)
+    for start in range(0, len(image_content), _BASE64_CHUNK):
+        chunk = binascii.b2a_base64(view[start:start + _BASE64_CHUNK], newline=False)
+        buffer[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return buffer.decode("ascii")
+
+
+def create_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(timeout=timeout, limits=limits, http2=LLM_HTTP2)
 
 
 class ProductAnalysisAgent:
-    def __init__(self):
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise RuntimeError("OPENAI_API_KEY not set in environment")
-        timeout = httpx.Timeout(20.0, connect=5.0)
-        self.client = AsyncOpenAI(api_key=api_key, http_client=httpx.AsyncClient(timeout=timeout))
+    """Один экземпляр на процесс: создаётся в lifespan приложения и держит пул соединений к OpenAI."""
+
+    def __init__(self, client: "AsyncOpenAI" = None):
+        if client is None:
+            from openai import AsyncOpenAI
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise RuntimeError("OPENAI_API_KEY not set in environment")
+            # Повторы делает self.llm: у него общий бюджет запроса, breaker и квоты
+            client = AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, http_client=create_http_client(), max_retries=0)
+        self.client = client
+        self.llm = ResilientLLM(attempt_timeout=LLM_TIMEOUT)
+        self._llm_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        self._shadow_tasks = set()
+
+    async def aclose(self) -> None:
+        await self.client.close()
+
+    async def warmup(self) -> None:
+        """Открывает соединение с OpenAI (TCP, TLS, HTTP/2) до первого запроса пользователя."""
+        await self.client.models.list(timeout=LLM_CONNECT_TIMEOUT + 5)
+
+    @staticmethod
+    def track_usage(usage, metadata: Dict[str, Any] = None) -> None:
+        if usage is None or metadata is None:
+            return
+        totals = metadata.setdefault("usage", {"prompt_tokens": 0, "completion_tokens": 0})
+        totals["prompt_tokens"] += usage.prompt_tokens or 0
+        totals["completion_tokens"] += usage.completion_tokens or 0
+
+    async def complete(self, metadata: Dict[str, Any] = None, **kwargs):
+        async def send(timeout: float):
+            async with self._llm_slots:
+                with llm_request(kwargs["model"]):
+                    return await self.client.chat.completions.create(timeout=timeout, **kwargs)
+
+        response = await self.llm.call(send, kwargs)
+        self.track_usage(response.usage, metadata)
+        record_tokens(kwargs["model"], response.usage)
+        return response
+
+    async def complete_stream(self, metadata: Dict[str, Any] = None, **kwargs) -> AsyncIterator[str]:
+        async def send(timeout: float):
+            # Время до начала ответа: сам поток дочитывается уже за пределами попытки
+            with llm_request(kwargs["model"]):
+                return await self.client.chat.completions.create(
+                    stream=True, stream_options={"include_usage": True}, timeout=timeout, **kwargs)
+
+        # Слот держим, пока поток не дочитан до конца; повторяется только открытие потока
+        async with self._llm_slots:
+            stream = await self.llm.call(send, kwargs, hedge=False)
+            async for chunk in self.llm.stream(stream):
+                self.track_usage(getattr(chunk, "usage", None), metadata)
+                record_tokens(kwargs["model"], getattr(chunk, "usage", None))
+                self.llm.record_usage(estimate_tokens(kwargs), getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def image_messages(self, prompt: str, image_content: bytes, mime_type: str) -> List[Dict[str, Any]]:
+        with stage("encode"):
+            url = image_data_url(image_content, mime_type)
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": url},
+                    },
+                ],
+            }
+        ]
+
+    async def analyze_image(self, image_content: bytes, mime_type: str = "image/jpeg", metadata: Dict[str, Any] = None, wait: bool = False) -> Dict[str, Any]:
+        metadata = {**(metadata or {}), "tier": "vision"}
+        ocr = await self.run_local_ocr(image_content, metadata, wait)
+        parsed = self.accept_local(ocr, metadata)
+        if parsed is not None:
+            return await self.build_result(parsed, metadata)
+        mode = choose_mode()
+        try:
+            result = await self.analyze_vision(image_content, mime_type, metadata, mode)
+        except LLMUnavailableError as e:
+            return await self.build_result(self.degraded_parsed(ocr, metadata, e), metadata)
+        if should_shadow():
+            self.start_shadow(image_content, mime_type, other_mode(mode), result)
+        return result
+
+    async def analyze_vision(self, image_content: bytes, mime_type: str, metadata: Dict[str, Any], mode: str) -> Dict[str, Any]:
+        """Анализ через vision-модель в выбранном режиме; single_pass при невалидном ответе откатывается на two_stage."""
+        metadata["mode"] = mode
+        started = time.perf_counter()
+        result = None
+        if mode == "single_pass":
+            result = await self.analyze_single_pass(image_content, mime_type, metadata)
+            if result is None:
+                metadata["single_pass_fallback"] = True
+        if result is None:
+            vision_started = time.perf_counter()
+            parsed = await self.extract_with_vision(image_content, mime_type, metadata)
+            metadata["vision_ms"] = round((time.perf_counter() - vision_started) * 1000, 1)
+            result = await self.build_result(parsed, metadata)
+        mode_stats.record(mode, (time.perf_counter() - started) * 1000, metadata.get("usage"),
+                          fallback=metadata.get("single_pass_fallback", False))
+        return result
 
-    async def analyze_image(self, image_content: bytes) -> Dict[str, Any]:
-        base64_image = base64.b64encode(image_content).decode("utf-8")
+    async def analyze_single_pass(self, image_content: bytes, mime_type: str, metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Извлечение и вердикт одним запросом со structured output. None — если ответ не прошёл валидацию."""
+        started = time.perf_counter()
+        messages = self.image_messages(SINGLE_PASS_PROMPT, image_content, mime_type)
 
+        async def attempt(model: str):
+            with stage("single_pass", model=model):
+                response = await self.complete(
+                    metadata=metadata,
+                    model=model,
+                    messages=messages,
+                    response_format=SINGLE_PASS_FORMAT,
+                    max_tokens=1200,
+                    temperature=0,
+                    seed=42
+                )
+            try:
+                with stage("json_parse"):
+                    analysis = SinglePassAnalysis(**json.loads(response.choices[0].message.content))
+            except Exception as e:
+                logging.warning(f"Single-pass output of {model} failed validation: {e}")
+                return None, None
+            return analysis, analysis.model_dump()
+
+        analysis = await self.routed("single_pass", metadata, attempt)
+        metadata["vision_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if analysis is None:
+            return None
+
+        parsed = {
+            "brand": analysis.brand,
+            "product_name": analysis.product_name,
+            "manufacturer": analysis.manufacturer,
+            "country": analysis.country,
+            "ingredients": analysis.ingredients,
+        }
+        if not analysis.ingredients:
+            return self.missing_ingredients_result(parsed, metadata)
+
+        # Индекс ингредиентов всё равно главнее: известный харам не перекрывается ответом модели
+        known, unknown, local = await self.plan_halal(analysis.ingredients, metadata)
+        if local is not None:
+            halal_result = local
+        else:
+            halal_json = json.dumps({
+                "status": analysis.status,
+                "confidence": analysis.confidence,
+                "concerns": analysis.concerns,
+                "recommendation": analysis.recommendation,
+                "ingredients": [{"name": v.name, "status": v.status, "reason": v.reason} for v in analysis.ingredient_verdicts],
+            }, ensure_ascii=False)
+            halal_result = await self.finish_halal(halal_json, known, unknown)
+        return {**self.product_fields(parsed), "ingredients": analysis.ingredients, **halal_result, "metadata": metadata}
+
+    def start_shadow(self, image_content: bytes, mime_type: str, mode: str, primary: Dict[str, Any]) -> None:
+        # Свой контекст: у фоновой проверки собственный бюджет, а не остаток бюджета основного запроса
+        task = asyncio.create_task(self.run_shadow(image_content, mime_type, mode, primary), context=contextvars.Context())
+        self._shadow_tasks.add(task)
+        task.add_done_callback(self._shadow_tasks.discard)
+
+    async def run_shadow(self, image_content: bytes, mime_type: str, mode: str, primary: Dict[str, Any]) -> None:
+        try:
+            with llm_budget():
+                result = await self.analyze_vision(image_content, mime_type, {"tier": "vision", "shadow": True}, mode)
+            mode_stats.record_agreement(result.get("status") == primary.get("status"))
+        except Exception as e:
+            logging.warning(f"Shadow analysis ({mode}) failed: {e}")
+
+    async def analyze_image_stream(self, image_content: bytes, mime_type: str = "image/jpeg", metadata: Dict[str, Any] = None, wait: bool = False) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """Как analyze_image, но отдаёт события по мере готовности:
+        extraction — сразу после чтения упаковки, halal_delta — токены вердикта, result — итог.
+        halal_escalation — вердикт передан более сильной модели, следующие halal_delta начинают текст заново.
+        """
+        metadata = {**(metadata or {}), "tier": "vision"}
+        parsed = await self.extract(image_content, mime_type, metadata, wait)
+        ingredients = parsed.get("ingredients") or []
+        yield "extraction", {**self.product_fields(parsed), "ingredients": ingredients, "metadata": metadata}
+        if not ingredients:
+            yield "result", self.missing_ingredients_result(parsed, metadata)
+            return
+
+        started = time.perf_counter()
+        known, unknown, local = await self.plan_halal(ingredients, metadata)
+        if local is not None:
+            halal_result = local
+        else:
+            prompt = self.halal_prompt(parsed.get("brand"), parsed.get("product_name"), unknown, known)
+            route = model_router.route("halal")
+            model, halal_json, error = route.models[0], None, None
+            while model is not None:
+                chunks, usage_before, attempt_started = [], dict(metadata.get("usage") or {}), time.perf_counter()
+                try:
+                    async for delta in self.complete_stream(metadata=metadata, **self.halal_request(prompt, model)):
+                        chunks.append(delta)
+                        yield "halal_delta", {"text": delta}
+                except LLMUnavailableError as e:
+                    if halal_json is None:
+                        error = e
+                    else:
+                        metadata["escalation_failed"] = "halal"
+                    break
+                checked = self.validate_halal("".join(chunks))
+                if checked is not None or halal_json is None:
+                    halal_json = "".join(chunks)
+                    metadata.setdefault("models", {})["halal"] = model
+                next_model = self.route_step(route, model, metadata, usage_before, attempt_started, checked)
+                if next_model is not None:
+                    # Клиент уже показал часть вердикта: предупреждаем, что дальше текст пойдёт заново
+                    yield "halal_escalation", metadata["escalations"][-1]
+                model = next_model
+            if error is not None:
+                halal_result = self.degraded_halal(known, unknown, metadata, error)
+            else:
+                halal_result = await self.finish_halal(halal_json, known, unknown)
+            # Стадию внутри генератора меряем вручную: контекст span не переживает yield
+            observe_stage("halal", time.perf_counter() - started)
+        metadata["halal_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        yield "result", {**self.product_fields(parsed), "ingredients": ingredients, **halal_result, "metadata": metadata}
+
+    async def extract(self, image_content: bytes, mime_type: str, metadata: Dict[str, Any], wait: bool = False) -> Dict[str, Any]:
+        ocr = await self.run_local_ocr(image_content, metadata, wait)
+        parsed = self.accept_local(ocr, metadata)
+        if parsed is not None:
+            return parsed
+        started = time.perf_counter()
+        try:
+            parsed = await self.extract_with_vision(image_content, mime_type, metadata)
+        except LLMUnavailableError as e:
+            return self.degraded_parsed(ocr, metadata, e)
+        metadata["vision_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return parsed
+
+    async def run_local_ocr(self, image_content: bytes, metadata: Dict[str, Any], wait: bool = False) -> Optional[Dict[str, Any]]:
+        """Локальный OCR, если он включён; None — если выключен или упал."""
+        if not OCR_FAST_PATH_ENABLED:
+            return None
+        started = time.perf_counter()
+        try:
+            with stage("ocr"):
+                ocr = await run_ocr(image_content, wait=wait)
+        except OcrBusyError:
+            raise
+        except Exception as e:
+            logging.warning(f"Local OCR failed, falling back to vision: {e}")
+            ocr = None
+        metadata["ocr_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if ocr is not None:
+            metadata["ocr_score"] = round(ocr["score"], 3)
+            # Найденное сканером в блоке состава уходит в стадию halal, даже если сам OCR не принят
+            additives = [hit for hit in ocr["additives"] if hit["in_composition"]]
+            if additives:
+                metadata["additives"] = additives
+        return ocr
+
+    def accept_local(self, ocr: Optional[Dict[str, Any]], metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Быстрый путь: к GPT-4o vision идём только при низкой уверенности OCR."""
+        if ocr is None or not accept_ocr(ocr):
+            return None
+        metadata["tier"] = "ocr"
+        return {"brand": None, "product_name": None, "manufacturer": None, "country": None,
+                "ingredients": ocr["ingredients"]}
+
+    def degraded_parsed(self, ocr: Optional[Dict[str, Any]], metadata: Dict[str, Any], error: LLMUnavailableError) -> Dict[str, Any]:
+        """OpenAI недоступен: берём состав из локального OCR, даже если его уверенность ниже порога."""
+        if ocr is None or not ocr["ingredients"]:
+            raise error
+        self.mark_degraded(metadata, error)
+        metadata["tier"] = "ocr"
+        return {"brand": None, "product_name": None, "manufacturer": None, "country": None,
+                "ingredients": ocr["ingredients"]}
+
+    def mark_degraded(self, metadata: Optional[Dict[str, Any]], error: LLMUnavailableError) -> None:
+        if metadata is None or "degraded" not in metadata:
+            self.llm.record_degraded()
+        if metadata is not None:
+            metadata.setdefault("degraded", str(error))
+
+    async def extract_with_vision(self, image_content: bytes, mime_type: str = "image/jpeg", metadata: Dict[str, Any] = None) -> Dict[str, Any]:
         prompt = """
         На изображении — упаковка пищевого продукта.
 
@@ -52,105 +436,169 @@ class ProductAnalysisAgent:
         Не додумывай и не фантазируй ингредиенты. Используй **только** то, что видно на изображении.
         """
 
-        response = await self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=500,
-            temperature=0,
-            seed=42  # Для стабильности
-        )
+        messages = self.image_messages(prompt, image_content, mime_type)
 
-        result = response.choices[0].message.content
-        match = re.search(r"```json\s*(\{[\s\S]*?\})\s*```", result)
-        json_str = match.group(1) if match else result
+        async def attempt(model: str):
+            with stage("vision", model=model):
+                response = await self.complete(
+                    metadata=metadata,
+                    model=model,
+                    messages=messages,
+                    max_tokens=500,
+                    temperature=0,
+                    seed=42  # Для стабильности
+                )
 
-        try:
-            parsed = json.loads(json_str)
-        except Exception:
-            try:
-                parsed = ast.literal_eval(json_str)
-            except Exception:
-                parsed = {
+            with stage("json_parse"):
+                result = response.choices[0].message.content
+                match = re.search(r"```json\s*(\{[\s\S]*?\})\s*```", result)
+                json_str = match.group(1) if match else result
+
+                try:
+                    parsed = json.loads(json_str)
+                except Exception:
+                    try:
+                        parsed = ast.literal_eval(json_str)
+                    except Exception:
+                        parsed = None
+            if not isinstance(parsed, dict):
+                return {
                     "brand": None,
                     "product_name": None,
                     "manufacturer": None,
                     "country": None,
                     "ingredients": [],
                     "note": "Ошибка разбора ответа от GPT"
-                }
+                }, None
+            return parsed, parsed
 
-        brand = parsed.get("brand")
-        product_name = parsed.get("product_name")
-        manufacturer = parsed.get("manufacturer")
-        country = parsed.get("country")
-        ingredients = parsed.get("ingredients", [])
+        return await self.routed("vision", metadata, attempt)
+
+    def product_fields(self, parsed: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "brand": parsed.get("brand"),
+            "product_name": parsed.get("product_name"),
+            "manufacturer": parsed.get("manufacturer"),
+            "country": parsed.get("country"),
+        }
 
+    def missing_ingredients_result(self, parsed: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            **self.product_fields(parsed),
+            "ingredients": [],
+            "status": "doubtful",
+            "confidence": "низкая",
+            "concerns": ["Состав не удалось извлечь с изображения"],
+            "recommendation": "Попробуйте загрузить фото с более чётким изображением состава",
+            "metadata": metadata
+        }
+
+    async def build_result(self, parsed: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+        ingredients = parsed.get("ingredients", [])
         if not ingredients:
-            return {
-                "brand": brand,
-                "product_name": product_name,
-                "manufacturer": manufacturer,
-                "country": country,
-                "ingredients": [],
-                "status": "doubtful",
-                "confidence": "низкая",
-                "concerns": ["Состав не удалось извлечь с изображения"],
-                "recommendation": "Попробуйте загрузить фото с более чётким изображением состава"
-            }
+            return self.missing_ingredients_result(parsed, metadata)
 
-        halal_json = await self.analyze_halal_status(brand, product_name, ingredients)
-        try:
-            halal_result = json.loads(halal_json)
-        except Exception:
-            match = re.search(r"\{[\s\S]*\}", halal_json)
-            if match:
-                try:
-                    halal_result = ast.literal_eval(match.group(0))
-                except Exception:
-                    halal_result = self.default_halal_fail()
-            else:
-                halal_result = self.default_halal_fail()
+        started = time.perf_counter()
+        halal_result = await self.classify_ingredients(parsed.get("brand"), parsed.get("product_name"), ingredients, metadata)
+        metadata["halal_ms"] = round((time.perf_counter() - started) * 1000, 1)
 
         result = {
-            "brand": brand,
-            "product_name": product_name,
-            "manufacturer": manufacturer,
-            "country": country,
+            **self.product_fields(parsed),
             "ingredients": ingredients,
-            **halal_result
+            **halal_result,
+            "metadata": metadata
         }
         return result
 
-    async def analyze_halal_status(self, brand: str, product_name: str, ingredients: List[str]) -> str:
+    async def plan_halal(self, ingredients: List[str], metadata: Dict[str, Any] = None) -> Tuple[list, List[str], Optional[Dict[str, Any]]]:
+        # Сначала смотрим в индекс ингредиентов, к модели идём только с неизвестными
+        with stage("ingredient_index"):
+            await ingredient_index.load()
+            known, unknown = ingredient_index.lookup(ingredients)
+            if metadata is not None:
+                known += ingredient_index.from_hits(metadata.get("additives"), ingredients)
+            local = local_decision(known, unknown)
+        if metadata is not None:
+            metadata["halal_source"] = "index" if local is not None else "llm"
+        return known, unknown, local
+
+    async def classify_ingredients(self, brand: str, product_name: str, ingredients: List[str], metadata: Dict[str, Any] = None) -> Dict[str, Any]:
+        known, unknown, local = await self.plan_halal(ingredients, metadata)
+        if local is not None:
+            return local
+
+        async def fetch() -> Dict[str, Any]:
+            halal_json = await self.analyze_halal_status(brand, product_name, unknown, known, metadata)
+            return await self.finish_halal(halal_json, known, unknown)
+
+        def joined(halal_result: Dict[str, Any]) -> Dict[str, Any]:
+            if metadata is not None:
+                metadata["coalesced"] = "halal"
+            return halal_result
+
+        # Тот же состав уже проверяется для другого запроса — ждём его ответ, а не шлём второй
+        key = halal_key(brand, product_name, [*ingredients, *(name for name, _, _ in known)])
+        try:
+            return await halal_flights.do(key, fetch, on_join=joined)
+        except LLMUnavailableError as e:
+            return self.degraded_halal(known, unknown, metadata, e)
+
+    def degraded_halal(self, known: list, unknown: List[str], metadata: Optional[Dict[str, Any]], error: LLMUnavailableError) -> Dict[str, Any]:
+        """Вердикт только по индексу ингредиентов: непроверенные ингредиенты делают продукт сомнительным."""
+        self.mark_degraded(metadata, error)
+        doubtful = [f"{i}: {reason}" for i, status, reason in known if status == "doubtful"]
+        return {
+            "status": "doubtful",
+            "confidence": "низкая",
+            "concerns": doubtful + [f"Не удалось проверить: {', '.join(unknown)}"],
+            "recommendation": "Сервис анализа временно недоступен. Проверьте эти ингредиенты вручную или повторите проверку позже."
+        }
+
+    async def finish_halal(self, halal_json: str, known: list, unknown: List[str]) -> Dict[str, Any]:
+        """Разбирает ответ модели, сохраняет вердикты по новым ингредиентам и учитывает уже известные."""
+        with stage("json_parse"):
+            halal_result = self.parse_halal_json(halal_json)
+
+        unknown_keys = {normalize(i) for i in unknown}
+        verdicts = {}
+        for item in halal_result.pop("ingredients", None) or []:
+            if not isinstance(item, dict):
+                continue
+            name = item.get("name") or ""
+            if normalize(name) in unknown_keys:
+                verdicts[name] = (item.get("status"), item.get("reason") or "")
+        fresh = ingredient_index.learn(verdicts)
+        if fresh:
+            await ingredient_index.persist(fresh)
+
+        flagged = [(i, status, reason) for i, status, reason in known if status in ("doubtful", "haram")]
+        if flagged and halal_result.get("status") != "certified":
+            halal_result["status"] = worst_status([halal_result.get("status"), *[s for _, s, _ in flagged]])
+            concerns = list(halal_result.get("concerns") or [])
+            halal_result["concerns"] = [f"{i}: {reason}" for i, _, reason in flagged] + concerns
+        return halal_result
+
+    def halal_prompt(self, brand: str, product_name: str, ingredients: List[str], known: List[tuple] = None) -> str:
         ingredients_text = "\n".join(f"- {i}" for i in ingredients)
+        known_text = "\n".join(f"- {i}: {status}" for i, status, _ in known or []) or "- нет"
         prompt = f"""
         Проанализируй продукт и состав на халяльность:
 
         Бренд: {brand}
         Продукт: {product_name}
-        Состав:
+        Состав (требует проверки):
         {ingredients_text}
-        ❗ Если в составе есть кармин (E120, cochineal) — статус должен быть haram. Будь жестким это отвественная работа
+        Уже проверенные ингредиенты этого продукта:
+        {known_text}
+        ❗ Будь жестким это отвественная работа
 
         Верни строго JSON в таком формате:
         {{
           "status": "certified/clean/doubtful/haram",
           "confidence": "высокая/средняя/низкая",
           "concerns": ["..."],
-          "recommendation": "..."
+          "recommendation": "...",
+          "ingredients": [{{"name": "...", "status": "clean/doubtful/haram", "reason": "..."}}]
         }}
 
         ❗ Статусы:
@@ -158,15 +606,95 @@ class ProductAnalysisAgent:
         - clean — если состав чистый, но нет сертификата
         - doubtful — если есть сомнительные компоненты
         - haram — если есть харам ингредиенты
+
+        В поле ingredients дай вердикт для каждого ингредиента из списка "требует проверки", name — как в списке.
         """
-        response = await self.client.chat.completions.create(
-            model="gpt-4o",
+        return prompt
+
+    def halal_request(self, prompt: str, model: str = "gpt-4o") -> Dict[str, Any]:
+        return dict(
+            model=model,
             messages=[{"role": "user", "content": prompt}],
-            max_tokens=500,
+            max_tokens=800,
             temperature=0,
             seed=42
         )
-        return response.choices[0].message.content
+
+    async def analyze_halal_status(self, brand: str, product_name: str, ingredients: List[str], known: List[tuple] = None, metadata: Dict[str, Any] = None) -> str:
+        prompt = self.halal_prompt(brand, product_name, ingredients, known)
+
+        async def attempt(model: str):
+            with stage("halal", model=model):
+                response = await self.complete(metadata=metadata, **self.halal_request(prompt, model))
+            halal_json = response.choices[0].message.content
+            return halal_json, self.validate_halal(halal_json)
+
+        return await self.routed("halal", metadata, attempt)
+
+    async def routed(self, stage_name: str, metadata: Optional[Dict[str, Any]], attempt: Callable[[str], Awaitable[tuple]]) -> Any:
+        """Проходит модели ступени по маршруту, пока ответ не перестанет требовать эскалации.
+
+        attempt(model) возвращает (значение, dict для правил эскалации или None, если ответ не прошёл валидацию).
+        Невалидный ответ сильной модели не вытесняет валидный ответ слабой.
+        """
+        route = model_router.route(stage_name)
+        if metadata is None:
+            metadata = {}
+        model, result, used = route.models[0], None, None
+        while model is not None:
+            usage_before, started = dict(metadata.get("usage") or {}), time.perf_counter()
+            try:
+                value, checked = await attempt(model)
+            except LLMUnavailableError:
+                # Первая модель уже ответила — её ответ лучше деградации из-за сбоя эскалации
+                if used is None:
+                    raise
+                metadata["escalation_failed"] = stage_name
+                break
+            if checked is not None or used is None:
+                result, used = value, model
+            model = self.route_step(route, model, metadata, usage_before, started, checked)
+        metadata.setdefault("models", {})[stage_name] = used
+        return result
+
+    def route_step(self, route: ModelRoute, model: str, metadata: Dict[str, Any], usage_before: Dict[str, int],
+                   started: float, checked: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Учитывает попытку в route_stats и возвращает модель для эскалации (None — ответ принят)."""
+        usage = metadata.get("usage") or {}
+        next_model = route.next_model(model)
+        reasons = route.reasons(checked) if next_model else []
+        route_stats.record(route.stage, model, (time.perf_counter() - started) * 1000,
+                           {key: usage.get(key, 0) - usage_before.get(key, 0) for key in ("prompt_tokens", "completion_tokens")},
+                           reasons)
+        if not reasons:
+            return None
+        metadata.setdefault("escalations", []).append({"stage": route.stage, "from": model, "to": next_model, "reasons": reasons})
+        return next_model
+
+    def load_halal_json(self, halal_json: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(halal_json)
+        except Exception:
+            match = re.search(r"\{[\s\S]*\}", halal_json)
+            if match:
+                try:
+                    return json.loads(match.group(0))
+                except Exception:
+                    try:
+                        return ast.literal_eval(match.group(0))
+                    except Exception:
+                        pass
+        return None
+
+    def parse_halal_json(self, halal_json: str) -> Dict[str, Any]:
+        parsed = self.load_halal_json(halal_json)
+        return parsed if parsed is not None else self.default_halal_fail()
+
+    def validate_halal(self, halal_json: str) -> Optional[Dict[str, Any]]:
+        try:
+            return HalalVerdict(**self.load_halal_json(halal_json)).model_dump()
+        except Exception:
+            return None
 
     def default_halal_fail(self, reason: str = "Не удалось проанализировать состав") -> Dict[str, Any]:
         return {
@@ -176,21 +704,4 @@ class ProductAnalysisAgent:
             "recommendation": "Проверьте состав вручную или поищите халяль сертификат."
         }
     def extract_ingredients_from_image(self, image_content: bytes) -> List[str]:
-        image = Image.open(BytesIO(image_content))
-        text = pytesseract.image_to_string(image, lang="rus+eng").lower()
-        print("[OCR TEXT]", text)  # Для отладки, можно заменить на logging
-        # Ищем все вхождения "состав" с разными разделителями и переносами
-        matches = re.findall(r"состав[:\-\s]*([\w\W]+?)(?:[.!?\n\r]|$)", text)
-        if not matches:
-            return []
-        # Берём первый найденный вариант
-        raw_ingredients = matches[0].strip()
-        # Иногда после слова "состав" идёт длинный текст, обрезаем по частым стоп-словам
-        for stopword in ["пищевое ", "пищевая ", "энергетическая ", "условия хранения", "срок годности", "масса нетто", "производитель"]:
-            idx = raw_ingredients.find(stopword)
-            if idx > 10:
-                raw_ingredients = raw_ingredients[:idx]
-        # Очищаем и разбиваем
-        ingredients = [i.strip().capitalize() for i in re.split(r",|;|\n|\r", raw_ingredients) if 2 < len(i.strip()) < 50]
-        return ingredients
-
+        return ocr_image(image_content)["ingredients"]
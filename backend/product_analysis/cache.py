@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL", 60 * 60 * 24))
+CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 2048))
+# Максимальное расстояние Хэмминга между dHash, при котором фото считаются одинаковыми.
+# Одного dHash для вердикта мало: этикетки одной линейки товаров различаются в пределах этого
+# расстояния, поэтому похожее фото засчитывается только при совпадении штрихкода
+PHASH_MAX_DISTANCE = int(os.getenv("ANALYSIS_CACHE_PHASH_DISTANCE", 4))
+
+# 64-битный хэш режем на полосы: если расстояние <= PHASH_MAX_DISTANCE,
+# то хотя бы одна из PHASH_MAX_DISTANCE + 1 полос совпадает точно
+_PHASH_BITS = 64
+
+
+def _bands(phash: int) -> list:
+    count = max(1, PHASH_MAX_DISTANCE + 1)
+    width = _PHASH_BITS // count
+    bands = []
+    for i in range(count):
+        shift = i * width
+        bits = width if i < count - 1 else _PHASH_BITS - shift
+        bands.append((i, (phash >> shift) & ((1 << bits) - 1)))
+    return bands
+
+
+def content_hash(image_content: bytes) -> str:
+    return hashlib.sha256(image_content).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    # Тот же ключ, что content_hash от содержимого файла, без чтения файла целиком в память
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def perceptual_hash_image(image: "Image.Image") -> Optional[int]:
+    """dHash 8x8: устойчив к пересжатию, масштабу и небольшим изменениям яркости."""
+    from PIL import Image, ImageStat
+    small = image.convert("L").resize((9, 8), Image.LANCZOS)
+    # У однотонных кадров хэш вырождается в 0 и совпал бы у любых двух таких фото
+    if ImageStat.Stat(small).stddev[0] < 2:
+        return None
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def perceptual_hash(image_content: bytes) -> Optional[int]:
+    from PIL import Image
+    try:
+        return perceptual_hash_image(Image.open(BytesIO(image_content)))
+    except Exception:
+        return None
+
+
+def image_keys(image_content: bytes) -> Tuple[str, Optional[int]]:
+    return content_hash(image_content), perceptual_hash(image_content)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class MemoryCacheBackend:
+    """In-process LRU с TTL. Подходит для одного воркера и для разработки."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Optional[int], Dict[str, Any]]]" = OrderedDict()
+        self._bands: Dict[Tuple[int, int], set] = {}
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def find_similar(self, phash: int) -> Optional[str]:
+        candidates = set()
+        for band in _bands(phash):
+            candidates |= self._bands.get(band, set())
+        best_key, best_distance = None, PHASH_MAX_DISTANCE + 1
+        for key in candidates:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] is None:
+                continue
+            distance = hamming(phash, entry[1])
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+        return best_key
+
+    async def set(self, key: str, phash: Optional[int], value: Dict[str, Any], ttl: int) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, phash, value)
+        if phash is not None:
+            for band in _bands(phash):
+                self._bands.setdefault(band, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    async def size(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: str) -> None:
+        _, phash, _ = self._entries.pop(key)
+        if phash is not None:
+            for band in _bands(phash):
+                keys = self._bands.get(band)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._bands[band]
+
+
+class RedisCacheBackend:
+    """Бэкенд поверх Redis-совместимого хранилища (redis.asyncio API).
+
+    TTL ставится на каждый ключ, LRU-вытеснение выполняет сам сервер
+    (maxmemory-policy allkeys-lru). Клиент можно подменить любым объектом
+    с методами get/set/sadd/smembers/expire/scan_iter.
+    """
+
+    prefix = "halal-scan:analysis:"
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisCacheBackend":
+        import redis.asyncio as redis
+        return cls(redis.from_url(url, decode_responses=True))
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.client.get(self.prefix + "result:" + key)
+        if raw is None:
+            return None
+        return json.loads(raw)["value"]
+
+    async def find_similar(self, phash: int) -> Optional[str]:
+        candidates = set()
+        for band, value in _bands(phash):
+            candidates |= set(await self.client.smembers(f"{self.prefix}band:{band}:{value}"))
+        best_key, best_distance = None, PHASH_MAX_DISTANCE + 1
+        for key in candidates:
+            raw = await self.client.get(self.prefix + "result:" + key)
+            if raw is None:
+                continue
+            stored = json.loads(raw).get("phash")
+            if stored is None:
+                continue
+            distance = hamming(phash, stored)
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+        return best_key
+
+    async def set(self, key: str, phash: Optional[int], value: Dict[str, Any], ttl: int) -> None:
+        payload = json.dumps({"phash": phash, "value": value}, ensure_ascii=False)
+        await self.client.set(self.prefix + "result:" + key, payload, ex=ttl)
+        if phash is not None:
+            for band, band_value in _bands(phash):
+                band_key = f"{self.prefix}band:{band}:{band_value}"
+                await self.client.sadd(band_key, key)
+                await self.client.expire(band_key, ttl)
+
+    async def size(self) -> int:
+        # Только результаты: в той же базе лежат полосы dHash и чужие ключи
+        count = 0
+        async for _ in self.client.scan_iter(match=self.prefix + "result:*", count=1000):
+            count += 1
+        return count
+
+
+class AnalysisCache:
+    """Кэш результатов анализа: точное совпадение по sha256, затем похожее фото по dHash с тем же штрихкодом."""
+
+    def __init__(self, backend=None, ttl: int = CACHE_TTL_SECONDS):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str, phash: Optional[int], barcode: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if phash is not None and barcode is not None:
+            similar_key = await self.backend.find_similar(phash)
+            if similar_key is not None:
+                value = await self.backend.get(similar_key)
+                if value is not None and value.get("barcode") == barcode:
+                    self.similar_hits += 1
+                    return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, phash: Optional[int], value: Dict[str, Any]) -> None:
+        await self.backend.set(key, phash, value, self.ttl)
+
+    async def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.similar_hits + self.misses
+        return {
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.similar_hits) / total if total else 0.0,
+            "entries": await self.backend.size(),
+        }
+
+
+def create_cache() -> AnalysisCache:
+    redis_url = os.getenv("ANALYSIS_CACHE_REDIS_URL")
+    if redis_url:
+        return AnalysisCache(RedisCacheBackend.from_url(redis_url))
+    return AnalysisCache()
+
+
+analysis_cache = create_cache()
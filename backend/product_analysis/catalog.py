@@ -0,0 +1,247 @@
+import argparse
+import csv
+import logging
+import os
+import re
+import sys
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+CATALOG_BARCODE_ENABLED = os.getenv("CATALOG_BARCODE_ENABLED", "1") == "1"
+CATALOG_IMPORT_CHUNK = int(os.getenv("CATALOG_IMPORT_CHUNK", 1000))
+
+# Источники, которым доверяем больше, чем автоматическому анализу: их записи анализ не перезаписывает.
+# История проверок сюда не входит и в каталог не пишется: её присылает клиент, вердикт в ней может быть любым
+TRUSTED_SOURCES = ("import", "off")
+# Поля, которые отдаются клиенту так же, как в ответе /analyze
+RESULT_FIELDS = ("brand", "product_name", "manufacturer", "country", "ingredients",
+                 "status", "confidence", "concerns", "recommendation")
+
+
+def normalize_barcode(value: Optional[str]) -> Optional[str]:
+    """Приводит EAN-8/UPC-A/EAN-13/GTIN-14 к виду, под которым код хранится в каталоге."""
+    digits = re.sub(r"\D", "", value or "")
+    if len(digits) == 12:
+        # UPC-A — тот же EAN-13 с ведущим нулём
+        digits = "0" + digits
+    if len(digits) not in (8, 13, 14):
+        return None
+    body, check = digits[:-1], int(digits[-1])
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(body)))
+    if (10 - total % 10) % 10 != check:
+        return None
+    return digits
+
+
+def decode_barcode(image: "Image.Image") -> Optional[str]:
+    """Ищет штрихкод на фото; без pyzbar/libzbar просто возвращает None."""
+    if not CATALOG_BARCODE_ENABLED:
+        return None
+    try:
+        from pyzbar import pyzbar
+    except ImportError:
+        return None
+    try:
+        symbols = pyzbar.decode(image.convert("L"), symbols=[pyzbar.ZBarSymbol.EAN13, pyzbar.ZBarSymbol.EAN8,
+                                                            pyzbar.ZBarSymbol.UPCA, pyzbar.ZBarSymbol.UPCE])
+    except Exception as e:
+        logging.warning(f"Barcode decoding failed: {e}")
+        return None
+    for symbol in symbols:
+        barcode = normalize_barcode(symbol.data.decode("ascii", "ignore"))
+        if barcode:
+            return barcode
+    return None
+
+
+def split_ingredients(text: str) -> List[str]:
+    """Режет строку состава по запятым и точкам с запятой вне скобок."""
+    items, depth, current = [], 0, ""
+    for char in text or "":
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth = max(0, depth - 1)
+        if char in ",;" and depth == 0:
+            items.append(current)
+            current = ""
+        else:
+            current += char
+    items.append(current)
+    return [item.strip(" .*_\n\t").capitalize() for item in items if item.strip(" .*_\n\t")]
+
+
+def entry_to_result(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        **{field: entry.get(field) for field in RESULT_FIELDS},
+        "barcode": entry["barcode"],
+        "metadata": {"tier": "catalog", "catalog_source": entry.get("source")},
+    }
+
+
+class ProductCatalog:
+    """Каталог товаров по штрихкоду (таблица product_catalog, уникальный индекс по barcode).
+
+    Пополняется только на сервере: результатами анализа фото со штрихкодом
+    и пакетным импортом CSV / выгрузок Open Food Facts.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    async def lookup(self, barcode: str) -> Optional[Dict[str, Any]]:
+        from sqlalchemy import select
+        from auth.database import AsyncSessionLocal
+        from .models import ProductCatalogEntry
+        async with AsyncSessionLocal() as db:
+            row = await db.scalar(select(ProductCatalogEntry).where(ProductCatalogEntry.barcode == barcode))
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {
+                "barcode": row.barcode,
+                "brand": row.brand,
+                "product_name": row.product_name,
+                "manufacturer": row.manufacturer,
+                "country": row.country,
+                "ingredients": row.ingredients or [],
+                "status": row.status,
+                "confidence": row.confidence,
+                "concerns": row.concerns or [],
+                "recommendation": row.recommendation,
+                "source": row.source,
+            }
+
+    async def record(self, barcode: str, result: Dict[str, Any], source: str) -> None:
+        """Сохраняет вердикт по штрихкоду. Результат анализа не затирает запись из доверенного источника."""
+        barcode = normalize_barcode(barcode)
+        if not barcode or not result.get("ingredients"):
+            return
+        from sqlalchemy import select
+        from auth.database import AsyncSessionLocal
+        from .models import ProductCatalogEntry
+        async with AsyncSessionLocal() as db:
+            try:
+                row = await db.scalar(select(ProductCatalogEntry).where(ProductCatalogEntry.barcode == barcode))
+                if row is not None and source == "analysis" and row.source in TRUSTED_SOURCES and row.status:
+                    return
+                if row is None:
+                    row = ProductCatalogEntry(barcode=barcode)
+                    db.add(row)
+                for field in RESULT_FIELDS:
+                    value = result.get(field)
+                    if value is not None:
+                        setattr(row, field, value)
+                row.source = source
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.warning(f"Product catalog: failed to record {barcode}: {e}")
+
+    def import_rows(self, rows: Iterable[Dict[str, Any]], source: str = "import") -> int:
+        """Пакетный upsert (синхронно, для консольного импорта). Пустой статус в импорте не затирает уже известный вердикт."""
+        from auth.database import SessionLocal
+        db = SessionLocal()
+        imported = 0
+        try:
+            chunk = []
+            for row in rows:
+                barcode = normalize_barcode(row.get("barcode"))
+                if not barcode:
+                    continue
+                chunk.append({"barcode": barcode, "source": source,
+                              **{field: row.get(field) for field in RESULT_FIELDS}})
+                if len(chunk) >= CATALOG_IMPORT_CHUNK:
+                    imported += self._upsert(db, chunk)
+                    chunk = []
+            if chunk:
+                imported += self._upsert(db, chunk)
+            return imported
+        finally:
+            db.close()
+
+    def _upsert(self, db, chunk: List[Dict[str, Any]]) -> int:
+        from sqlalchemy import case, func
+        from .models import ProductCatalogEntry
+        # В одном INSERT ... ON CONFLICT один штрихкод может встретиться только раз
+        chunk = list({item["barcode"]: item for item in chunk}.values())
+        dialect = db.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            existing = {row.barcode: row for row in db.query(ProductCatalogEntry)
+                        .filter(ProductCatalogEntry.barcode.in_([item["barcode"] for item in chunk]))}
+            for item in chunk:
+                row = existing.get(item["barcode"])
+                if row is None:
+                    db.add(ProductCatalogEntry(**item))
+                    continue
+                for field in RESULT_FIELDS:
+                    if item[field] is not None:
+                        setattr(row, field, item[field])
+                if item["status"] is not None:
+                    row.source = item["source"]
+            db.commit()
+            return len(chunk)
+        statement = insert(ProductCatalogEntry).values(chunk)
+        excluded = statement.excluded
+        table = ProductCatalogEntry.__table__.c
+        updates = {field: func.coalesce(getattr(excluded, field), getattr(table, field)) for field in RESULT_FIELDS}
+        updates["source"] = case((excluded.status.isnot(None), excluded.source), else_=table.source)
+        updates["updated_at"] = func.now()
+        db.execute(statement.on_conflict_do_update(index_elements=["barcode"], set_=updates))
+        db.commit()
+        return len(chunk)
+
+
+def read_csv(path: str) -> Iterator[Dict[str, Any]]:
+    """CSV с колонками barcode, brand, product_name, manufacturer, country, ingredients[, status, confidence]."""
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            yield {
+                **{field: row.get(field) or None for field in RESULT_FIELDS},
+                "barcode": row.get("barcode"),
+                "ingredients": split_ingredients(row.get("ingredients", "")) or None,
+                "concerns": None,
+            }
+
+
+def read_open_food_facts(path: str) -> Iterator[Dict[str, Any]]:
+    """Выгрузка Open Food Facts (en.openfoodfacts.org.products.csv, TSV). Вердикта в ней нет — только состав."""
+    csv.field_size_limit(sys.maxsize)
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            ingredients = split_ingredients(row.get("ingredients_text", ""))
+            if not ingredients:
+                continue
+            yield {
+                "barcode": row.get("code"),
+                "brand": (row.get("brands") or "").split(",")[0].strip() or None,
+                "product_name": row.get("product_name") or None,
+                "manufacturer": row.get("manufacturing_places") or None,
+                "country": (row.get("countries_en") or "").split(",")[0].strip() or None,
+                "ingredients": ingredients,
+            }
+
+
+product_catalog = ProductCatalog()
+
+
+if __name__ == "__main__":
+    # python -m product_analysis.catalog import products.csv
+    # python -m product_analysis.catalog import-off en.openfoodfacts.org.products.csv
+    parser = argparse.ArgumentParser(description="Заполнение каталога товаров по штрихкоду")
+    parser.add_argument("command", choices=["import", "import-off"])
+    parser.add_argument("path")
+    args = parser.parse_args()
+    if args.command == "import":
+        count = product_catalog.import_rows(read_csv(args.path), source="import")
+    else:
+        count = product_catalog.import_rows(read_open_food_facts(args.path), source="off")
+    print(f"Imported {count} products")
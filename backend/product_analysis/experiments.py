@@ -0,0 +1,77 @@
+import os
+import random
+from collections import deque
+from typing import Any, Dict, Optional
+
+from observability import percentile
+
+# two_stage — vision, затем отдельный запрос на халяльность; single_pass — один запрос со structured output;
+# ab — случайный выбор между ними с долей single_pass = ANALYSIS_AB_SPLIT
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "two_stage")
+ANALYSIS_AB_SPLIT = float(os.getenv("ANALYSIS_AB_SPLIT", 0.5))
+# Доля запросов, для которых второй режим прогоняется в фоне, чтобы сравнить вердикты
+ANALYSIS_SHADOW_RATE = float(os.getenv("ANALYSIS_SHADOW_RATE", 0))
+
+MODES = ("two_stage", "single_pass")
+
+
+def choose_mode() -> str:
+    if ANALYSIS_MODE == "ab":
+        return "single_pass" if random.random() < ANALYSIS_AB_SPLIT else "two_stage"
+    return ANALYSIS_MODE if ANALYSIS_MODE in MODES else "two_stage"
+
+
+def other_mode(mode: str) -> str:
+    return "two_stage" if mode == "single_pass" else "single_pass"
+
+
+def should_shadow() -> bool:
+    return ANALYSIS_SHADOW_RATE > 0 and random.random() < ANALYSIS_SHADOW_RATE
+
+
+class ModeStats:
+    """Сравнение режимов анализа: задержка, токены, откаты single_pass и согласие вердиктов."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.modes: Dict[str, Dict[str, Any]] = {}
+        self.comparisons = 0
+        self.agreements = 0
+
+    def record(self, mode: str, latency_ms: float, usage: Optional[Dict[str, int]], fallback: bool = False) -> None:
+        entry = self.modes.setdefault(mode, {
+            "requests": 0, "fallbacks": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "latencies": deque(maxlen=self.window),
+        })
+        entry["requests"] += 1
+        entry["fallbacks"] += int(fallback)
+        entry["latencies"].append(latency_ms)
+        usage = usage or {}
+        entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        entry["completion_tokens"] += usage.get("completion_tokens", 0)
+
+    def record_agreement(self, agree: bool) -> None:
+        self.comparisons += 1
+        self.agreements += int(agree)
+
+    def stats(self) -> Dict[str, Any]:
+        modes = {}
+        for mode, entry in self.modes.items():
+            requests = entry["requests"]
+            modes[mode] = {
+                "requests": requests,
+                "fallbacks": entry["fallbacks"],
+                "latency_p50_ms": percentile(entry["latencies"], 0.5),
+                "latency_p95_ms": percentile(entry["latencies"], 0.95),
+                "avg_prompt_tokens": entry["prompt_tokens"] / requests if requests else 0,
+                "avg_completion_tokens": entry["completion_tokens"] / requests if requests else 0,
+            }
+        return {
+            "mode": ANALYSIS_MODE,
+            "modes": modes,
+            "comparisons": self.comparisons,
+            "agreement_ratio": self.agreements / self.comparisons if self.comparisons else None,
+        }
+
+
+mode_stats = ModeStats()
@@ -0,0 +1,196 @@
+import base64
+import binascii
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import ProductCheckHistory
+
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+HISTORY_BATCH_MAX_ITEMS = int(os.getenv("HISTORY_BATCH_MAX_ITEMS", 500))
+# С какого размера пакета на Postgres пишем через COPY во временную таблицу вместо INSERT ... VALUES
+HISTORY_COPY_THRESHOLD = int(os.getenv("HISTORY_COPY_THRESHOLD", 100))
+# Строк в одном INSERT ... VALUES: держимся далеко от лимита в 32767 параметров
+HISTORY_INSERT_CHUNK = 500
+
+# Сохраняем только если статус не unknown
+HISTORY_STATUSES = ("certified", "haram", "doubtful", "clean")
+WRITE_FIELDS = (
+    "product_name", "brand", "manufacturer", "country", "status", "image_url", "category",
+    "ingredients", "halal_certificate", "reason", "confidence", "barcode", "additional_notes",
+)
+
+# Поля, которые можно запросить через ?fields=; id и date нужны курсору и отдаются всегда.
+# Без ?fields= отдаются все — те же, что отдавал список истории до пагинации
+HISTORY_FIELDS = (
+    "id", "date", "user_id", "product_name", "brand", "manufacturer", "country", "status", "image_url", "category",
+    "ingredients", "halal_certificate", "reason", "confidence", "barcode", "additional_notes",
+)
+REQUIRED_FIELDS = ("id", "date")
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(date: datetime, item_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{date.isoformat()}|{item_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        date, item_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(date), int(item_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {e}")
+
+
+def parse_fields(fields: Optional[str]) -> Sequence[str]:
+    if not fields:
+        return HISTORY_FIELDS
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in HISTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return [*REQUIRED_FIELDS, *(field for field in requested if field not in REQUIRED_FIELDS)]
+
+
+async def fetch_history(
+    db: AsyncSession,
+    user_id: int,
+    limit: Optional[int] = HISTORY_DEFAULT_LIMIT,
+    cursor: Optional[str] = None,
+    fields: Sequence[str] = HISTORY_FIELDS,
+    status: Optional[str] = None,
+    brand: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница истории, от новых к старым, и курсор следующей страницы (None — страниц больше нет).
+    limit=None — вся история одним списком, без курсора.
+
+    Keyset-пагинация по (date, id) идёт по индексу (user_id, date, id): стоимость
+    страницы не зависит ни от её номера, ни от размера истории.
+    """
+    columns = [getattr(ProductCheckHistory, field) for field in fields]
+    query = select(*columns).where(ProductCheckHistory.user_id == user_id)
+    if status:
+        query = query.where(ProductCheckHistory.status == status)
+    if brand:
+        query = query.where(ProductCheckHistory.brand.ilike(brand.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"), escape="\\"))
+    if date_from:
+        query = query.where(ProductCheckHistory.date >= date_from)
+    if date_to:
+        query = query.where(ProductCheckHistory.date < date_to)
+    if cursor:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        # Сравнение кортежей, а не OR: так и Postgres, и SQLite делают range scan по индексу
+        query = query.where(tuple_(ProductCheckHistory.date, ProductCheckHistory.id) < tuple_(cursor_date, cursor_id))
+    query = query.order_by(ProductCheckHistory.date.desc(), ProductCheckHistory.id.desc())
+    if limit is None:
+        return [dict(row) for row in (await db.execute(query)).mappings().all()], None
+    # Берём на одну строку больше, чтобы без COUNT понять, есть ли следующая страница
+    rows = (await db.execute(query.limit(limit + 1))).mappings().all()
+    items = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(items[-1]["date"], items[-1]["id"]) if len(rows) > limit else None
+    return items, next_cursor
+
+
+async def save_history_batch(db: AsyncSession, user_id: int, items: Sequence[Any]) -> List[Dict[str, Any]]:
+    """Пишет пакет проверок одной транзакцией и возвращает результат по каждому элементу.
+
+    Элементы с уже сохранённым idempotency_key (в БД или раньше в этом же пакете)
+    помечаются как duplicate с id существующей записи; элементам без ключа
+    присваивается случайный.
+    """
+    outcomes: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    rows, row_indexes, seen = [], {}, {}
+    for index, item in enumerate(items):
+        if item.status not in HISTORY_STATUSES:
+            outcomes[index] = {"index": index, "status": "error", "idempotency_key": item.idempotency_key,
+                               "error": "Invalid status for saving history"}
+            continue
+        key = item.idempotency_key or uuid.uuid4().hex
+        if key in seen:
+            outcomes[index] = {"index": index, "status": "duplicate", "idempotency_key": key}
+            continue
+        seen[key] = index
+        row_indexes[key] = index
+        rows.append({"user_id": user_id, "idempotency_key": key, **{field: getattr(item, field) for field in WRITE_FIELDS}})
+
+    # Заодно открывает транзакцию на соединении — в ней же пойдёт COPY
+    existing = dict((await db.execute(
+        select(ProductCheckHistory.idempotency_key, ProductCheckHistory.id)
+        .where(ProductCheckHistory.user_id == user_id, ProductCheckHistory.idempotency_key.in_(list(row_indexes)))
+    )).all()) if row_indexes else {}
+    fresh = [row for row in rows if row["idempotency_key"] not in existing]
+    created = await insert_history_rows(db, fresh)
+    await db.commit()
+
+    for key, index in row_indexes.items():
+        if key in created:
+            outcomes[index] = {"index": index, "status": "created", "id": created[key], "idempotency_key": key}
+        else:
+            # Ключ уже был в БД либо его только что записал параллельный запрос (ON CONFLICT DO NOTHING)
+            outcomes[index] = {"index": index, "status": "duplicate", "id": existing.get(key), "idempotency_key": key}
+    for outcome in outcomes:
+        if outcome["status"] == "duplicate" and outcome.get("id") is None:
+            outcome["id"] = created.get(outcome["idempotency_key"], existing.get(outcome["idempotency_key"]))
+    return outcomes
+
+
+async def insert_history_rows(db: AsyncSession, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    """INSERT ... ON CONFLICT DO NOTHING; возвращает {idempotency_key: id} реально вставленных строк."""
+    if not rows:
+        return {}
+    dialect = db.get_bind().dialect
+    if dialect.name == "postgresql" and dialect.driver == "asyncpg" and len(rows) >= HISTORY_COPY_THRESHOLD:
+        return await copy_history_rows(db, rows)
+    if dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    created = {}
+    for start in range(0, len(rows), HISTORY_INSERT_CHUNK):
+        statement = (
+            insert(ProductCheckHistory)
+            .values(rows[start:start + HISTORY_INSERT_CHUNK])
+            .on_conflict_do_nothing(index_elements=["user_id", "idempotency_key"])
+            .returning(ProductCheckHistory.idempotency_key, ProductCheckHistory.id)
+        )
+        created.update(dict((await db.execute(statement)).all()))
+    return created
+
+
+async def copy_history_rows(db: AsyncSession, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    """COPY во временную таблицу и один INSERT ... SELECT: COPY сам по себе не умеет ON CONFLICT."""
+    connection = await (await db.connection()).get_raw_connection()
+    driver = connection.driver_connection
+    columns = ["user_id", "idempotency_key", *WRITE_FIELDS]
+    column_list = ", ".join(columns)
+    # Только записываемые колонки и без умолчаний: LIKE ... INCLUDING DEFAULTS тянул бы nextval() для id
+    # на каждую строку временной таблицы. id и date проставляются при вставке в саму таблицу
+    await driver.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS history_batch ON COMMIT DROP AS "
+        f"SELECT {column_list} FROM product_check_history WITH NO DATA"
+    )
+    records = [
+        tuple(json.dumps(row[column], ensure_ascii=False) if column == "ingredients" and row[column] is not None else row[column]
+              for column in columns)
+        for row in rows
+    ]
+    await driver.copy_records_to_table("history_batch", records=records, columns=columns)
+    inserted = await driver.fetch(
+        f"INSERT INTO product_check_history ({column_list}) "
+        f"SELECT {column_list} FROM history_batch "
+        "ON CONFLICT (user_id, idempotency_key) DO NOTHING "
+        "RETURNING idempotency_key, id"
+    )
+    return {record["idempotency_key"]: record["id"] for record in inserted}
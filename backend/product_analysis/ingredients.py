@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from .scanner import additive_scanner
+
+STATUS_SEVERITY = {"certified": 0, "clean": 1, "doubtful": 2, "haram": 3}
+
+# Детерминированные правила: нормализованный термин -> (статус, причина).
+# E-номера хранятся в виде "e120", названия — в нижнем регистре с "е" вместо "ё".
+SEED_RULES: Dict[str, Tuple[str, str]] = {
+    # Харам
+    "e120": ("haram", "Кармин (E120) получают из насекомых-кошенили"),
+    "кармин": ("haram", "Кармин (E120) получают из насекомых-кошенили"),
+    "кошениль": ("haram", "Кармин (E120) получают из насекомых-кошенили"),
+    "carmine": ("haram", "Кармин (E120) получают из насекомых-кошенили"),
+    "cochineal": ("haram", "Кармин (E120) получают из насекомых-кошенили"),
+    "свинина": ("haram", "Свинина"),
+    "свиной": ("haram", "Компонент свиного происхождения"),
+    "свиная": ("haram", "Компонент свиного происхождения"),
+    "свиное": ("haram", "Компонент свиного происхождения"),
+    "сало": ("haram", "Свиное сало"),
+    "бекон": ("haram", "Бекон (свинина)"),
+    "pork": ("haram", "Свинина"),
+    "lard": ("haram", "Свиное сало"),
+    "bacon": ("haram", "Бекон (свинина)"),
+    "спирт": ("haram", "Содержит спирт"),
+    "этиловый спирт": ("haram", "Содержит спирт"),
+    "alcohol": ("haram", "Содержит спирт"),
+    "ethanol": ("haram", "Содержит спирт"),
+    "вино": ("haram", "Содержит вино"),
+    "wine": ("haram", "Содержит вино"),
+    "коньяк": ("haram", "Содержит алкоголь"),
+    "ром": ("haram", "Содержит алкоголь"),
+    "rum": ("haram", "Содержит алкоголь"),
+    "ликер": ("haram", "Содержит алкоголь"),
+    "пиво": ("haram", "Содержит алкоголь"),
+    "алкоголь": ("haram", "Содержит алкоголь"),
+    # Сомнительные — зависят от происхождения сырья
+    "желатин": ("doubtful", "Желатин может быть свиного или нехаляльного происхождения"),
+    "gelatin": ("doubtful", "Желатин может быть свиного или нехаляльного происхождения"),
+    "gelatine": ("doubtful", "Желатин может быть свиного или нехаляльного происхождения"),
+    "e441": ("doubtful", "Желатин может быть свиного или нехаляльного происхождения"),
+    "e422": ("doubtful", "Глицерин может быть животного происхождения"),
+    "e470": ("doubtful", "Соли жирных кислот могут быть животного происхождения"),
+    "e471": ("doubtful", "Моно- и диглицериды жирных кислот могут быть животного происхождения"),
+    "e472": ("doubtful", "Эфиры глицеридов могут быть животного происхождения"),
+    "e473": ("doubtful", "Эфиры сахарозы и жирных кислот могут быть животного происхождения"),
+    "e475": ("doubtful", "Эфиры полиглицерина могут быть животного происхождения"),
+    "e476": ("doubtful", "Полирицинолеат полиглицерина может быть животного происхождения"),
+    "e477": ("doubtful", "Эфиры пропиленгликоля могут быть животного происхождения"),
+    "e481": ("doubtful", "Стеароиллактилат может быть животного происхождения"),
+    "e482": ("doubtful", "Стеароиллактилат может быть животного происхождения"),
+    "e542": ("doubtful", "Костный фосфат животного происхождения"),
+    "e570": ("doubtful", "Стеариновая кислота может быть животного происхождения"),
+    "e627": ("doubtful", "Гуанилат может быть получен из мяса или рыбы"),
+    "e631": ("doubtful", "Инозинат может быть получен из мяса или рыбы"),
+    "e635": ("doubtful", "Рибонуклеотиды могут быть получены из мяса или рыбы"),
+    "e904": ("doubtful", "Шеллак — выделения насекомых"),
+    "e920": ("doubtful", "L-цистеин может быть получен из волос или перьев"),
+    "e921": ("doubtful", "L-цистин может быть получен из волос или перьев"),
+    "сычужный фермент": ("doubtful", "Сычужный фермент животного происхождения"),
+    "ароматизатор": ("doubtful", "Ароматизаторы могут содержать спирт как растворитель"),
+    # Чистые
+    "вода": ("clean", ""),
+    "питьевая вода": ("clean", ""),
+    "сахар": ("clean", ""),
+    "соль": ("clean", ""),
+    "поваренная соль": ("clean", ""),
+    "мука пшеничная": ("clean", ""),
+    "пшеничная мука": ("clean", ""),
+    "крахмал": ("clean", ""),
+    "кукурузный крахмал": ("clean", ""),
+    "картофельный крахмал": ("clean", ""),
+    "какао-порошок": ("clean", ""),
+    "какао тертое": ("clean", ""),
+    "какао-масло": ("clean", ""),
+    "молоко": ("clean", ""),
+    "цельное молоко": ("clean", ""),
+    "сухое молоко": ("clean", ""),
+    "сухое обезжиренное молоко": ("clean", ""),
+    "сливки": ("clean", ""),
+    "яйца": ("clean", ""),
+    "меланж": ("clean", ""),
+    "растительное масло": ("clean", ""),
+    "подсолнечное масло": ("clean", ""),
+    "пальмовое масло": ("clean", ""),
+    "рапсовое масло": ("clean", ""),
+    "глюкозный сироп": ("clean", ""),
+    "фруктоза": ("clean", ""),
+    "декстроза": ("clean", ""),
+    "мед": ("clean", ""),
+    "дрожжи": ("clean", ""),
+    "уксус спиртовой": ("clean", ""),
+    "sugar": ("clean", ""),
+    "water": ("clean", ""),
+    "salt": ("clean", ""),
+    "wheat flour": ("clean", ""),
+    "e100": ("clean", ""),
+    "e160a": ("clean", ""),
+    "e170": ("clean", ""),
+    "e202": ("clean", ""),
+    "e211": ("clean", ""),
+    "e260": ("clean", ""),
+    "e270": ("clean", ""),
+    "e290": ("clean", ""),
+    "e296": ("clean", ""),
+    "e300": ("clean", ""),
+    "e322": ("clean", ""),
+    "e330": ("clean", ""),
+    "e331": ("clean", ""),
+    "e338": ("clean", ""),
+    "e412": ("clean", ""),
+    "e414": ("clean", ""),
+    "e415": ("clean", ""),
+    "e440": ("clean", ""),
+    "e450": ("clean", ""),
+    "e500": ("clean", ""),
+    "e501": ("clean", ""),
+    "e503": ("clean", ""),
+    "e951": ("clean", ""),
+    "e955": ("clean", ""),
+}
+
+_NOISE_RE = re.compile(r"[\s\*\.;:]+")
+
+
+def normalize(name: str) -> str:
+    text = name.lower().replace("ё", "е")
+    text = _NOISE_RE.sub(" ", text)
+    return text.strip(" ,-()")
+
+
+def worst_status(statuses: List[str]) -> Optional[str]:
+    statuses = [s for s in statuses if s in STATUS_SEVERITY]
+    if not statuses:
+        return None
+    return max(statuses, key=STATUS_SEVERITY.__getitem__)
+
+
+class IngredientIndex:
+    """Индекс ингредиентов и E-номеров с закэшированными вердиктами.
+
+    Правила из SEED_RULES детерминированы и не перезаписываются; вердикты,
+    полученные от модели, хранятся в таблице ingredient_verdicts и
+    подгружаются при первом обращении.
+    """
+
+    def __init__(self, seed: Dict[str, Tuple[str, str]] = SEED_RULES):
+        self._rules: Dict[str, Tuple[str, str]] = dict(seed)
+        self._learned: Dict[str, Tuple[str, str]] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def verdict(self, ingredient: str) -> Optional[Tuple[str, str]]:
+        key = normalize(ingredient)
+        if not key:
+            return None
+        exact = self._rules.get(key) or self._learned.get(key)
+        found = [exact] if exact else []
+        # E-номера и флаговые термины внутри составного ингредиента ("желатин говяжий", "краситель Е120")
+        for hit in additive_scanner.scan(key):
+            rule = self._rules.get(hit["term"]) or self._learned.get(hit["term"])
+            if rule:
+                found.append(rule)
+        if not found:
+            return None
+        status = worst_status([status for status, _ in found])
+        reasons = [reason for s, reason in found if s == status and reason]
+        return status, reasons[0] if reasons else ""
+
+    def lookup(self, ingredients: List[str]) -> Tuple[List[Tuple[str, str, str]], List[str]]:
+        """Делит состав на известные (ингредиент, статус, причина) и неизвестные ингредиенты."""
+        known, unknown = [], []
+        for ingredient in ingredients:
+            verdict = self.verdict(ingredient)
+            if verdict is None:
+                unknown.append(ingredient)
+            else:
+                known.append((ingredient, *verdict))
+        return known, unknown
+
+    def annotate(self, hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Дописывает к совпадениям сканера статус и причину из правил (None — добавка без вердикта)."""
+        for hit in hits:
+            rule = self._rules.get(hit["term"]) or self._learned.get(hit["term"])
+            hit["status"], hit["reason"] = rule if rule else (None, "")
+        return hits
+
+    def from_hits(self, hits: Optional[List[Dict[str, Any]]], ingredients: List[str]) -> List[Tuple[str, str, str]]:
+        """Харам и сомнительные термины из текста этикетки, которых нет в списке ингредиентов:
+        список мог прочитать vision или OCR порезал его не там, а сканер видел весь блок состава."""
+        covered = {hit["term"] for ingredient in ingredients for hit in additive_scanner.scan(ingredient)}
+        extra = []
+        for hit in hits or []:
+            if hit.get("status") in ("haram", "doubtful") and hit["term"] not in covered:
+                covered.add(hit["term"])
+                name = hit["term"].upper() if hit["category"] == "e_number" else hit["text"]
+                extra.append((name, hit["status"], hit["reason"]))
+        return extra
+
+    def learn(self, verdicts: Dict[str, Tuple[str, str]]) -> Dict[str, Tuple[str, str]]:
+        """Запоминает вердикты модели; возвращает только новые записи для сохранения в БД."""
+        fresh = {}
+        for ingredient, (status, reason) in verdicts.items():
+            key = normalize(ingredient)
+            if not key or status not in ("clean", "doubtful", "haram") or key in self._rules:
+                continue
+            if self._learned.get(key) != (status, reason):
+                self._learned[key] = (status, reason)
+                fresh[key] = (status, reason)
+        return fresh
+
+    async def load(self) -> None:
+        """Подгружает сохранённые вердикты из БД (один раз)."""
+        async with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            try:
+                from sqlalchemy import select
+                from auth.database import AsyncSessionLocal
+                from .models import IngredientVerdict
+                async with AsyncSessionLocal() as db:
+                    for row in await db.scalars(select(IngredientVerdict)):
+                        self._learned[row.key] = (row.status, row.reason or "")
+            except Exception as e:
+                logging.warning(f"Ingredient index: failed to load verdicts: {e}")
+
+    async def persist(self, verdicts: Dict[str, Tuple[str, str]]) -> None:
+        if not verdicts:
+            return
+        try:
+            from sqlalchemy import select
+            from auth.database import AsyncSessionLocal
+            from .models import IngredientVerdict
+            async with AsyncSessionLocal() as db:
+                existing = {row.key: row for row in await db.scalars(select(IngredientVerdict).where(IngredientVerdict.key.in_(list(verdicts))))}
+                for key, (status, reason) in verdicts.items():
+                    row = existing.get(key)
+                    if row is None:
+                        db.add(IngredientVerdict(key=key, status=status, reason=reason, source="llm"))
+                    else:
+                        row.status = status
+                        row.reason = reason
+                await db.commit()
+        except Exception as e:
+            logging.warning(f"Ingredient index: failed to persist verdicts: {e}")
+
+
+def local_decision(known: List[Tuple[str, str, str]], unknown: List[str]) -> Optional[Dict]:
+    """Вердикт без обращения к модели, если состав целиком известен либо в нём есть харам."""
+    haram = [(i, reason) for i, status, reason in known if status == "haram"]
+    if haram:
+        return {
+            "status": "haram",
+            "confidence": "высокая",
+            "concerns": [f"{i}: {reason}" for i, reason in haram],
+            "recommendation": "Продукт содержит харам ингредиенты. Не рекомендуется к употреблению."
+        }
+    if unknown:
+        return None
+    doubtful = [(i, reason) for i, status, reason in known if status == "doubtful"]
+    if doubtful:
+        return {
+            "status": "doubtful",
+            "confidence": "средняя",
+            "concerns": [f"{i}: {reason}" for i, reason in doubtful],
+            "recommendation": "Уточните происхождение сомнительных компонентов или поищите халяль сертификат."
+        }
+    return {
+        "status": "clean",
+        "confidence": "высокая",
+        "concerns": [],
+        "recommendation": "Состав чистый, но халяль сертификат не обнаружен."
+    }
+
+
+ingredient_index = IngredientIndex()
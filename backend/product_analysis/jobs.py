@@ -0,0 +1,269 @@
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from sqlalchemy import and_, func, or_, select, update
+
+from auth.database import AsyncSessionLocal
+from .models import AnalysisJob
+from .pipeline import analyze_upload
+from .preprocessing import InvalidImageError
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Задача в статусе running дольше аренды считается брошенной (воркер упал) и берётся заново
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 300))
+# Сколько задач одного владельца (пользователя или IP) может выполняться одновременно
+JOB_OWNER_CONCURRENCY = int(os.getenv("JOB_OWNER_CONCURRENCY", 2))
+JOB_WEBHOOK_RETRIES = int(os.getenv("JOB_WEBHOOK_RETRIES", 3))
+JOB_WEBHOOK_TIMEOUT = float(os.getenv("JOB_WEBHOOK_TIMEOUT", 10))
+# Хосты через запятую, на которые разрешены webhook'и (в том числе внутренние). Пусто — любой
+# хост с публичным адресом: иначе клиент мог бы заставить сервер ходить во внутреннюю сеть и метаданные облака
+JOB_WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+
+LEASE_EXPIRED_ERROR = "Job did not finish within its lease on the last attempt"
+
+PRIORITIES = {"high": 10, "normal": 5, "low": 0}
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def job_to_dict(job: AnalysisJob) -> Dict[str, Any]:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "priority": job.priority,
+        "attempts": job.attempts,
+        "result": job.result,
+        "error": job.error,
+        "webhook_status": job.webhook_status,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+
+async def check_webhook_url(url: str) -> None:
+    """ValueError, если webhook ведёт не на http(s) или на частный, loopback, link-local и т.п. адрес."""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("webhook_url must be an http(s) URL")
+    host = parts.hostname.lower()
+    if JOB_WEBHOOK_ALLOWED_HOSTS:
+        if host not in JOB_WEBHOOK_ALLOWED_HOSTS:
+            raise ValueError("webhook_url host is not allowed")
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError):
+        raise ValueError("webhook_url host cannot be resolved")
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if getattr(address, "ipv4_mapped", None):
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError("webhook_url must point to a public address")
+
+
+class JobQueue:
+    """Очередь анализов в таблице analysis_jobs.
+
+    На Postgres задачи забираются через SELECT ... FOR UPDATE SKIP LOCKED,
+    на SQLite (где FOR UPDATE игнорируется) от двойного захвата защищает
+    условный UPDATE по счётчику попыток.
+    """
+
+    async def enqueue(self, content: bytes, owner: str, priority: int, webhook_url: Optional[str] = None) -> Dict[str, Any]:
+        async with AsyncSessionLocal() as db:
+            job = AnalysisJob(
+                id=uuid.uuid4().hex,
+                owner=owner,
+                status="queued",
+                priority=priority,
+                image=content,
+                webhook_url=webhook_url,
+                attempts=0,
+                max_attempts=JOB_MAX_ATTEMPTS,
+                available_at=utcnow(),
+            )
+            db.add(job)
+            await db.commit()
+            await db.refresh(job)
+            return job_to_dict(job)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            job = await db.get(AnalysisJob, job_id)
+            return job_to_dict(job) if job else None
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            now = utcnow()
+            lease_expired = now - timedelta(seconds=JOB_LEASE_SECONDS)
+            busy_owners = (
+                select(AnalysisJob.owner)
+                .where(AnalysisJob.status == "running", AnalysisJob.locked_at > lease_expired)
+                .group_by(AnalysisJob.owner)
+                .having(func.count() >= JOB_OWNER_CONCURRENCY)
+            )
+            job = await db.scalar(
+                select(AnalysisJob)
+                .where(
+                    or_(
+                        and_(AnalysisJob.status == "queued", AnalysisJob.available_at <= now),
+                        and_(AnalysisJob.status == "running", AnalysisJob.locked_at <= lease_expired),
+                    ),
+                    AnalysisJob.owner.notin_(busy_owners),
+                )
+                .order_by(AnalysisJob.priority.desc(), AnalysisJob.created_at)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            if job is None:
+                await db.rollback()
+                return None
+            # Аренда истекла на последней попытке: задача роняет воркер или не укладывается во время,
+            # и новая попытка кончилась бы тем же — закрываем её, а не крутим бесконечно
+            exhausted = job.status == "running" and job.attempts >= job.max_attempts
+            if exhausted:
+                values = {"status": "failed", "error": LEASE_EXPIRED_ERROR, "finished_at": now, "image": None}
+            else:
+                values = {"status": "running", "locked_at": now, "attempts": job.attempts + 1}
+            claimed = await db.execute(
+                update(AnalysisJob)
+                .where(AnalysisJob.id == job.id, AnalysisJob.status == job.status, AnalysisJob.attempts == job.attempts)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            if not claimed.rowcount:
+                return None
+            return {
+                "id": job.id,
+                "image": job.image,
+                "attempts": job.attempts if exhausted else job.attempts + 1,
+                "max_attempts": job.max_attempts,
+                "webhook_url": job.webhook_url,
+                "exhausted": exhausted,
+            }
+
+    async def complete(self, job_id: str, result: Dict[str, Any]) -> None:
+        await self._update(job_id, status="done", result=result, error=None, finished_at=utcnow(), image=None)
+
+    async def fail(self, job_id: str, error: str, retry_in: Optional[float] = None) -> None:
+        if retry_in is None:
+            await self._update(job_id, status="failed", error=error, finished_at=utcnow(), image=None)
+        else:
+            await self._update(job_id, status="queued", error=error, available_at=utcnow() + timedelta(seconds=retry_in))
+
+    async def set_webhook_status(self, job_id: str, webhook_status: str) -> None:
+        await self._update(job_id, webhook_status=webhook_status)
+
+    async def _update(self, job_id: str, **values) -> None:
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(AnalysisJob).where(AnalysisJob.id == job_id).values(**values))
+            await db.commit()
+
+
+class JobWorkers:
+    """Фоновые воркеры внутри процесса приложения, разбирающие очередь analysis_jobs."""
+
+    def __init__(self, queue: JobQueue, get_agent: Callable[[], Any], count: int = JOB_WORKERS):
+        self.queue = queue
+        self.get_agent = get_agent
+        self.count = count
+        self._tasks = []
+        self._stopping = asyncio.Event()
+        self._http = None
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._http = httpx.AsyncClient(timeout=JOB_WEBHOOK_TIMEOUT)
+        self._tasks = [asyncio.create_task(self._run(i)) for i in range(self.count)]
+
+    async def stop(self) -> None:
+        # Незавершённые задачи останутся running и будут подобраны после истечения аренды
+        self._stopping.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _run(self, number: int) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = await self.queue.claim()
+            except Exception as e:
+                logging.error(f"Job worker {number}: failed to claim job: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            try:
+                await self._process(job)
+            except Exception as e:
+                # Обычно сбой БД при записи результата: задача останется running и вернётся после аренды
+                logging.error(f"Job worker {number}: failed to process job {job['id']}: {e}")
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def _process(self, job: Dict[str, Any]) -> None:
+        if job["exhausted"]:
+            logging.warning(f"Job {job['id']} failed: lease expired after {job['attempts']} attempts")
+            await self._notify(job, {"job_id": job["id"], "status": "failed", "error": LEASE_EXPIRED_ERROR})
+            return
+        try:
+            result = await analyze_upload(job["image"], self.get_agent(), wait=True)
+        except InvalidImageError:
+            await self.queue.fail(job["id"], "Uploaded file is not a valid image")
+            await self._notify(job, {"job_id": job["id"], "status": "failed", "error": "Uploaded file is not a valid image"})
+            return
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            logging.warning(f"Job {job['id']} attempt {job['attempts']} failed: {e}")
+            if job["attempts"] < job["max_attempts"]:
+                # При открытом breaker нет смысла повторять раньше, чем он попробует закрыться
+                await self.queue.fail(job["id"], str(e), max(2 ** job["attempts"], getattr(e, "retry_after", 0)))
+                return
+            await self.queue.fail(job["id"], str(e))
+            await self._notify(job, {"job_id": job["id"], "status": "failed", "error": str(e)})
+            return
+        await self.queue.complete(job["id"], result)
+        await self._notify(job, {"job_id": job["id"], "status": "done", "result": result})
+
+    async def _notify(self, job: Dict[str, Any], payload: Dict[str, Any]) -> None:
+        if not job["webhook_url"]:
+            return
+        try:
+            # Повторная проверка: DNS имени могли перенаправить на внутренний адрес после постановки задачи
+            await check_webhook_url(job["webhook_url"])
+        except ValueError as e:
+            logging.warning(f"Webhook for job {job['id']} rejected: {e}")
+            await self.queue.set_webhook_status(job["id"], "rejected")
+            return
+        for attempt in range(JOB_WEBHOOK_RETRIES):
+            try:
+                response = await self._http.post(job["webhook_url"], json=payload)
+                if response.status_code < 500:
+                    await self.queue.set_webhook_status(job["id"], f"delivered:{response.status_code}")
+                    return
+            except httpx.HTTPError as e:
+                logging.warning(f"Webhook for job {job['id']} failed: {e}")
+            await asyncio.sleep(2 ** attempt)
+        await self.queue.set_webhook_status(job["id"], "failed")
+
+
+job_queue = JobQueue()
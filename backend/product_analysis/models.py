@@ -1,15 +1,21 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, JSON, func
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, JSON, LargeBinary, Index, func
 from sqlalchemy.orm import relationship
 from auth.base import Base
 
 class ProductCheckHistory(Base):
     __tablename__ = "product_check_history"
+    __table_args__ = (
+        # Keyset-пагинация истории: WHERE user_id = ? ORDER BY date DESC, id DESC
+        Index("ix_product_check_history_user_date", "user_id", "date", "id"),
+        # Повторная синхронизация офлайн-очереди не создаёт дублей
+        Index("ix_product_check_history_user_idempotency", "user_id", "idempotency_key", unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     product_name = Column(String, nullable=True)
     brand = Column(String, nullable=True)
     status = Column(String, nullable=False)
-    date = Column(DateTime(timezone=True), server_default=func.now())
+    date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     image_url = Column(String, nullable=True)
     category = Column(String, nullable=True)
     ingredients = Column(JSON, nullable=True)
@@ -20,5 +26,58 @@ class ProductCheckHistory(Base):
     manufacturer = Column(String, nullable=True)
     country = Column(String, nullable=True)
     additional_notes = Column(String, nullable=True)
+    idempotency_key = Column(String, nullable=True)
 
-    user = relationship("User", backref="product_check_history") 
\ No newline at end of file
+    user = relationship("User", backref="product_check_history") 
+
+
+class IngredientVerdict(Base):
+    __tablename__ = "ingredient_verdicts"
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, unique=True, index=True, nullable=False)
+    status = Column(String, nullable=False)
+    reason = Column(String, nullable=True)
+    source = Column(String, nullable=False, default="llm")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    __table_args__ = (
+        Index("ix_analysis_jobs_claim", "status", "priority", "available_at"),
+    )
+    id = Column(String, primary_key=True)
+    owner = Column(String, nullable=False, index=True)
+    status = Column(String, nullable=False)
+    priority = Column(Integer, nullable=False, default=5)
+    image = Column(LargeBinary, nullable=True)
+    result = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    webhook_url = Column(String, nullable=True)
+    webhook_status = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    available_at = Column(DateTime(timezone=True), nullable=False)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class ProductCatalogEntry(Base):
+    __tablename__ = "product_catalog"
+    id = Column(Integer, primary_key=True, index=True)
+    barcode = Column(String, unique=True, index=True, nullable=False)
+    brand = Column(String, nullable=True)
+    product_name = Column(String, nullable=True)
+    manufacturer = Column(String, nullable=True)
+    country = Column(String, nullable=True)
+    ingredients = Column(JSON(none_as_null=True), nullable=True)
+    # Пустой статус — состав известен (например, из Open Food Facts), вердикт ещё не вычислен
+    status = Column(String, nullable=True)
+    confidence = Column(String, nullable=True)
+    concerns = Column(JSON(none_as_null=True), nullable=True)
+    recommendation = Column(String, nullable=True)
+    source = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Any, Dict, List, Tuple
+
+from .ingredients import ingredient_index
+from .scanner import additive_scanner
+
+OCR_FAST_PATH_ENABLED = os.getenv("OCR_FAST_PATH_ENABLED", "1") == "1"
+# Минимальная уверенность (0..1), при которой vision-запрос к GPT-4o пропускается
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", 0.75))
+OCR_MIN_INGREDIENTS = int(os.getenv("OCR_MIN_INGREDIENTS", 3))
+OCR_LANG = os.getenv("OCR_LANG", "rus+eng")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))
+# Сколько задач может ждать свободного процесса сверх OCR_WORKERS; дальше — 429
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", 2 * OCR_WORKERS))
+OCR_JOB_TIMEOUT = float(os.getenv("OCR_JOB_TIMEOUT", 15))
+
+# Конец блока состава; начало блока и стоп-слова ищет сканер (scanner.SECTION_TERMS)
+_SENTENCE_END_RE = re.compile(r"[.!?\n\r]")
+
+
+
+class OcrBusyError(RuntimeError):
+    pass
+
+
+class OcrTimeoutError(RuntimeError):
+    pass
+
+
+class OcrExecutor:
+    """Пул процессов для декодирования изображений и Tesseract, чтобы не блокировать event loop.
+
+    Очередь ограничена: если все процессы заняты и OCR_QUEUE_SIZE задач уже ждут,
+    submit сразу бросает OcrBusyError (роутер отвечает 429).
+    """
+
+    def __init__(self, workers: int = OCR_WORKERS, queue_size: int = OCR_QUEUE_SIZE, timeout: float = OCR_JOB_TIMEOUT):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self._slots = None
+        self._pool = None
+
+    async def warmup(self) -> int:
+        """Поднимает все процессы пула заранее: spawn и импорт PIL/Tesseract (около секунды на процесс)
+        иначе достаются первым запросам после старта. Возвращает число запущенных процессов."""
+        self.start()
+        futures = [asyncio.wrap_future(self._pool.submit(warm_worker)) for _ in range(self.workers)]
+        return len(set(await asyncio.wait_for(asyncio.gather(*futures), 60)))
+
+    def start(self) -> None:
+        if self._pool is None:
+            # spawn: форк процесса с потоками event loop/httpx небезопасен
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.capacity)
+
+    async def shutdown(self) -> None:
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+    async def submit(self, fn, *args, timeout: float = None, wait: bool = False):
+        """Выполняет fn(*args) в пуле. wait=True — ждать свободного слота вместо OcrBusyError (пакетные задачи).
+
+        Задачу, которая уже выполняется, по таймауту не прервать: вызывающий получает OcrTimeoutError,
+        а слот занят, пока процесс её не доделает, — иначе лимиты очереди не видели бы реальной нагрузки.
+        """
+        self.start()
+        if not wait and self._slots.locked():
+            raise OcrBusyError("OCR workers are saturated")
+        await self._slots.acquire()
+        self.pending += 1
+        released_later = False
+        try:
+            self.start()
+            pool = self._pool
+            try:
+                future = pool.submit(fn, *args)
+                try:
+                    return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+                except asyncio.TimeoutError:
+                    # Ещё не начатая задача отменяется, запущенная — нет
+                    if not future.cancel():
+                        future.add_done_callback(self._release_from_thread(asyncio.get_running_loop()))
+                        released_later = True
+                    raise OcrTimeoutError(f"OCR job exceeded {timeout or self.timeout}s")
+            except BrokenProcessPool:
+                # Воркер упал (OOM, segfault) — пересоздаём пул при следующей задаче
+                if self._pool is pool:
+                    logging.error("OCR process pool is broken, restarting")
+                    self._pool = None
+                    # Уцелевшие процессы сломанного пула сами не завершатся
+                    pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        finally:
+            if not released_later:
+                self._release()
+
+    def _release(self) -> None:
+        self.pending -= 1
+        self._slots.release()
+
+    def _release_from_thread(self, loop: asyncio.AbstractEventLoop):
+        # Колбэк concurrent.futures вызывается из служебного потока пула
+        def callback(_) -> None:
+            try:
+                loop.call_soon_threadsafe(self._release)
+            except RuntimeError:
+                # Цикл уже закрыт (остановка приложения) — освобождать нечего
+                pass
+        return callback
+
+
+ocr_executor = OcrExecutor()
+
+
+def parse_ingredients(text: str, hits: List[Dict[str, Any]] = None) -> Tuple[List[str], Tuple[int, int]]:
+    """Ищет блок "состав" и режет его на ингредиенты. Возвращает ингредиенты и границы блока в тексте.
+
+    hits — результат additive_scanner.scan(text), если он уже есть: начало блока и стоп-слова берутся из него.
+    """
+    if hits is None:
+        hits = additive_scanner.scan(text)
+    section = next((hit for hit in hits if hit["category"] == "section"), None)
+    if section is None:
+        return [], (0, 0)
+    start = section["end"]
+    while start < len(text) and (text[start] in ":-" or text[start].isspace()):
+        start += 1
+    if start >= len(text):
+        return [], (0, 0)
+    sentence_end = _SENTENCE_END_RE.search(text, start + 1)
+    end = sentence_end.start() if sentence_end else len(text)
+    # Иногда после слова "состав" идёт длинный текст, обрезаем по частым стоп-словам
+    stop = next((hit["start"] for hit in hits if hit["category"] == "stop" and start + 10 < hit["start"] < end), None)
+    if stop is not None:
+        end = stop
+    raw_ingredients = text[start:end]
+    # Очищаем и разбиваем
+    ingredients = [i.strip().capitalize() for i in re.split(r",|;|\n|\r", raw_ingredients) if 2 < len(i.strip()) < 50]
+    return ingredients, (start, end)
+
+
+def warm_worker() -> int:
+    # Импорты, которые нужны предобработке и OCR в процессе пула; в основном процессе они не нужны вовсе
+    from PIL import Image, ImageFilter, ImageOps, ImageStat  # noqa: F401
+    import pytesseract  # noqa: F401
+    from . import preprocessing  # noqa: F401
+    return os.getpid()
+
+
+def ocr_image(image_content: bytes) -> Dict[str, Any]:
+    """Синхронный OCR: текст по абзацам и уверенность Tesseract для слов блока "состав"."""
+    from PIL import Image, ImageOps
+    import pytesseract
+
+    # Для Tesseract полутон с растянутым контрастом читается заметно лучше цветного фото
+    image = ImageOps.autocontrast(Image.open(BytesIO(image_content)).convert("L"), cutoff=1)
+    try:
+        # timeout у pytesseract убивает зависший процесс tesseract и освобождает воркер
+        data = pytesseract.image_to_data(image, lang=OCR_LANG, output_type=pytesseract.Output.DICT, timeout=OCR_JOB_TIMEOUT)
+    except Exception as e:
+        # Исключения pytesseract не переживают pickle и роняют весь пул процессов
+        raise RuntimeError(f"Tesseract failed: {e}")
+
+    # Склеиваем строки одного абзаца (с учётом переносов), абзацы разделяем "\n"
+    text, words, paragraph = "", [], None
+    for i, word in enumerate(data["text"]):
+        word = word.strip().lower()
+        if not word:
+            continue
+        current = (data["block_num"][i], data["par_num"][i])
+        if paragraph is not None and current != paragraph:
+            text += "\n"
+        elif text and not text.endswith("\n"):
+            if text.endswith("-"):
+                text = text[:-1]
+            else:
+                text += " "
+        paragraph = current
+        words.append((len(text), float(data["conf"][i])))
+        text += word
+
+    logging.debug(f"[OCR TEXT] {text}")
+    hits = additive_scanner.scan(text)
+    ingredients, (start, end) = parse_ingredients(text, hits)
+    confidences = [conf for offset, conf in words if start <= offset < end and conf >= 0]
+    return {
+        "text": text,
+        "ingredients": ingredients,
+        "word_confidence": sum(confidences) / len(confidences) / 100 if confidences else 0.0,
+        # Добавки и флаговые термины со спанами в text; статус дописывает run_ocr по индексу ингредиентов
+        "additives": [{**hit, "in_composition": start <= hit["start"] < end}
+                      for hit in hits if hit["category"] not in ("section", "stop")],
+    }
+
+
+def score_ocr(result: Dict[str, Any]) -> float:
+    """Оценка (0..1) того, что OCR надёжно прочитал состав."""
+    ingredients = result["ingredients"]
+    if not ingredients:
+        return 0.0
+    known, _ = ingredient_index.lookup(ingredients)
+    known_ratio = len(known) / len(ingredients)
+    # Доля ингредиентов, похожих на слова, а не на мусор распознавания
+    plausible = sum(1 for i in ingredients if sum(c.isalpha() for c in i) >= 0.7 * len(i.replace(" ", "")))
+    shape_ratio = plausible / len(ingredients)
+    score = 0.5 * result["word_confidence"] + 0.3 * known_ratio + 0.2 * shape_ratio
+    if len(ingredients) < OCR_MIN_INGREDIENTS:
+        score *= len(ingredients) / OCR_MIN_INGREDIENTS
+    return score
+
+
+async def run_ocr(image_content: bytes, wait: bool = False) -> Dict[str, Any]:
+    await ingredient_index.load()
+    result = await ocr_executor.submit(ocr_image, image_content, wait=wait)
+    ingredient_index.annotate(result["additives"])
+    result["score"] = score_ocr(result)
+    return result
+
+
+def accept_ocr(result: Dict[str, Any]) -> bool:
+    return result["score"] >= OCR_MIN_CONFIDENCE and len(result["ingredients"]) >= OCR_MIN_INGREDIENTS
@@ -0,0 +1,131 @@
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Tuple, Union
+
+from observability import ANALYZE_IN_PROGRESS, stage
+from .agent import ProductAnalysisAgent
+from .cache import analysis_cache
+from .catalog import entry_to_result, product_catalog
+from .ocr import ocr_executor
+from .preprocessing import preprocess_image
+from .resilience import llm_budget
+from .singleflight import image_flights
+
+
+async def prepare_upload(source: Union[bytes, str], wait: bool = False) -> Dict[str, Any]:
+    """Ориентация, уменьшение и пересжатие; заодно ключ кэша: sha256 байтов + перцептивный хэш.
+
+    source — байты фото или путь к загрузке на диске; дальше по конвейеру идёт только пересжатое фото.
+
+    Бросает InvalidImageError для нечитаемых файлов и OcrBusyError, если пул
+    OCR переполнен (при wait=True задача вместо этого ждёт свободного слота).
+    """
+    with stage("preprocess"):
+        return await ocr_executor.submit(preprocess_image, source, wait=wait)
+
+
+async def cached_result(prepared: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    with stage("cache"):
+        cached = await analysis_cache.get(prepared["cache_key"], prepared["phash"], prepared.get("barcode"))
+    if cached is None:
+        return None
+    return {**cached, "metadata": {**cached.get("metadata", {}), "tier": "cache"}}
+
+
+def is_degraded(result: Dict[str, Any]) -> bool:
+    # Ответ без OpenAI (только OCR и индекс) не кэшируем: при следующей проверке модель уже может ответить
+    return isinstance(result, dict) and "degraded" in (result.get("metadata") or {})
+
+
+async def store_result(prepared: Dict[str, Any], result: Dict[str, Any]) -> None:
+    if isinstance(result, dict) and result.get("ingredients") and not is_degraded(result):
+        await analysis_cache.set(prepared["cache_key"], prepared["phash"], result)
+
+
+async def lookup_barcode(barcode: str, agent: ProductAnalysisAgent, metadata: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+    """Результат из каталога по штрихкоду. Если известен только состав, классифицирует его без vision."""
+    started = time.perf_counter()
+    with stage("catalog"):
+        entry = await product_catalog.lookup(barcode)
+    if entry is None:
+        return None
+    result = entry_to_result(entry)
+    result["metadata"] = {**(metadata or {}), **result["metadata"],
+                          "catalog_ms": round((time.perf_counter() - started) * 1000, 1)}
+    if entry["status"] is None:
+        if not entry["ingredients"]:
+            return None
+        with llm_budget():
+            result = {**await agent.build_result(entry, result["metadata"]), "barcode": barcode}
+        if not is_degraded(result):
+            await product_catalog.record(barcode, result, "analysis")
+    return result
+
+
+async def record_barcode(prepared: Dict[str, Any], result: Dict[str, Any]) -> None:
+    if prepared.get("barcode") and isinstance(result, dict):
+        result["barcode"] = prepared["barcode"]
+        if is_degraded(result):
+            return
+        await product_catalog.record(prepared["barcode"], result, "analysis")
+
+
+async def analyze_upload(source: Union[bytes, str], agent: ProductAnalysisAgent, wait: bool = False) -> Dict[str, Any]:
+    """Полный путь одного фото: предобработка -> кэш -> каталог по штрихкоду -> агент -> запись в кэш и каталог."""
+    with ANALYZE_IN_PROGRESS.track_inprogress(), stage("total"):
+        prepared = await prepare_upload(source, wait=wait)
+        cached = await cached_result(prepared)
+        if cached is not None:
+            return cached
+        metadata = {"preprocessing": prepared["stats"]}
+        if prepared.get("barcode"):
+            found = await lookup_barcode(prepared["barcode"], agent, metadata)
+            if found is not None:
+                await store_result(prepared, found)
+                return found
+        return await analyze_shared(prepared, agent, metadata, wait)
+
+
+async def analyze_fresh(prepared: Dict[str, Any], agent: ProductAnalysisAgent, metadata: Dict[str, Any], wait: bool = False) -> Dict[str, Any]:
+    with llm_budget():
+        result = await agent.analyze_image(prepared["content"], prepared["mime_type"], metadata, wait=wait)
+    await record_barcode(prepared, result)
+    await store_result(prepared, result)
+    return result
+
+
+async def analyze_shared(prepared: Dict[str, Any], agent: ProductAnalysisAgent, metadata: Dict[str, Any], wait: bool = False) -> Dict[str, Any]:
+    """analyze_fresh, склеенный с уже идущим анализом того же фото (тот же sha256 или близкий dHash и тот же штрихкод).
+
+    Работа доводится до записи в кэш и каталог, даже если все клиенты отключились.
+    """
+    def joined(result: Dict[str, Any]) -> Dict[str, Any]:
+        if isinstance(result, dict):
+            result["metadata"] = {**(result.get("metadata") or {}), "tier": "coalesced",
+                                  "preprocessing": metadata["preprocessing"]}
+        return result
+
+    return await image_flights.do(prepared["cache_key"], lambda: analyze_fresh(prepared, agent, metadata, wait),
+                                  phash=prepared["phash"], on_join=joined, group=prepared.get("barcode"))
+
+
+async def stream_prepared(prepared: Dict[str, Any], agent: ProductAnalysisAgent) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Потоковый вариант analyze_upload для уже подготовленного фото."""
+    metadata = {"preprocessing": prepared["stats"]}
+    found = await cached_result(prepared)
+    if found is None and prepared.get("barcode"):
+        found = await lookup_barcode(prepared["barcode"], agent, metadata)
+        if found is not None:
+            await store_result(prepared, found)
+    if found is None and image_flights.joinable(prepared["cache_key"], prepared["phash"], prepared.get("barcode")):
+        # Это фото уже анализируется без потока: ждём общий результат вместо второго вызова модели
+        found = await analyze_shared(prepared, agent, metadata)
+    if found is not None:
+        yield "extraction", {key: found.get(key) for key in ("brand", "product_name", "manufacturer", "country", "ingredients", "metadata")}
+        yield "result", found
+        return
+    with llm_budget():
+        async for event, data in agent.analyze_image_stream(prepared["content"], prepared["mime_type"], metadata):
+            if event == "result":
+                await record_barcode(prepared, data)
+                await store_result(prepared, data)
+            yield event, data
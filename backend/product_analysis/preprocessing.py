@@ -0,0 +1,109 @@
+import os
+import time
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Dict, Union
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+from .cache import content_hash, file_hash, perceptual_hash_image
+from .catalog import decode_barcode
+
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1600))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+IMAGE_CROP_ENABLED = os.getenv("IMAGE_CROP_ENABLED", "1") == "1"
+
+MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+# Форматы, которые vision-модель принимает как есть
+SOURCE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def crop_to_label(image: "Image.Image") -> "Image.Image":
+    """Обрезает однородный фон вокруг упаковки по границам найденных контуров.
+
+    Контуры ищутся на уменьшенной копии, обрезается исходное изображение,
+    чтобы после уменьшения до IMAGE_MAX_DIMENSION на текст пришлось больше пикселей.
+    """
+    from PIL import ImageFilter
+    proxy = image.convert("L")
+    proxy.thumbnail((512, 512))
+    edges = proxy.filter(ImageFilter.FIND_EDGES).point(lambda p: 255 if p > 40 else 0)
+    # Рамка в 1px после свёртки копирует исходные пиксели — её не учитываем
+    bbox = edges.crop((1, 1, proxy.size[0] - 1, proxy.size[1] - 1)).getbbox()
+    if not bbox:
+        return image
+    scale = image.size[0] / proxy.size[0]
+    width, height = image.size
+    margin = int(0.02 * max(width, height))
+    left, top, right, bottom = (int((v + 1) * scale) for v in bbox)
+    left, top = max(0, left - margin), max(0, top - margin)
+    right, bottom = min(width, right + margin), min(height, bottom + margin)
+    area = (right - left) * (bottom - top)
+    # Режем, только если это заметно уменьшает картинку и не похоже на ошибку
+    if 0.15 * width * height <= area <= 0.9 * width * height:
+        return image.crop((left, top, right, bottom))
+    return image
+
+
+def preprocess_image(source: Union[bytes, str]) -> Dict[str, Any]:
+    """Готовит фото для OCR и vision: ориентация по EXIF, уменьшение, обрезка, пересжатие.
+
+    Выполняется в пуле процессов; заодно считает ключи кэша и читает штрихкод,
+    чтобы не декодировать фото повторно. source — байты или путь к загрузке,
+    сброшенной на диск (uploads.receive_image): большой файл не копируется между процессами.
+    """
+    # PIL нужен только процессам пула: основной процесс импортирует модуль ради InvalidImageError
+    from PIL import Image, ImageOps
+
+    started = time.perf_counter()
+    on_disk = isinstance(source, str)
+    try:
+        source_size = os.path.getsize(source) if on_disk else len(source)
+        image_file = Image.open(source if on_disk else BytesIO(source))
+        oriented = image_file.getexif().get(0x0112, 1) == 1
+        image = ImageOps.exif_transpose(image_file)
+    except Exception as e:
+        raise InvalidImageError(f"Cannot decode image: {e}")
+    original_size = image.size
+    # Штрихкод ищем на полном кадре: после уменьшения тонкие штрихи сливаются
+    barcode = decode_barcode(image)
+
+    if IMAGE_CROP_ENABLED:
+        image = crop_to_label(image)
+    image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    fmt = IMAGE_FORMAT if IMAGE_FORMAT in MIME_TYPES else "jpeg"
+    buffer = BytesIO()
+    image.save(buffer, format=fmt.upper(), quality=IMAGE_QUALITY, optimize=True)
+    content = buffer.getvalue()
+    mime_type = MIME_TYPES[fmt]
+    # Небольшое фото, которое не пришлось поворачивать и обрезать, пересжатие только раздует
+    if oriented and image.size == original_size and len(content) >= source_size and image_file.format in SOURCE_MIME_TYPES:
+        mime_type = SOURCE_MIME_TYPES[image_file.format]
+        if on_disk:
+            with open(source, "rb") as f:
+                content = f.read()
+        else:
+            content = source
+
+    return {
+        "content": content,
+        "mime_type": mime_type,
+        "cache_key": file_hash(source) if on_disk else content_hash(source),
+        "phash": perceptual_hash_image(image),
+        "barcode": barcode,
+        "stats": {
+            "bytes_in": source_size,
+            "bytes_out": len(content),
+            "size_in": list(original_size),
+            "size_out": list(image.size),
+            "preprocess_ms": round((time.perf_counter() - started) * 1000, 1),
+        },
+    }
@@ -0,0 +1,341 @@
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+# Сколько всего может занять анализ одного фото вместе с повторами; дальше — деградация или 503
+LLM_BUDGET_SECONDS = float(os.getenv("LLM_BUDGET_SECONDS", 45))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 0.5))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", 8))
+# Дублирующий запрос, если первый не ответил за LLM_HEDGE_DELAY (0 — за p95 последних ответов)
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", 0))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+# Подряд идущие сбои, после которых перестаём ходить в OpenAI на LLM_BREAKER_RESET_SECONDS
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", 30))
+# Квота аккаунта OpenAI на процесс (0 — без ограничения). При нескольких воркерах делите квоту на их число
+LLM_RATE_RPM = int(os.getenv("LLM_RATE_RPM", 0))
+LLM_RATE_TPM = int(os.getenv("LLM_RATE_TPM", 0))
+# Оценка токенов одной картинки до ответа модели; после ответа учитываем реальный usage
+LLM_IMAGE_TOKEN_ESTIMATE = int(os.getenv("LLM_IMAGE_TOKEN_ESTIMATE", 1000))
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    # openai импортируется ~0.7 с: грузим его при первом запросе к модели (или в прогреве), а не при старте
+    import openai
+    return (
+        openai.APIConnectionError,  # включая APITimeoutError
+        openai.RateLimitError,
+        openai.InternalServerError,
+        asyncio.TimeoutError,
+    )
+
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("llm_deadline", default=None)
+
+
+class LLMUnavailableError(Exception):
+    """OpenAI сейчас не может ответить: открыт breaker, исчерпан бюджет времени или повторы."""
+
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@contextmanager
+def llm_budget(seconds: float = LLM_BUDGET_SECONDS):
+    """Общий срок для всех запросов к модели внутри блока; вложенный блок срок не продлевает."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        try:
+            _deadline.reset(token)
+        except ValueError:
+            # Потоковый генератор закрыт из другого контекста — там переменная и так не видна
+            pass
+
+
+def remaining_budget() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    tokens = request.get("max_tokens") or 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                tokens += LLM_IMAGE_TOKEN_ESTIMATE
+            else:
+                # Кириллица в среднем ~3 символа на токен
+                tokens += len(part.get("text") or "") // 3
+    return tokens
+
+
+def retry_after_header(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if response.headers.get("retry-after-ms"):
+            return float(response.headers["retry-after-ms"]) / 1000
+        if response.headers.get("retry-after"):
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class TokenBucket:
+    """Ведро на rate единиц в минуту. Ожидание не выходит за бюджет запроса."""
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+        self.waits = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, amount: float) -> bool:
+        if not self.enabled:
+            return True
+        self._refill()
+        return self.tokens >= min(amount, self.capacity)
+
+    def take(self, amount: float) -> None:
+        if self.enabled:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta: float) -> None:
+        """Поправка после ответа: фактический расход отличается от оценки (может увести в минус)."""
+        if self.enabled:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+    async def acquire(self, amount: float) -> None:
+        if not self.enabled:
+            return
+        amount = min(amount, self.capacity)
+        # Под замком ждём по очереди: иначе мелкие запросы бесконечно обгоняют крупные
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+                budget = remaining_budget()
+                if budget is not None and wait > budget:
+                    raise LLMUnavailableError("OpenAI rate limit quota exhausted", retry_after=wait)
+                self.waits += 1
+                await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """closed -> open после LLM_BREAKER_FAILURES сбоев подряд -> half_open через reset_seconds:
+    пропускаем один пробный запрос, его успех закрывает breaker, сбой снова открывает.
+    """
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.threshold = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return max(1.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                raise LLMUnavailableError("OpenAI circuit breaker is open", retry_after=self.retry_after())
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                raise LLMUnavailableError("OpenAI circuit breaker is half-open", retry_after=1)
+            self._probing = True
+
+    def success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logging.warning(f"OpenAI circuit breaker opened after {self.failures} failures")
+                self.opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release(self) -> None:
+        """Пробный запрос завершился ошибкой, не связанной с доступностью OpenAI (например, 400)."""
+        self._probing = False
+
+
+class ResilientLLM:
+    """Обёртка над вызовами OpenAI: повторы с джиттером, hedging, breaker и квоты в пределах бюджета запроса."""
+
+    def __init__(self, attempt_timeout: float, window: int = 500):
+        self.attempt_timeout = attempt_timeout
+        self.breaker = CircuitBreaker()
+        self.requests = TokenBucket(LLM_RATE_RPM)
+        self.tokens = TokenBucket(LLM_RATE_TPM)
+        self.latencies = deque(maxlen=window)
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "budget_exhausted": 0,
+                         "hedges": 0, "hedge_wins": 0, "degraded": 0}
+
+    def hedge_delay(self) -> Optional[float]:
+        if not LLM_HEDGE_ENABLED:
+            return None
+        if LLM_HEDGE_DELAY > 0:
+            return LLM_HEDGE_DELAY
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def timeout(self) -> float:
+        budget = remaining_budget()
+        if budget is None:
+            return self.attempt_timeout
+        if budget <= 0:
+            self.counters["budget_exhausted"] += 1
+            raise LLMUnavailableError("LLM latency budget exhausted")
+        return min(self.attempt_timeout, budget)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        # Full jitter: разносим повторы одновременно упавших запросов во времени
+        delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+        return max(delay, retry_after_header(error) or 0)
+
+    def record_usage(self, estimated: int, usage) -> None:
+        if usage is not None and usage.total_tokens:
+            self.tokens.adjust(usage.total_tokens - estimated)
+
+    def record_degraded(self) -> None:
+        self.counters["degraded"] += 1
+
+    async def call(self, send: Callable[[float], Awaitable[Any]], request: Dict[str, Any], hedge: bool = True):
+        """send(timeout) выполняет одну попытку. Повторяемые ошибки после всех попыток — LLMUnavailableError."""
+        estimated = estimate_tokens(request)
+        self.counters["calls"] += 1
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                self.breaker.before_call()
+            except LLMUnavailableError:
+                self.counters["rejected"] += 1
+                raise
+            try:
+                timeout = self.timeout()
+                await self.requests.acquire(1)
+                await self.tokens.acquire(estimated)
+                # Ожидание квоты съело часть бюджета
+                timeout = min(timeout, self.timeout())
+                started = time.monotonic()
+                response = await self.attempt(send, timeout, estimated, hedge)
+            except retryable_errors() as e:
+                self.breaker.failure()
+                self.counters["failures"] += 1
+                delay = self.backoff(attempt, e)
+                budget = remaining_budget()
+                if attempt == LLM_MAX_RETRIES or (budget is not None and delay >= budget):
+                    raise LLMUnavailableError(f"OpenAI request failed: {e.__class__.__name__}", retry_after=max(1, delay)) from e
+                logging.warning(f"OpenAI attempt {attempt + 1} failed ({e!r}), retrying in {delay:.2f}s")
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.success()
+            self.latencies.append(time.monotonic() - started)
+            self.record_usage(estimated, getattr(response, "usage", None))
+            return response
+
+    async def attempt(self, send: Callable[[float], Awaitable[Any]], timeout: float, estimated: int, hedge: bool):
+        delay = self.hedge_delay() if hedge else None
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(send(timeout), timeout)
+        deadline = time.monotonic() + timeout
+        primary = asyncio.ensure_future(asyncio.wait_for(send(timeout), timeout))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            # Дубль отправляем, только если квота позволяет сделать это без ожидания
+            if not done and self.requests.available(1) and self.tokens.available(estimated):
+                self.requests.take(1)
+                self.tokens.take(estimated)
+                self.counters["hedges"] += 1
+                left = deadline - time.monotonic()
+                pending.add(asyncio.ensure_future(asyncio.wait_for(send(left), left)))
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, chunks: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Дочитывает поток в пределах бюджета; обрыв посреди ответа считается сбоем для breaker."""
+        iterator = chunks.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), self.timeout())
+            except StopAsyncIteration:
+                return
+            except retryable_errors() as e:
+                self.breaker.failure()
+                self.counters["failures"] += 1
+                raise LLMUnavailableError(f"OpenAI stream failed: {e.__class__.__name__}") from e
+            yield chunk
+
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        return {
+            **self.counters,
+            "breaker_state": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "rate_limit_waits": self.requests.waits + self.tokens.waits,
+            "latency_p50_s": ordered[len(ordered) // 2] if ordered else None,
+            "latency_p95_s": ordered[int(0.95 * (len(ordered) - 1))] if ordered else None,
+            "hedge_delay_s": self.hedge_delay(),
+        }
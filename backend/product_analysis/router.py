@@ -1,28 +1,74 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Query, Request, Response
 from .agent import ProductAnalysisAgent
-from .schemas import ProductAnalysisResponse, ProductCheckHistoryCreate, ProductCheckHistoryResponse
+from .pipeline import analyze_upload, lookup_barcode, prepare_upload, stream_prepared
+from .catalog import normalize_barcode
+from .schemas import (
+    ProductAnalysisResponse, ProductCheckHistoryBatch, ProductCheckHistoryBatchOutcome,
+    ProductCheckHistoryCreate, ProductCheckHistoryResponse,
+)
 from .models import ProductCheckHistory
-from auth.database import SessionLocal
-from sqlalchemy.orm import Session
+from .cache import analysis_cache, content_hash
+from .experiments import mode_stats
+from .preprocessing import InvalidImageError
+from .ocr import OcrBusyError
+from .resilience import LLMUnavailableError
+from .singleflight import halal_flights, image_flights
+from .routing import route_stats
+from .jobs import PRIORITIES, check_webhook_url, job_queue
+from .uploads import (
+    ZIP_MAGIC, NotAnImageError, peek, read_image_bytes, receive_image, received_image, release_image, store_file,
+)
+from .history import (
+    HISTORY_BATCH_MAX_ITEMS, HISTORY_DEFAULT_LIMIT, HISTORY_MAX_LIMIT, HISTORY_STATUSES,
+    fetch_history, parse_fields, save_history_batch,
+)
+from auth.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from datetime import datetime
+import asyncio
 import json
 import logging
+import os
 import ast
+import time
+import zipfile
+from contextlib import AsyncExitStack
 from fastapi import status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
 router = APIRouter(prefix="/products", tags=["products"])
 
-def get_agent():
-    return ProductAnalysisAgent()
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 50))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 200 * 1024 * 1024))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".heic", ".bmp", ".gif")
+
+
+def llm_unavailable(error: LLMUnavailableError) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Analysis service is temporarily unavailable, try again later",
+                         headers={"Retry-After": str(max(1, round(error.retry_after)))})
+
+def get_agent(request: Request) -> ProductAnalysisAgent:
+    # Агент создаётся один раз в lifespan (main.py); в тестах подменяется через dependency_overrides
+    return request.app.state.agent
 
 @router.post("/analyze")
 async def analyze_product(
     image: UploadFile = File(...),
     agent: ProductAnalysisAgent = Depends(get_agent)
 ):
-    if not image.content_type.startswith('image/'):
+    try:
+        async with received_image(image) as received:
+            result = await analyze_upload(received["source"], agent)
+    except NotAnImageError:
         raise HTTPException(status_code=400, detail="Uploaded file must be an image")
-    content = await image.read()
-    result = await agent.analyze_image(content)
+    except InvalidImageError:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+    except OcrBusyError:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+    except LLMUnavailableError as e:
+        raise llm_unavailable(e)
     try:
         # Если результат уже словарь, возвращаем его напрямую
         if isinstance(result, dict):
@@ -33,12 +79,202 @@ async def analyze_product(
         logging.error(f"OpenAI raw result: {result}")
         raise HTTPException(status_code=500, detail=f"Failed to parse analysis result: {result}")
 
+@router.post("/analyze/stream")
+async def analyze_product_stream(
+    image: UploadFile = File(...),
+    agent: ProductAnalysisAgent = Depends(get_agent)
+):
+    """Server-Sent Events: extraction, затем halal_delta по мере генерации вердикта и итоговый result.
+
+    halal_escalation означает, что вердикт пересчитывается более сильной моделью: накопленный текст надо сбросить.
+    """
+    # Ошибки до начала потока отдаём обычными HTTP-статусами; загрузка нужна только до предобработки
+    try:
+        async with received_image(image) as received:
+            prepared = await prepare_upload(received["source"])
+    except NotAnImageError:
+        raise HTTPException(status_code=400, detail="Uploaded file must be an image")
+    except InvalidImageError:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+    except OcrBusyError:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+
+    async def events():
+        try:
+            async for event, data in stream_prepared(prepared, agent):
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        except LLMUnavailableError as e:
+            logging.warning(f"Streaming analysis degraded to error: {e}")
+            yield f"event: error\ndata: {json.dumps({'detail': 'Analysis service is temporarily unavailable', 'retry_after': e.retry_after})}\n\n"
+        except Exception as e:
+            logging.exception(f"Streaming analysis failed: {e}")
+            yield f"event: error\ndata: {json.dumps({'detail': 'Analysis failed'})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def read_zip(file) -> List[tuple]:
+    """Фото из архива: небольшие — в память, остальные распаковываются во временные файлы."""
+    items, total = [], 0
+    try:
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                total += info.file_size
+                if len(items) >= BATCH_MAX_ITEMS or total > BATCH_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Batch is too large")
+                with archive.open(info) as entry:
+                    items.append((info.filename, store_file(entry, info.file_size)))
+    except BaseException:
+        for _, received in items:
+            release_image(received)
+        raise
+    return items
+
+@router.post("/analyze/batch")
+async def analyze_batch(
+    images: List[UploadFile] = File(...),
+    agent: ProductAnalysisAgent = Depends(get_agent)
+):
+    started = time.perf_counter()
+    async with AsyncExitStack() as uploads:
+        files, total = [], 0
+        for upload in images:
+            if await peek(upload, len(ZIP_MAGIC)) == ZIP_MAGIC:
+                try:
+                    entries = await run_in_threadpool(read_zip, upload.file)
+                except zipfile.BadZipFile:
+                    raise HTTPException(status_code=400, detail=f"{upload.filename} is not a valid zip archive")
+            else:
+                try:
+                    entries = [(upload.filename, await receive_image(upload))]
+                except NotAnImageError:
+                    # Не фото — ошибка этого элемента, а не всего пакета
+                    entries = [(upload.filename, None)]
+            for filename, received in entries:
+                files.append((filename, received))
+                if received is not None:
+                    uploads.callback(release_image, received)
+                    total += received["size"]
+            if total > BATCH_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Batch is too large")
+        if not files:
+            raise HTTPException(status_code=400, detail="No images in batch")
+        if len(files) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} images per batch")
+        return await analyze_files(files, agent, started)
+
+
+async def analyze_files(files: List[tuple], agent: ProductAnalysisAgent, started: float) -> dict:
+    # Одинаковые фото внутри пакета анализируем один раз; у сброшенных на диск sha256 посчитан при копировании
+    files_keys = [received and (received["sha256"] or content_hash(received["source"])) for _, received in files]
+    first_index, unique = {}, {}
+    for index, ((_, received), key) in enumerate(zip(files, files_keys)):
+        if key is not None and key not in first_index:
+            first_index[key] = index
+            unique[key] = received["source"]
+
+    async def run(source) -> dict:
+        try:
+            return {"status": "ok", "result": await analyze_upload(source, agent, wait=True)}
+        except InvalidImageError:
+            return {"status": "error", "error": "Uploaded file is not a valid image"}
+        except LLMUnavailableError:
+            return {"status": "error", "error": "Analysis service is temporarily unavailable"}
+        except Exception as e:
+            logging.exception(f"Batch item failed: {e}")
+            return {"status": "error", "error": "Analysis failed"}
+
+    keys = list(unique)
+    outcomes = dict(zip(keys, await asyncio.gather(*(run(unique[key]) for key in keys))))
+
+    items = []
+    for index, ((filename, _), key) in enumerate(zip(files, files_keys)):
+        outcome = outcomes[key] if key is not None else {"status": "error", "error": "Uploaded file must be an image"}
+        item = {"index": index, "filename": filename, **outcome}
+        if key is not None and first_index[key] != index:
+            item["duplicate_of"] = first_index[key]
+        items.append(item)
+    return {
+        "items": items,
+        "total": len(files),
+        "unique": len(keys),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+@router.post("/analyze/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_analysis_job(
+    request: Request,
+    image: UploadFile = File(...),
+    priority: str = Form("normal"),
+    webhook_url: Optional[str] = Form(None),
+):
+    """Ставит анализ в очередь; результат — через GET /analyze/jobs/{job_id} или POST на webhook_url."""
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of: {', '.join(PRIORITIES)}")
+    if webhook_url:
+        try:
+            await check_webhook_url(webhook_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        async with received_image(image) as received:
+            # Фото хранится в строке задачи до её выполнения, так что здесь без байтов не обойтись
+            content = await run_in_threadpool(read_image_bytes, received)
+    except NotAnImageError:
+        raise HTTPException(status_code=400, detail="Uploaded file must be an image")
+    # Эндпоинты анализа анонимные, поэтому лимит параллельных задач считается по IP клиента
+    owner = request.client.host if request.client else "unknown"
+    return await job_queue.enqueue(content, owner, PRIORITIES[priority], webhook_url)
+
+@router.get("/analyze/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/barcode/{barcode}")
+async def analyze_barcode(
+    barcode: str,
+    agent: ProductAnalysisAgent = Depends(get_agent)
+):
+    """Вердикт по штрихкоду без фото: один запрос к каталогу по индексу, LLM не вызывается для известных товаров."""
+    normalized = normalize_barcode(barcode)
+    if normalized is None:
+        raise HTTPException(status_code=400, detail="Invalid barcode")
+    try:
+        result = await lookup_barcode(normalized, agent)
+    except LLMUnavailableError as e:
+        raise llm_unavailable(e)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Product not found, analyze a photo of the label instead")
+    return result
+
+@router.get("/cache/stats")
+async def cache_stats():
+    return await analysis_cache.stats()
+
+@router.get("/modes/stats")
+def analysis_mode_stats():
+    return mode_stats.stats()
+
+@router.get("/llm/stats")
+def llm_stats(agent: ProductAnalysisAgent = Depends(get_agent)):
+    return agent.llm.stats()
+
+@router.get("/routing/stats")
+def routing_stats():
+    return route_stats.stats()
+
+@router.get("/coalescing/stats")
+def coalescing_stats():
+    return {"image": image_flights.stats(), "halal": halal_flights.stats()}
+
 @router.post("/history", response_model=ProductCheckHistoryResponse, status_code=status.HTTP_201_CREATED)
-def save_history(item: ProductCheckHistoryCreate):
-    # Сохраняем только если статус не unknown
-    if item.status not in ["certified", "haram", "doubtful", "clean"]:
+async def save_history(item: ProductCheckHistoryCreate, db: AsyncSession = Depends(get_db)):
+    if item.status not in HISTORY_STATUSES:
         raise HTTPException(status_code=400, detail="Invalid status for saving history")
-    db: Session = SessionLocal()
     db_item = ProductCheckHistory(
         user_id=1,  # TODO: заменить на Depends(get_current_user) для реального пользователя
         product_name=item.product_name,
@@ -56,14 +292,46 @@ def save_history(item: ProductCheckHistoryCreate):
         additional_notes=item.additional_notes
     )
     db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
-    db.close()
+    await db.commit()
+    await db.refresh(db_item)
     return db_item
 
-@router.get("/history", response_model=list[ProductCheckHistoryResponse])
-def get_history():
-    db: Session = SessionLocal()
-    items = db.query(ProductCheckHistory).filter(ProductCheckHistory.user_id == 1).order_by(ProductCheckHistory.date.desc()).all()
-    db.close()
-    return items 
\ No newline at end of file
+@router.post("/history/batch", response_model=List[ProductCheckHistoryBatchOutcome])
+async def save_history_batch_endpoint(batch: ProductCheckHistoryBatch, db: AsyncSession = Depends(get_db)):
+    """Синхронизация офлайн-очереди: все элементы одной транзакцией, результат по каждому элементу."""
+    if len(batch.items) > HISTORY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {HISTORY_BATCH_MAX_ITEMS} items per batch")
+    # TODO: заменить на Depends(get_current_user) для реального пользователя
+    return await save_history_batch(db, user_id=1, items=batch.items)
+
+@router.get("/history")
+async def get_history(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    brand: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: Optional[str] = Query(None, description="Поля через запятую, например fields=brand,status"),
+    db: AsyncSession = Depends(get_db),
+):
+    """История от новых к старым; курсор следующей страницы — в заголовке X-Next-Cursor.
+
+    Ответ остаётся массивом, как раньше; при ?fields= в элементах только id, date и запрошенные поля.
+    Без limit и cursor отдаётся вся история, как до пагинации: на ней считается статистика на фронтенде.
+    С cursor без limit страница по умолчанию — HISTORY_DEFAULT_LIMIT.
+    """
+    if limit is None and cursor:
+        limit = HISTORY_DEFAULT_LIMIT
+    try:
+        selected = parse_fields(fields)
+        items, next_cursor = await fetch_history(
+            db, user_id=1, limit=limit, cursor=cursor, fields=selected,
+            status=status_filter, brand=brand, date_from=date_from, date_to=date_to,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
@@ -0,0 +1,108 @@
+import json
+import os
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from observability import METRICS_ENABLED, LLM_ESCALATIONS, llm_cost, percentile
+
+# Правила эскалации: результат ступени передаётся как dict, None — ответ не прошёл валидацию схемы
+ESCALATION_RULES: Dict[str, Callable[[Optional[Dict[str, Any]]], bool]] = {
+    "invalid": lambda result: result is None,
+    "low_confidence": lambda result: result is not None and result.get("confidence") == "низкая",
+    "doubtful": lambda result: result is not None and result.get("status") == "doubtful",
+    "haram": lambda result: result is not None and result.get("status") == "haram",
+    "no_ingredients": lambda result: result is not None and not result.get("ingredients"),
+}
+
+# Модели ступени по порядку: следующая вызывается, только если сработало одно из правил escalate_on.
+# Переопределяется JSON вида {"halal": {"models": ["gpt-4o"], "escalate_on": []}}
+DEFAULT_ROUTES = {
+    # Короткая классификация текста: mini справляется в разы быстрее и дешевле
+    "halal": {"models": ["gpt-4o-mini", "gpt-4o"], "escalate_on": ["invalid", "low_confidence", "doubtful"]},
+    # Чтение состава с фото у mini заметно хуже, поэтому по умолчанию сразу gpt-4o
+    "vision": {"models": ["gpt-4o"], "escalate_on": ["invalid", "no_ingredients"]},
+    "single_pass": {"models": ["gpt-4o"], "escalate_on": ["invalid", "low_confidence"]},
+}
+LLM_ROUTES = {**DEFAULT_ROUTES, **json.loads(os.getenv("LLM_ROUTES_JSON", "{}"))}
+
+
+class ModelRoute:
+    def __init__(self, stage: str, models: List[str], escalate_on: List[str] = ()):
+        unknown = set(escalate_on) - set(ESCALATION_RULES)
+        if not models:
+            raise ValueError(f"Route for {stage} has no models")
+        if unknown:
+            raise ValueError(f"Unknown escalation rules for {stage}: {', '.join(sorted(unknown))}")
+        self.stage = stage
+        self.models = list(models)
+        self.escalate_on = list(escalate_on)
+
+    def reasons(self, result: Optional[Dict[str, Any]]) -> List[str]:
+        return [rule for rule in self.escalate_on if ESCALATION_RULES[rule](result)]
+
+    def next_model(self, model: str) -> Optional[str]:
+        index = self.models.index(model)
+        return self.models[index + 1] if index + 1 < len(self.models) else None
+
+    def describe(self) -> Dict[str, Any]:
+        return {"models": self.models, "escalate_on": self.escalate_on}
+
+
+class ModelRouter:
+    def __init__(self, routes: Dict[str, Dict[str, Any]] = LLM_ROUTES):
+        self.routes = {stage: ModelRoute(stage, **config) for stage, config in routes.items()}
+
+    def route(self, stage: str) -> ModelRoute:
+        return self.routes[stage]
+
+
+class RouteStats:
+    """Задержка, токены, стоимость и эскалации по ступеням и моделям — как ModeStats для режимов."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.reset()
+
+    def reset(self) -> None:
+        self.entries: Dict[tuple, Dict[str, Any]] = {}
+
+    def record(self, stage: str, model: str, latency_ms: float, usage: Optional[Dict[str, int]],
+               reasons: List[str] = ()) -> None:
+        entry = self.entries.setdefault((stage, model), {
+            "requests": 0, "escalations": 0, "reasons": {}, "prompt_tokens": 0, "completion_tokens": 0,
+            "latencies": deque(maxlen=self.window),
+        })
+        usage = usage or {}
+        entry["requests"] += 1
+        entry["latencies"].append(latency_ms)
+        entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        entry["completion_tokens"] += usage.get("completion_tokens", 0)
+        if reasons:
+            entry["escalations"] += 1
+            for reason in reasons:
+                entry["reasons"][reason] = entry["reasons"].get(reason, 0) + 1
+                if METRICS_ENABLED:
+                    LLM_ESCALATIONS.labels(stage, reason).inc()
+
+    def stats(self) -> Dict[str, Any]:
+        stages: Dict[str, Dict[str, Any]] = {}
+        for (stage, model), entry in self.entries.items():
+            requests = entry["requests"]
+            cost = llm_cost(model, entry["prompt_tokens"], entry["completion_tokens"])
+            stages.setdefault(stage, {})[model] = {
+                "requests": requests,
+                "escalations": entry["escalations"],
+                "escalation_ratio": entry["escalations"] / requests if requests else 0,
+                "reasons": dict(entry["reasons"]),
+                "latency_p50_ms": percentile(entry["latencies"], 0.5),
+                "latency_p95_ms": percentile(entry["latencies"], 0.95),
+                "avg_prompt_tokens": entry["prompt_tokens"] / requests if requests else 0,
+                "avg_completion_tokens": entry["completion_tokens"] / requests if requests else 0,
+                "cost_usd": cost,
+                "avg_cost_usd": cost / requests if cost is not None and requests else None,
+            }
+        return {"routes": {stage: route.describe() for stage, route in model_router.routes.items()}, "stages": stages}
+
+
+model_router = ModelRouter()
+route_stats = RouteStats()
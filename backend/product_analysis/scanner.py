@@ -0,0 +1,301 @@
+import re
+from collections import deque
+from typing import Any, Dict, List, Tuple
+
+# Словарь сканера: термин -> (ключ правила в SEED_RULES, категория).
+# «*» в конце — основа слова: совпадение тянется до конца слова (свин* -> свиного, желатин* -> желатина).
+# Термины без «*» ищутся только целым словом: «ром» не должен срабатывать на «ромашку».
+# E-номера в словаре не нужны: их сканер распознаёт сам (E120, Е-471, e 160а, E1422).
+# Исключения (категория "exception") длиннее основ, которые перекрывают, и поэтому выигрывают у них:
+# «уксус спиртовой» — не «спирт*», «свинец» — не «свин*».
+ADDITIVE_TERMS: Dict[str, Tuple[str, str]] = {
+    # Свинина
+    "свинин*": ("свинина", "pork"),
+    "свин*": ("свиной", "pork"),
+    "сало": ("сало", "pork"),
+    "шпик*": ("сало", "pork"),
+    "бекон*": ("бекон", "pork"),
+    "шошқа*": ("свиной", "pork"),
+    "pork": ("pork", "pork"),
+    "pig": ("pork", "pork"),
+    "swine": ("pork", "pork"),
+    "lard": ("lard", "pork"),
+    "bacon": ("bacon", "pork"),
+    "schwein*": ("pork", "pork"),
+    "domuz*": ("pork", "pork"),
+    "свинец*": ("свинец", "exception"),
+    "свинц*": ("свинец", "exception"),
+    # Алкоголь
+    "спирт*": ("спирт", "alcohol"),
+    "этиловый спирт": ("этиловый спирт", "alcohol"),
+    "этанол*": ("спирт", "alcohol"),
+    "уксус спиртов*": ("уксус спиртовой", "exception"),
+    "уксуса спиртов*": ("уксус спиртовой", "exception"),
+    "спиртовой уксус": ("уксус спиртовой", "exception"),
+    "спиртового уксуса": ("уксус спиртовой", "exception"),
+    "alcohol*": ("alcohol", "alcohol"),
+    "ethanol": ("ethanol", "alcohol"),
+    "ethyl alcohol": ("ethanol", "alcohol"),
+    "вино": ("вино", "alcohol"),
+    "вина": ("вино", "alcohol"),
+    "вином": ("вино", "alcohol"),
+    "шарап*": ("вино", "alcohol"),
+    "wine": ("wine", "alcohol"),
+    "коньяк*": ("коньяк", "alcohol"),
+    "cognac": ("коньяк", "alcohol"),
+    "brandy": ("коньяк", "alcohol"),
+    "ром": ("ром", "alcohol"),
+    "рома": ("ром", "alcohol"),
+    "ромом": ("ром", "alcohol"),
+    "rum": ("rum", "alcohol"),
+    "ликер*": ("ликер", "alcohol"),
+    "liqueur*": ("ликер", "alcohol"),
+    "пиво": ("пиво", "alcohol"),
+    "пива": ("пиво", "alcohol"),
+    "beer": ("пиво", "alcohol"),
+    "водк*": ("алкоголь", "alcohol"),
+    "виски": ("алкоголь", "alcohol"),
+    "whisky": ("алкоголь", "alcohol"),
+    "whiskey": ("алкоголь", "alcohol"),
+    "арақ": ("алкоголь", "alcohol"),
+    # Насекомые
+    "кармин*": ("кармин", "insect"),
+    "кошенил*": ("кошениль", "insect"),
+    "carmine": ("carmine", "insect"),
+    "carminic acid": ("carmine", "insect"),
+    "cochineal": ("cochineal", "insect"),
+    "шеллак*": ("e904", "insect"),
+    "shellac": ("e904", "insect"),
+    # Желатин
+    "желатин*": ("желатин", "gelatin"),
+    "gelatin*": ("gelatin", "gelatin"),
+    "jelatin*": ("gelatin", "gelatin"),
+    # Ферменты и компоненты, которые бывают животного происхождения
+    "сычужн*": ("сычужный фермент", "enzyme"),
+    "rennet": ("сычужный фермент", "enzyme"),
+    "глицерин*": ("e422", "animal_derived"),
+    "glycerin*": ("e422", "animal_derived"),
+    "glycerol": ("e422", "animal_derived"),
+    "диглицерид*": ("e471", "animal_derived"),
+    "diglycerid*": ("e471", "animal_derived"),
+    "стеарин*": ("e570", "animal_derived"),
+    "stearic acid": ("e570", "animal_derived"),
+    "цистеин*": ("e920", "animal_derived"),
+    "cysteine": ("e920", "animal_derived"),
+    "костный фосфат": ("e542", "animal_derived"),
+    "костного фосфата": ("e542", "animal_derived"),
+    # Ароматизаторы могут быть на спирту
+    "ароматизатор*": ("ароматизатор", "flavoring"),
+    "flavour*": ("ароматизатор", "flavoring"),
+    "flavor*": ("ароматизатор", "flavoring"),
+}
+
+# Разметка текста этикетки: начало блока состава и то, что идёт после него
+SECTION_TERMS: Dict[str, Tuple[str, str]] = {
+    "состав*": ("состав", "section"),
+    "құрамы": ("состав", "section"),
+    "ingredients": ("состав", "section"),
+    "пищевое": ("stop", "stop"),
+    "пищевая": ("stop", "stop"),
+    "энергетическая": ("stop", "stop"),
+    "условия хранения": ("stop", "stop"),
+    "срок годности": ("stop", "stop"),
+    "масса нетто": ("stop", "stop"),
+    "производитель": ("stop", "stop"),
+    "nutrition facts": ("stop", "stop"),
+    "best before": ("stop", "stop"),
+}
+
+# Латиница, которую OCR путает с кириллицей, сводится к кириллице — но только внутри слов, где уже есть
+# кириллица или цифры («жeлатин», «E12O»): латинское слово целиком остаётся латиницей, иначе «pom» = «ром»
+_HOMOGLYPHS = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м", "o": "о",
+    "p": "р", "t": "т", "x": "х", "y": "у", "ё": "е", "ı": "і", "i": "і",
+})
+# Буквы, которые OCR читает вместо цифр внутри E-номера (уже после сведения омоглифов)
+_DIGIT_LOOKALIKES = {"о": "0", "з": "3", "б": "6", "і": "1", "l": "1", "|": "1"}
+# Буквенный индекс E-номера: кириллический по порядку алфавита (Е150в = E150c)
+_E_SUFFIXES = {"a": "a", "b": "b", "c": "c", "d": "d", "а": "a", "б": "b", "в": "c", "г": "d"}
+_HYPHENS = "-‐‑‒–—¬"
+# Быстрый путь fold: посимвольные замены без смены длины (str.replace в C быстрее str.translate с кириллицей),
+# если в тексте нет переносов, мягких дефисов, повторных пробелов и похожих на цифры букв в E-номере
+_FAST_REPLACEMENTS = [(chr(code), value) for code, value in _HOMOGLYPHS.items()] + \
+    [("\n", " "), ("\r", " "), ("\t", " ")] + [(dash, "-") for dash in _HYPHENS[1:-1]]
+# Слово из одной латиницы (от двух букв: одиночная «E» — начало E-номера «E 120»)
+_LATIN_WORD_RE = re.compile(r"(?<![^\W_])[a-zA-Z]{2,}(?![^\W_])")
+_SLOW_PATH_RE = re.compile(r"[\u00ad¬]|[‐‑‒–—-]\s*[\r\n]|\s\s|[^\S \n\r\t]|(?<!\w)[eе][ -]{0,3}\d*[oоiіlзб|]")
+
+
+def fold(text: str, keep_latin: bool = True) -> Tuple[str, List[int]]:
+    """Приводит текст к виду для поиска и возвращает его вместе с позициями символов в исходном тексте.
+
+    Один проход: нижний регистр, омоглифы, пробелы в один, склейка переносов («жела-\\nтин»),
+    цифры вместо похожих букв в E-номерах («Е12О» -> «е120»). keep_latin=False сводит к кириллице
+    и чисто латинские слова — так словарь получает вариант термина для слов со смешанным алфавитом.
+    """
+    latin = list(_LATIN_WORD_RE.finditer(text)) if keep_latin else []
+    lowered = text.lower()
+    if len(lowered) == len(text) and not _SLOW_PATH_RE.search(lowered):
+        for source, target in _FAST_REPLACEMENTS:
+            if source in lowered:
+                lowered = lowered.replace(source, target)
+        if latin:
+            pieces, last = [], 0
+            for match in latin:
+                pieces += [lowered[last:match.start()], match.group().lower()]
+                last = match.end()
+            lowered = "".join(pieces) + lowered[last:]
+        return lowered, range(len(text))
+    keep = set()
+    for match in latin:
+        keep.update(range(match.start(), match.end()))
+    out: List[str] = []
+    origin: List[int] = []
+    # 0 — не E-номер, 1 — «е» в начале слова (и разделители за ней), 2 — пошли цифры
+    e_state, e_digits = 0, 0
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i].lower()
+        if ch == "­":
+            i += 1
+            continue
+        if ch in _HYPHENS:
+            j, newline = i + 1, ch == "¬"
+            while j < n and text[j].isspace():
+                newline = newline or text[j] in "\r\n"
+                j += 1
+            if newline and out and out[-1].isalpha() and j < n and text[j].isalpha():
+                i = j
+                continue
+            ch = "-"
+        elif ch.isspace():
+            if out and out[-1] == " ":
+                i += 1
+                continue
+            ch = " "
+        elif i not in keep:
+            ch = ch.translate(_HOMOGLYPHS)
+            if ch in _DIGIT_LOOKALIKES and e_state:
+                following = text[i + 1] if i + 1 < n else ""
+                if following.isdigit() or (e_state == 2 and e_digits < 3):
+                    ch = _DIGIT_LOOKALIKES[ch]
+
+        if ch == "е" and (not out or not out[-1].isalnum()):
+            e_state, e_digits = 1, 0
+        elif ch.isdigit() and e_state:
+            e_state, e_digits = 2, e_digits + 1
+        elif not (ch in " -" and e_state == 1):
+            e_state = 0
+        out.append(ch)
+        origin.append(i)
+        i += 1
+    return "".join(out), origin
+
+
+class AdditiveScanner:
+    """Aho-Corasick по многоязычному словарю добавок, плюс распознавание E-номеров в том же проходе.
+
+    scan(text) возвращает неперекрывающиеся совпадения (самое левое, затем самое длинное) с границами
+    в исходном тексте: {"text", "term", "category", "start", "end"}; term — ключ правила в SEED_RULES.
+    """
+
+    def __init__(self, terms: Dict[str, Tuple[str, str]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, str, str, bool]]] = [[]]
+        for term, (key, category) in terms.items():
+            stem = term.endswith("*")
+            pattern, _ = fold(term.rstrip("*"))
+            self._insert(pattern, key, category, stem)
+            mixed, _ = fold(term.rstrip("*"), keep_latin=False)
+            if mixed != pattern:
+                self._insert(mixed, key, category, stem)
+        self._build_links()
+
+    def _insert(self, pattern: str, key: str, category: str, stem: bool) -> None:
+        node = 0
+        for ch in pattern:
+            if ch not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][ch] = len(self._goto) - 1
+            node = self._goto[node][ch]
+        self._out[node].append((len(pattern), key, category, stem))
+
+    def _build_links(self) -> None:
+        # У детей корня суффиксная ссылка — корень; дальше обход в ширину
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                fallback = self._fail[node]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                queue.append(child)
+
+    def scan(self, text: str) -> List[Dict[str, Any]]:
+        folded, origin = fold(text)
+        n = len(folded)
+        found: List[Tuple[int, int, int, str, str]] = []
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        e_start, e_digits = -1, 0
+        for i, ch in enumerate(folded):
+            following = goto[node].get(ch)
+            while following is None and node:
+                node = fail[node]
+                following = goto[node].get(ch)
+            node = following or 0
+            for length, key, category, stem in out[node]:
+                start, end = i - length + 1, i + 1
+                if start > 0 and folded[start - 1].isalnum():
+                    continue
+                if stem:
+                    while end < n and folded[end].isalnum():
+                        end += 1
+                elif end < n and folded[end].isalnum():
+                    continue
+                found.append((start, end, length, key, category))
+
+            # E-номер: «е» в начале слова, до одного разделителя, 3-4 цифры, необязательный буквенный индекс
+            if e_start >= 0:
+                if ch.isdigit():
+                    e_digits += 1
+                    continue
+                if e_digits:
+                    self._finish_e_number(text, folded, origin, e_start, i, e_digits, found)
+                    e_start = -1
+                elif not (ch in " -" and i - e_start <= 3):
+                    e_start = -1
+            if ch == "е" and (i == 0 or not folded[i - 1].isalnum()):
+                e_start, e_digits = i, 0
+        if e_start >= 0 and e_digits:
+            self._finish_e_number(text, folded, origin, e_start, n, e_digits, found)
+
+        hits, covered = [], 0
+        # Самое левое, затем самое длинное; при равных границах — более длинный термин («свинин*» точнее «свин*»)
+        for start, end, _, key, category in sorted(found, key=lambda hit: (hit[0], hit[0] - hit[1], -hit[2])):
+            if start < covered:
+                continue
+            covered = end
+            raw_start, raw_end = origin[start], origin[end - 1] + 1
+            hits.append({"text": text[raw_start:raw_end], "term": key, "category": category, "start": raw_start, "end": raw_end})
+        return hits
+
+    @staticmethod
+    def _finish_e_number(text: str, folded: str, origin: List[int], start: int, end: int, digits: int, found: list) -> None:
+        if not 3 <= digits <= 4:
+            return
+        number = folded[end - digits:end]
+        suffix = _E_SUFFIXES.get(text[origin[end]].lower()) if end < len(folded) else None
+        if suffix and (end + 1 == len(folded) or not folded[end + 1].isalnum()):
+            number, end = number + suffix, end + 1
+        elif end < len(folded) and folded[end].isalpha():
+            return
+        found.append((start, end, end - start, "e" + number, "e_number"))
+
+
+additive_scanner = AdditiveScanner({**ADDITIVE_TERMS, **SECTION_TERMS})
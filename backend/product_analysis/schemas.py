@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 from datetime import datetime
 
 class ProductAnalysisResponse(BaseModel):
@@ -9,6 +9,30 @@ class ProductAnalysisResponse(BaseModel):
     concerns: Optional[List[str]] = None
     confidence: str
 
+class IngredientVerdictItem(BaseModel):
+    name: str
+    status: Literal["clean", "doubtful", "haram"]
+    reason: str
+
+class HalalVerdict(BaseModel):
+    status: Literal["certified", "clean", "doubtful", "haram"]
+    confidence: Literal["высокая", "средняя", "низкая"]
+    concerns: List[str] = []
+    recommendation: str
+    ingredients: List[IngredientVerdictItem] = []
+
+class SinglePassAnalysis(BaseModel):
+    brand: Optional[str]
+    product_name: Optional[str]
+    manufacturer: Optional[str]
+    country: Optional[str]
+    ingredients: List[str]
+    status: Literal["certified", "clean", "doubtful", "haram"]
+    confidence: Literal["высокая", "средняя", "низкая"]
+    concerns: List[str]
+    recommendation: str
+    ingredient_verdicts: List[IngredientVerdictItem]
+
 class ProductCheckHistoryCreate(BaseModel):
     product_name: Optional[str] = None
     brand: Optional[str] = None
@@ -24,6 +48,20 @@ class ProductCheckHistoryCreate(BaseModel):
     barcode: Optional[str] = None
     additional_notes: Optional[str] = None
 
+class ProductCheckHistoryBatchItem(ProductCheckHistoryCreate):
+    # Ключ, который клиент присваивает проверке в офлайн-очереди; без него повтор создаст дубль
+    idempotency_key: Optional[str] = Field(None, max_length=128)
+
+class ProductCheckHistoryBatch(BaseModel):
+    items: List[ProductCheckHistoryBatchItem]
+
+class ProductCheckHistoryBatchOutcome(BaseModel):
+    index: int
+    status: Literal["created", "duplicate", "error"]
+    id: Optional[int] = None
+    idempotency_key: Optional[str] = None
+    error: Optional[str] = None
+
 class ProductCheckHistoryResponse(ProductCheckHistoryCreate):
     id: int
     date: datetime 
\ No newline at end of file
@@ -0,0 +1,102 @@
+import asyncio
+import copy
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .cache import PHASH_MAX_DISTANCE, hamming
+from .ingredients import normalize
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") == "1"
+
+
+class SingleFlight:
+    """Склейка одновременных одинаковых запросов: первый (лидер) запускает работу,
+    остальные ждут тот же результат, пока он ещё не попал в кэш.
+
+    Работа идёт в отдельной задаче, а ожидающие смотрят на неё через asyncio.shield:
+    отключение любого клиента, включая лидера, не отменяет общий вызов к OpenAI.
+    Каждый ожидающий получает свою копию результата — вызывающий код дописывает в него metadata.
+    """
+
+    def __init__(self, name: str, similar_distance: int = -1):
+        self.name = name
+        # Для фото: ключ в работе, но у нового запроса другие байты и почти тот же dHash в той же группе
+        self.similar_distance = similar_distance
+        self._inflight: Dict[Hashable, Tuple[asyncio.Task, Optional[int], Optional[Hashable]]] = {}
+        self.counters = {"leaders": 0, "coalesced": 0, "coalesced_similar": 0, "failed": 0, "orphaned": 0}
+        self._waiters: Dict[Hashable, int] = {}
+
+    def find(self, key: Hashable, phash: Optional[int] = None, group: Optional[Hashable] = None) -> Optional[Hashable]:
+        if key in self._inflight:
+            return key
+        if phash is None or group is None or self.similar_distance < 0:
+            return None
+        for other, (_, other_phash, other_group) in self._inflight.items():
+            if other_group == group and other_phash is not None and hamming(phash, other_phash) <= self.similar_distance:
+                return other
+        return None
+
+    async def do(self, key: Hashable, work: Callable[[], Awaitable[Any]], phash: Optional[int] = None,
+                 on_join: Callable[[Any], Any] = None, group: Optional[Hashable] = None) -> Any:
+        """Результат work() — своей или уже идущей. on_join получает копию результата у присоединившихся.
+
+        К работе с другим ключом по близкому phash присоединяемся только в той же group (не None).
+        """
+        if not SINGLEFLIGHT_ENABLED:
+            return await work()
+        joined = self.find(key, phash, group)
+        leader = joined is None
+        if leader:
+            self.counters["leaders"] += 1
+            # Задача наследует контекст лидера, в том числе его бюджет llm_budget
+            task = asyncio.create_task(work())
+            self._inflight[key] = (task, phash, group)
+            task.add_done_callback(lambda done: self._finish(key, done))
+            joined = key
+        else:
+            self.counters["coalesced" if joined == key else "coalesced_similar"] += 1
+        task = self._inflight[joined][0]
+        self._waiters[joined] = self._waiters.get(joined, 0) + 1
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            self._waiters[joined] -= 1
+            if not self._waiters[joined]:
+                self._waiters.pop(joined, None)
+                if not task.done():
+                    # Все клиенты ушли, а работа доделается и попадёт в кэш
+                    self.counters["orphaned"] += 1
+        if leader:
+            return result
+        result = copy.deepcopy(result)
+        return on_join(result) if on_join is not None else result
+
+    def joinable(self, key: Hashable, phash: Optional[int] = None, group: Optional[Hashable] = None) -> bool:
+        return SINGLEFLIGHT_ENABLED and self.find(key, phash, group) is not None
+
+    def _finish(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key, (None,))[0] is task:
+            del self._inflight[key]
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            # Читаем исключение, даже если ждать его уже некому: иначе asyncio пишет «never retrieved»
+            self.counters["failed"] += 1
+            if not self._waiters.get(key):
+                logging.warning(f"Single-flight {self.name} work failed with no waiters: {error}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "in_flight": len(self._inflight)}
+
+
+def halal_key(brand: Optional[str], product_name: Optional[str], ingredients: List[str]) -> Tuple[str, str, Tuple[str, ...]]:
+    # Порядок и регистр ингредиентов на разных фото одной упаковки могут отличаться
+    return normalize(brand or ""), normalize(product_name or ""), tuple(sorted({normalize(i) for i in ingredients}))
+
+
+# Полный анализ фото: ключ — sha256 байтов, плюс близкий dHash нормализованного кадра с тем же штрихкодом
+image_flights = SingleFlight("image", similar_distance=PHASH_MAX_DISTANCE)
+# Вердикт по составу: ключ — нормализованные бренд, название и ингредиенты
+halal_flights = SingleFlight("halal")
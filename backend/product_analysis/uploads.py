@@ -0,0 +1,229 @@
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+
+from observability import METRICS_ENABLED, UPLOAD_BYTES, UPLOAD_REJECTED, UPLOAD_SPOOLED, stage
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 15 * 1024 * 1024))
+# Фото крупнее держим не в памяти, а во временном файле: в пул предобработки уходит путь, а не байты
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", 1024 * 1024))
+# Сколько байт загрузок процесс держит в памяти одновременно; сверх этого на диск уходят и небольшие фото
+UPLOAD_MEMORY_BYTES = int(os.getenv("UPLOAD_MEMORY_BYTES", 64 * 1024 * 1024))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or tempfile.gettempdir()
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Заголовки multipart и текстовые поля формы сверх самого файла
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+# Сигнатуры форматов: (смещение, байты, MIME). Заголовку Content-Type клиента не верим
+MAGIC_NUMBERS = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (8, b"WEBP", "image/webp"),
+    (4, b"ftypheic", "image/heic"),
+    (4, b"ftypheix", "image/heic"),
+    (4, b"ftypmif1", "image/heif"),
+    (4, b"ftypmsf1", "image/heif"),
+    (4, b"ftypavif", "image/avif"),
+]
+ZIP_MAGIC = b"PK\x03\x04"
+SNIFF_BYTES = 16
+
+
+class NotAnImageError(ValueError):
+    pass
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    for offset, magic, mime_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            # RIFF-контейнер бывает и WAV/AVI: WEBP — только вместе с RIFF в начале
+            if mime_type == "image/webp" and not head.startswith(b"RIFF"):
+                continue
+            return mime_type
+    return None
+
+
+def body_limit(max_bytes: int) -> int:
+    return max_bytes + UPLOAD_FORM_OVERHEAD
+
+
+def too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Uploaded file is larger than {max_bytes // (1024 * 1024)} MB")
+
+
+class UploadMemory:
+    """Байты загрузок, которые сейчас лежат в памяти процесса. Всё, что не влезает в лимит, идёт на диск."""
+
+    def __init__(self, limit: int = UPLOAD_MEMORY_BYTES):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.spooled = 0
+        # Резервируют и из потоков (распаковка zip в run_in_threadpool)
+        self._lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size: int) -> None:
+        with self._lock:
+            self.used -= size
+
+    def stats(self) -> Dict[str, Any]:
+        return {"used_bytes": self.used, "peak_bytes": self.peak, "limit_bytes": self.limit, "spooled": self.spooled}
+
+
+upload_memory = UploadMemory()
+
+
+def spool_to_disk(file, max_bytes: int) -> Dict[str, Any]:
+    """Копирует файл кусками во временный файл с именем, которое можно передать в другой процесс."""
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_DIR, prefix="upload_", delete=False) as target:
+        try:
+            while chunk := file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise too_large(max_bytes)
+                digest.update(chunk)
+                target.write(chunk)
+        except BaseException:
+            target.close()
+            os.unlink(target.name)
+            raise
+    upload_memory.spooled += 1
+    if METRICS_ENABLED:
+        UPLOAD_SPOOLED.inc()
+    return {"source": target.name, "size": size, "sha256": digest.hexdigest(), "spooled": True}
+
+
+def store_file(file, size: Optional[int], max_bytes: int = UPLOAD_MAX_BYTES) -> Dict[str, Any]:
+    """Небольшой файл читает в память в пределах UPLOAD_MEMORY_BYTES, остальное сбрасывает на диск.
+
+    Блокирующая: вызывайте через run_in_threadpool. Результат освобождается через release_image.
+    """
+    if size is not None and size > max_bytes:
+        if METRICS_ENABLED:
+            UPLOAD_REJECTED.labels("too_large").inc()
+        raise too_large(max_bytes)
+    if size is not None and size <= UPLOAD_SPOOL_BYTES and upload_memory.reserve(size):
+        try:
+            content = file.read(size)
+        except BaseException:
+            upload_memory.release(size)
+            raise
+        received = {"source": content, "size": len(content), "sha256": None, "spooled": False, "reserved": size}
+    else:
+        received = spool_to_disk(file, max_bytes)
+    if METRICS_ENABLED:
+        UPLOAD_BYTES.observe(received["size"])
+    return received
+
+
+async def peek(upload: UploadFile, size: int = SNIFF_BYTES) -> bytes:
+    head = await upload.read(size)
+    await upload.seek(0)
+    return head
+
+
+async def receive_image(upload: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> Dict[str, Any]:
+    """Проверяет сигнатуру и размер загрузки и отдаёт её байтами или путём к файлу на диске.
+
+    source — bytes или путь (str); preprocess_image принимает и то и другое. После анализа
+    вызовите release_image — проще всего через received_image.
+    """
+    mime_type = sniff_mime(await peek(upload))
+    if mime_type is None:
+        if METRICS_ENABLED:
+            UPLOAD_REJECTED.labels("not_image").inc()
+        raise NotAnImageError("Uploaded file must be an image")
+    # Starlette уже разобрал форму: части больше 1 МБ лежат в анонимном временном файле,
+    # а upload.size — реальный размер части, а не заявленный клиентом
+    received = await run_in_threadpool(store_file, upload.file, upload.size, max_bytes)
+    return {**received, "mime_type": mime_type}
+
+
+def release_image(received: Dict[str, Any]) -> None:
+    if received.get("reserved"):
+        upload_memory.release(received.pop("reserved"))
+    if received["spooled"]:
+        try:
+            os.unlink(received["source"])
+        except FileNotFoundError:
+            pass
+
+
+def read_image_bytes(received: Dict[str, Any]) -> bytes:
+    if not received["spooled"]:
+        return received["source"]
+    with open(received["source"], "rb") as f:
+        return f.read()
+
+
+@asynccontextmanager
+async def received_image(upload: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> AsyncIterator[Dict[str, Any]]:
+    with stage("upload"):
+        received = await receive_image(upload, max_bytes)
+    try:
+        yield received
+    finally:
+        release_image(received)
+
+
+class UploadLimitMiddleware:
+    """ASGI-middleware: 413 до разбора формы, если тело запроса больше лимита маршрута.
+
+    Заявленный Content-Length проверяется сразу, без чтения тела; при chunked-передаче
+    тело обрывается, как только принято больше лимита, и на диск не пишется весь файл.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            if METRICS_ENABLED:
+                UPLOAD_REJECTED.labels("too_large").inc()
+            error = too_large(limit - UPLOAD_FORM_OVERHEAD)
+            await JSONResponse({"detail": error.detail}, status_code=error.status_code,
+                               headers={"Connection": "close"})(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    if METRICS_ENABLED:
+                        UPLOAD_REJECTED.labels("too_large").inc()
+                    # FastAPI пробрасывает HTTPException из разбора тела как есть, а не превращает в 400
+                    raise too_large(limit - UPLOAD_FORM_OVERHEAD)
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,24 @@
+import pytest
+
+from product_analysis.ingredients import ingredient_index
+from product_analysis.scanner import additive_scanner
+
+
+# Ложные срабатывания основ «спирт*», «свин*» и сведения омоглифов: «pom» — латиница, а не «ром»
+@pytest.mark.parametrize("text", ["уксус спиртовой", "Уксус спиртовой 9%", "спиртовой уксус", "свинец", "pom", "POM"])
+def test_not_haram(text):
+    assert all(hit["status"] != "haram" for hit in ingredient_index.annotate(additive_scanner.scan(text)))
+    verdict = ingredient_index.verdict(text)
+    assert verdict is None or verdict[0] != "haram"
+
+
+@pytest.mark.parametrize("text, term", [
+    ("спирт этиловый", "спирт"),
+    ("свиной жир", "свиной"),
+    ("Ром", "ром"),
+    ("жeлатин", "желатин"),  # латинская «e» внутри кириллического слова
+    ("pоrk", "pork"),  # кириллическая «о» внутри латинского слова
+    ("E12O", "e120"),
+])
+def test_still_found(text, term):
+    assert [hit["term"] for hit in additive_scanner.scan(text)] == [term]